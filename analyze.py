@@ -4,12 +4,12 @@ import sys
 
 from utils import (
     analyze,
+    analyze_all_periods,
     check_parameters,
 )
 
 from instructions import instructions, rate_instructions
 
-
 DEFAULT_EXCEL_OUTPUT_FOLDER_NAME = "out"
 DEFAULT_TO_DROP_COLUMN = "to_drop"
 DEFAULT_DEFAULT_DAYS_CUTOFF = 30
@@ -74,11 +74,59 @@ def main():
         default=None,
         help="Il numero di ricoveri (o pazienti) da considerare per il calcolo dei tassi di isolamenti per 1.000 ricoveri (o pazienti).",
     )
+    parser.add_argument(
+        "--legacy-resistance",
+        action="store_true",
+        help="Calcola le resistenze gruppo per gruppo con il metodo precedente (più lento) invece che in modo vettoriale su tutti gli isolati.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="Il numero di processi (o thread) con cui parallelizzare l'elaborazione, se non specificato vengono usati tutti i processori disponibili.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["serial", "threads", "processes"],
+        default="processes",
+        help="Come parallelizzare l'elaborazione: in serie, con più thread o con più processi. Le elaborazioni piccole vengono comunque eseguite in serie.",
+    )
+    parser.add_argument(
+        "--all-periods",
+        action="store_true",
+        help="Genera in un'unica esecuzione i report di tutti i mesi dell'anno e quello annuale, caricando e classificando i dati una volta sola.",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        nargs="+",
+        choices=["xlsx", "parquet", "csv", "ndjson"],
+        default=["xlsx"],
+        help="I formati in cui salvare il report, anche più di uno. Con parquet, csv e ndjson le tabelle overall, overall_rates e details vengono salvate in una cartella con lo stesso nome del file excel. Se xlsx non è tra i formati il file excel non viene generato.",
+    )
     args = parser.parse_args(args)
     config = vars(args)
     check_parameters(**config)
 
     # Analyze
+    if config.get("all_periods"):
+        analyze_all_periods(
+            year=config.get("year"),
+            excel_output_folder_name=config.get("output_folder"),
+            drop_column=config.get("drop_column"),
+            default_days_cutoff=config.get("default_days_cutoff"),
+            instructions=instructions,
+            rate_instructions=rate_instructions,
+            days_of_hospitalization=config.get("days_hospitalization"),
+            number_of_admissions_or_patients=config.get("n_admissions"),
+            legacy_resistance=config.get("legacy_resistance"),
+            workers=config.get("workers"),
+            backend=config.get("backend"),
+            output_formats=config.get("output_format"),
+        )
+        return
     analyze(
         year=config.get("year"),
         month=config.get("month"),
@@ -89,6 +137,10 @@ def main():
         rate_instructions=rate_instructions,
         days_of_hospitalization=config.get("days_hospitalization"),
         number_of_admissions_or_patients=config.get("n_admissions"),
+        legacy_resistance=config.get("legacy_resistance"),
+        workers=config.get("workers"),
+        backend=config.get("backend"),
+        output_formats=config.get("output_format"),
     )
 
 
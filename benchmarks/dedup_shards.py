@@ -0,0 +1,85 @@
+"""Time of the deduplication of the rows of many instructions through _dedup_cache, one
+instruction at a time (1 worker) vs _dedup_cache.prefetch with the patients split in shards
+over 2, 4, ... worker processes, up to the number of CPUs. The results must be identical to
+_find_duplicated.
+
+Run from the repository root:
+    python -m benchmarks.dedup_shards [n_isolates] [n_instructions]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.duplicated_fns import _dedup_cache, _find_duplicated
+from utils.executor import _executor
+
+
+def synthetic_isolates(n_isolates, seed=0):
+    rng = np.random.default_rng(seed)
+    patient = rng.integers(0, n_isolates // 4 + 1, n_isolates)
+    resistente = rng.choice(["", "ESBL", "CAR|MDR>KPC", "VRE", "MRSA"], n_isolates)
+    return pd.DataFrame(
+        {
+            "id_richiesta": (7_000_000 + np.arange(n_isolates))
+            .astype(str)
+            .astype(object),
+            "patient_key": patient,
+            "data_prelievo": pd.Timestamp("2023-01-01")
+            + pd.to_timedelta(rng.integers(0, 365 * 24, n_isolates), unit="h"),
+            "resistente": resistente.astype(object),
+            "n_resistenze": np.char.count(resistente.astype(str), "|")
+            + (resistente != ""),
+            "id_gruppo_microbo": rng.integers(0, 170, n_isolates),
+        }
+    )
+
+
+def synthetic_requests(df, n_instructions, seed=0):
+    """(rows, days_cutoff, resistance_wise) of each instruction, the rows of a few
+    gruppi microbi as filter_df_for_count would select them"""
+    rng = np.random.default_rng(seed)
+    return [
+        (
+            df[df.id_gruppo_microbo.isin(rng.integers(0, 170, 20))],
+            int(rng.choice([7, 30, 90])),
+            bool(rng.integers(0, 2)),
+        )
+        for _ in range(n_instructions)
+    ]
+
+
+def main(n_isolates=1_000_000, n_instructions=40):
+    requests = synthetic_requests(synthetic_isolates(n_isolates), n_instructions)
+    print(
+        f"{n_instructions} instructions, "
+        f"{sum(len(r[0]) for r in requests)} rows to deduplicate"
+    )
+
+    expected = [_find_duplicated(*request) for request in requests]
+
+    workers = 1
+    while True:
+        cache = _dedup_cache()
+        start = time.perf_counter()
+        # min_rows=1: sharded with any number of workers, a single worker does not prefetch
+        # and every find_duplicated is a miss, as before prefetch
+        cache.prefetch(requests, _executor("processes", workers), min_rows=1)
+        results = [cache.find_duplicated(*request) for request in requests]
+        elapsed = time.perf_counter() - start
+        for (positions, reasons), (exp_positions, exp_reasons) in zip(
+            results, expected
+        ):
+            assert np.array_equal(positions, exp_positions)
+            assert pd.Series(reasons).equals(pd.Series(exp_reasons))
+        print(f"  {workers:2d} worker(s): {elapsed:6.2f} s")
+        if workers >= (os.cpu_count() or 1):
+            break
+        workers = min(workers * 2, os.cpu_count() or 1)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,92 @@
+"""Memory of the long format frame returned by load_data (one row per antibiotic) with plain
+object columns vs the compact dtypes (categories and string[pyarrow]), and time of the
+isolate groupby of analyze() on both.
+
+Run from the repository root:
+    python -m benchmarks.dtypes_memory [n_isolates]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.helper import _apply_compact_dtypes, to_object_dtypes
+
+ISOLATE_COLS = [
+    "id_richiesta",
+    "cognome_paziente",
+    "nome_paziente",
+    "data_nascita",
+    "tags",
+    "data_prelievo",
+    "id_gruppo_microbo",
+]
+
+
+def synthetic_long_format(n_isolates, antibiotics_per_isolate=8, seed=0):
+    rng = np.random.default_rng(seed)
+    n_rows = n_isolates * antibiotics_per_isolate
+    isolate = np.repeat(np.arange(n_isolates), antibiotics_per_isolate)
+    patient = rng.integers(0, n_isolates // 4 + 1, n_isolates)[isolate]
+    gruppo = rng.integers(0, 170, n_isolates)[isolate]
+    reparto = rng.integers(0, 120, n_isolates)[isolate]
+    materiale = rng.integers(0, 45, n_isolates)[isolate]
+
+    def labels(prefix, codes):
+        return np.array([f"{prefix}{i}" for i in range(codes.max() + 1)], dtype=object)[
+            codes
+        ]
+
+    df = pd.DataFrame(
+        {
+            "id_esame": labels("E", isolate),
+            "id_antibiotico": labels("ATB", rng.integers(0, 60, n_rows)),
+            "nome_antibiotico": labels("ANTIBIOTICO ", rng.integers(0, 60, n_rows)),
+            "id_paziente": labels("P", patient),
+            "cognome_paziente": labels("COGNOME ", patient),
+            "nome_paziente": labels("NOME ", patient),
+            "data_nascita": pd.Timestamp("1930-01-01")
+            + pd.to_timedelta(patient % 30000, unit="D"),
+            "id_reparto": labels("R", reparto),
+            "nome_reparto": labels("REPARTO ", reparto),
+            "id_richiesta": labels("7", isolate),
+            "data_prelievo": pd.Timestamp("2023-01-01")
+            + pd.to_timedelta(isolate % (365 * 24), unit="h"),
+            "id_materiale": labels("M", materiale),
+            "nome_materiale": labels("MATERIALE ", materiale),
+            "id_microbo": labels("mic", gruppo),
+            "nome_microbo": labels("Microbo ", gruppo),
+            "esbl": (gruppo % 7 == 0).astype(object),
+            "int_risultato": rng.choice(["S", "R", "I"], n_rows).astype(object),
+            "id_ricovero": labels("R", patient),
+            "risultato_quantitativo": rng.choice(["<=0.25", "1", "4", ">8"], n_rows),
+            "tags": labels("sorv_pass|", materiale % 8),
+            "id_gruppo_microbo": labels("grp", gruppo),
+            "nome_gruppo_microbo": labels("Gruppo ", gruppo),
+            "source": labels("2023-", isolate % 12),
+        }
+    )
+    return df
+
+
+def _groupby_time(df):
+    start = time.perf_counter()
+    df.groupby(ISOLATE_COLS, sort=True, observed=True).ngroup()
+    return time.perf_counter() - start
+
+
+def main(n_isolates=100_000):
+    compact = _apply_compact_dtypes(synthetic_long_format(n_isolates))
+    plain = to_object_dtypes(compact)
+    print(f"{len(plain)} rows ({n_isolates} isolates)")
+    for name, df in [("object", plain), ("compact", compact)]:
+        memory = df.memory_usage(deep=True).sum()
+        print(
+            f"{name:>8}: {memory / 2**20:8.1f} MiB, isolate groupby {_groupby_time(df):5.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,610 @@
+"""Check that the rewritten parts of the analysis give the same output as the implementations
+they replaced, on synthetic data:
+
+- classification: classify_isolates vs the groupby of check_resistance_and_validity (the
+  --legacy-resistance path)
+- dedup: the linear sweep of _find_duplicated (grouping by patient names or patient_key,
+  through _dedup_cache with patient histories too) vs the pairwise loops it replaced
+- workbook: the single pass of _report_writer vs DataFrame.to_excel of every detail sheet
+  and the second pass with openpyxl that added the overall sheets, links, widths and filters
+
+Exits with status 1 if any check finds a difference.
+
+Run from the repository root:
+    python -m benchmarks.equivalence [n_isolates]
+"""
+
+import itertools
+import os
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from benchmarks.output_formats import synthetic_detail
+from instructions import instructions, rate_instructions
+from utils.check_resistance import (
+    _SORVEGLIANZA_ATTIVA_MATERIALE,
+    check_resistance_and_validity,
+    classify_isolates,
+    resistance_rules,
+)
+from utils.duplicated_fns import (
+    _PATIENT_KEY,
+    _dedup_cache,
+    filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance,
+    filter_query_repeated_isolation_in_patients_lt_1_month_resistance_wise,
+)
+from utils.helper import _add_patient_key, _with_compact_dtypes, to_object_dtypes
+from utils.report_helper import (
+    _get_width,
+    _report_writer,
+    generate_date_reference_for_excel_output,
+    generate_resistenti_text_for_excel_output,
+)
+
+
+def _same_frame(a, b):
+    """None if a and b have the same columns and values (missing values compared as equal),
+    else a description of the first difference"""
+    if list(a.columns) != list(b.columns) or len(a) != len(b):
+        return f"columns {list(a.columns)} ({len(a)} rows) vs {list(b.columns)} ({len(b)} rows)"
+    for column in a.columns:
+        x = a[column].astype(object).to_numpy()
+        y = b[column].astype(object).to_numpy()
+        for i, (u, v) in enumerate(zip(x, y)):
+            if pd.isna(u) != pd.isna(v) or (not pd.isna(u) and u != v):
+                return f"column {column}, row {i}: {u!r} vs {v!r}"
+    return None
+
+
+def synthetic_observations(n_isolates, rng):
+    """One row per antibiotic of n_isolates isolates, with the values of an export after
+    _with_compact_dtypes: MIC strings with comparison signs and decimal commas around the
+    thresholds of resistance_rules.csv, "true"/"false" results, unparsable and missing values,
+    antibiotics without rules and gruppi without rules"""
+    thresholds = sorted(
+        {
+            condition.soglia
+            for program in resistance_rules.programs.values()
+            for level in program.base + program.indipendente + program.meccanismo
+            for condition in level.condizioni
+            if condition.soglia is not None
+        }
+    )
+    values = ["true", "false", "POS", "abc", None]
+    for threshold in thresholds:
+        for value in (threshold / 2, threshold, threshold * 2):
+            values += [f"{value:g}", f"<={value:g}", f">{value:g}", f"≥{value:g}"]
+            values.append(f"{value:g}".replace(".", ","))
+    antibiotics = list(resistance_rules.antibiotics) + ["AMK", "GEN"]
+    gruppi = list(resistance_rules.programs) + ["candal", "aspfum"]
+
+    n_rows = rng.integers(1, 12, n_isolates)
+    isolate = np.repeat(np.arange(n_isolates), n_rows)
+    n = len(isolate)
+    return _with_compact_dtypes(
+        pd.DataFrame(
+            {
+                "id_richiesta": (70_000_000 + isolate // 2).astype(str),
+                "id_microbo": np.array(["a", "b"], dtype=object)[isolate % 2],
+                "id_gruppo_microbo": rng.choice(gruppi, n_isolates)[isolate],
+                "id_materiale": rng.choice(
+                    [_SORVEGLIANZA_ATTIVA_MATERIALE, "URI", "SAN"], n_isolates
+                )[isolate],
+                "id_antibiotico": rng.choice(antibiotics, n),
+                "risultato_quantitativo": rng.choice(np.array(values, dtype=object), n),
+                # a few values per isolate, so that the mode has ties
+                "nome_reparto": rng.choice(["MEDICINA", "CHIRURGIA", None], n),
+                "id_ricovero": rng.choice(["R1", "R2", "R3"], n),
+            }
+        )
+    )
+
+
+def check_classification(n_isolates, rng):
+    df = synthetic_observations(n_isolates, rng)
+    group_cols = ["id_richiesta", "id_microbo"]
+    keep_cols = ["nome_reparto", "id_ricovero"]
+    with warnings.catch_warnings():
+        # groupby.apply on the grouping columns, as analyze does with --legacy-resistance
+        warnings.simplefilter("ignore", DeprecationWarning)
+        legacy = (
+            to_object_dtypes(df)
+            .groupby(group_cols, as_index=False)
+            .apply(check_resistance_and_validity, keep_cols=keep_cols)
+        )
+    return _same_frame(classify_isolates(df, group_cols, keep_cols), legacy)
+
+
+def _legacy_drop_duplicated_resistance_wise(df, days_cutoff=30, drop_column="to_drop"):
+    # _drop_duplicated_resistance_wise before the linear sweep
+    df = df.sort_values("data_prelievo")
+    # Prima di tutto eliminiamo i duplicati resistenti tenendo i primi in ordine cronologico
+    next_iteration = True
+    not_drop_df = df[df[drop_column].isnull()]
+    while next_iteration and not_drop_df.resistente.astype(bool).sum() > 0:
+        next_iteration = False
+        indexes, rows = list(
+            zip(*not_drop_df[not_drop_df.resistente.astype(bool)].iterrows())
+        )
+        for (previous_index, previous_row), (index, row) in itertools.pairwise(
+            zip(indexes, rows)
+        ):
+            if (row.data_prelievo - previous_row.data_prelievo).days < days_cutoff:
+                if row.n_resistenze > previous_row.n_resistenze:
+                    df.loc[previous_index, drop_column] = (
+                        f'Duplicato di id_richiesta: {row.id_richiesta} (data prelievo: {row.data_prelievo.strftime("%Y-%m-%d")}), che ha più resistenze'
+                    )
+                elif row.n_resistenze < previous_row.n_resistenze:
+                    df.loc[index, drop_column] = (
+                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), che aveva più resistenze'
+                    )
+                else:
+                    df.loc[index, drop_column] = (
+                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), entrambi con lo stesso numero di resistenze'
+                    )
+                next_iteration = True
+            not_drop_df = df[df[drop_column].isnull()]
+
+    # Ora eliminiamo tutti i duplicati tenendo i primi resistenti in ordine cronologico, se non ci sono resistenti teniamo i primi in ordine cronologico
+    next_iteration = True
+    while next_iteration:
+        next_iteration = False
+        indexes, rows = list(zip(*not_drop_df.iterrows()))
+        for (previous_index, previous_row), (index, row) in itertools.pairwise(
+            zip(indexes, rows)
+        ):
+            if (row.data_prelievo - previous_row.data_prelievo).days < days_cutoff:
+                if previous_row.resistente and row.resistente:
+                    raise ValueError(
+                        "There should not be two consecutive resistant rows"
+                    )
+                elif previous_row.resistente and not row.resistente:
+                    df.loc[index, drop_column] = (
+                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), che era resistente'
+                    )
+                elif not previous_row.resistente and row.resistente:
+                    df.loc[previous_index, drop_column] = (
+                        f'Duplicato di id_richiesta: {row.id_richiesta} (data prelievo: {row.data_prelievo.strftime("%Y-%m-%d")}), che è/sarà resistente'
+                    )
+                else:
+                    df.loc[index, drop_column] = (
+                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), entrambi non resistenti'
+                    )
+                next_iteration = True
+            not_drop_df = df[df[drop_column].isnull()]
+    return df
+
+
+def _legacy_drop_duplicated_no_resistance(df, days_cutoff=30, drop_column="to_drop"):
+    # _drop_duplicated_no_resistance before the linear sweep
+    df = df.sort_values("data_prelievo")
+    # eliminiamo tutti i duplicati tenendo i primi in ordine cronologico
+    next_iteration = True
+    not_drop_df = df[df[drop_column].isnull()]
+    while next_iteration:
+        next_iteration = False
+        indexes, rows = list(zip(*not_drop_df.iterrows()))
+        for (previous_index, previous_row), (index, row) in itertools.pairwise(
+            zip(indexes, rows)
+        ):
+            if (row.data_prelievo - previous_row.data_prelievo).days < days_cutoff:
+                df.loc[index, drop_column] = (
+                    f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")})'
+                )
+                next_iteration = True
+            not_drop_df = df[df[drop_column].isnull()]
+    return df
+
+
+def _legacy_drop_duplicated(df, drop_fn, days_cutoff=30, drop_column="to_drop"):
+    # filter_query_repeated_isolation_in_patients_lt_1_month_* before the linear sweep
+    df = df.copy()
+    df[drop_column] = pd.NA
+    group_cols = ["cognome_paziente", "nome_paziente", "data_nascita"]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        return (
+            df.groupby(group_cols, as_index=False)
+            .apply(drop_fn, days_cutoff=days_cutoff, drop_column=drop_column)
+            .reset_index(drop=True)
+        )
+
+
+def synthetic_isolates(n_isolates, rng):
+    """Isolates of n_isolates / 4 patients over 2 months, patients without names and every
+    combination of resistant and not resistant neighbours. A few patients have tens of
+    isolates in a few days: the old loops sorted the rows of a patient with quicksort, which
+    is not stable beyond 16 rows, and the ties on data_prelievo must keep its order."""
+    n_patients = max(n_isolates // 4, 1)
+    patient = rng.integers(0, n_patients, n_isolates)
+    days = rng.integers(0, 60, n_isolates)
+    n_long_stays = min(n_isolates // 100, n_patients)
+    patient[: n_long_stays * 40] = np.repeat(np.arange(n_long_stays), 40)
+    days[: n_long_stays * 40] = rng.integers(0, 5, n_long_stays * 40)
+    resistente = rng.choice(["", "", "ESBL", "MDR>KPC", "ESBL|MDR>VIM"], n_isolates)
+    df = pd.DataFrame(
+        {
+            "id_richiesta": (70_000_000 + np.arange(n_isolates)).astype(str),
+            "cognome_paziente": np.where(
+                patient % 50 == 49, None, (patient % 97).astype(str)
+            ),
+            "nome_paziente": (patient // 97).astype(str),
+            "data_nascita": "1950-01-01",
+            "data_prelievo": pd.Timestamp("2023-01-01")
+            + pd.to_timedelta(days, unit="D"),
+            "resistente": resistente,
+            "n_resistenze": np.where(
+                resistente == "", 0.0, np.char.count(resistente, "|") + 1.0
+            ),
+        }
+    )
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def check_dedup(n_isolates, rng):
+    df = synthetic_isolates(n_isolates, rng)
+    with_key = _add_patient_key(df.copy())
+    cache = _dedup_cache(patient_histories=True)
+    for days_cutoff in (1, 30):
+        for legacy_fn, fn, cached in (
+            (
+                _legacy_drop_duplicated_resistance_wise,
+                filter_query_repeated_isolation_in_patients_lt_1_month_resistance_wise,
+                _dedup_cache.resistance_wise,
+            ),
+            (
+                _legacy_drop_duplicated_no_resistance,
+                filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance,
+                _dedup_cache.no_resistance,
+            ),
+        ):
+            legacy = _legacy_drop_duplicated(df, legacy_fn, days_cutoff=days_cutoff)
+            results = {
+                "patient names": fn(df, days_cutoff=days_cutoff),
+                "patient_key": fn(with_key, days_cutoff=days_cutoff),
+                "_dedup_cache": cached(cache, with_key, days_cutoff=days_cutoff),
+            }
+            for name, result in results.items():
+                difference = _same_frame(
+                    result.drop(columns=_PATIENT_KEY, errors="ignore"), legacy
+                )
+                if difference:
+                    return f"{fn.__name__}, {name}, days_cutoff={days_cutoff}: {difference}"
+            # Another frame with the same patients is deduplicated from their histories
+            subset = with_key[with_key[_PATIENT_KEY] % 3 != 0]
+            difference = _same_frame(
+                cached(cache, subset, days_cutoff=days_cutoff),
+                fn(subset, days_cutoff=days_cutoff),
+            )
+            if difference:
+                return f"{fn.__name__}, patient histories, days_cutoff={days_cutoff}: {difference}"
+    return None
+
+
+def _legacy_intestation_row(ws, titles):
+    # add_overall_ws_intestation_row and add_overall_rates_ws_intestation_row before the
+    # write-only workbook
+    for column, title in enumerate(titles, 1):
+        ws.cell(1, column, title)
+    for cell in ws[1:1]:
+        cell.font = openpyxl.styles.Font(bold=True)
+        side = openpyxl.styles.Side(border_style="thin")
+        cell.border = openpyxl.styles.Border(
+            bottom=side, left=side, right=side, top=side
+        )
+        cell.alignment = openpyxl.styles.Alignment(horizontal="center")
+
+
+def _legacy_set_column_widths(wb):
+    for ws in wb._sheets:
+        sheet_name = ws.title
+        width_name = sheet_name
+        if sheet_name not in ("overall", "overall_rates"):
+            width_name = "_default"
+        for column in [c[0].column_letter for c in list(ws.columns)]:
+            wb[sheet_name].column_dimensions[column].width = _get_width(
+                column, sheet_name=width_name
+            )
+
+
+def _legacy_set_wb_filters(wb):
+    for ws in wb._sheets:
+        if ws.title in ("overall"):
+            if not len(ws["A"]):
+                continue
+            ws.auto_filter.ref = ws.dimensions
+        elif ws.title in ("overall_rates"):
+            if not len(ws["A"]) or not len(ws["K"]):
+                continue
+            left = ws["A"][0].coordinate
+            right = ws["J"][-1].coordinate
+            ws.auto_filter.ref = f"{left}:{right}"
+        else:
+            if not len(ws["A"]) or not len(ws["K"]):
+                continue
+            left = ws["A"][0].coordinate
+            right = ws["K"][-1].coordinate
+            ws.auto_filter.ref = f"{left}:{right}"
+
+
+def _legacy_write_report(
+    path,
+    overall_rows,
+    rate_rows,
+    year,
+    month,
+    days_of_hospitalization=None,
+    number_of_admissions_or_patients=None,
+):
+    # The excel output of analyze before _report_writer: the detail sheets with to_excel, then
+    # the workbook loaded again to add the overall sheets and the formatting
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        for sheet_name, *_, temp_df in overall_rows:
+            temp_df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+    wb = openpyxl.load_workbook(path)
+    sheetnames = list(wb.sheetnames)
+    overall_ws = wb.create_sheet("overall")
+    overall_rates_ws = wb.create_sheet("overall_rates")
+    _legacy_intestation_row(
+        overall_ws,
+        [
+            "Periodo di riferimento",
+            "Tag materiale",
+            "Matrice",
+            "ID gruppo microbo",
+            "Gruppo microbo",
+            "Dettaglio isolati",
+            "Totale isolati",
+            "Resistenti (%)",
+            "Dettaglio resistenze",
+        ],
+    )
+    _legacy_intestation_row(
+        overall_rates_ws,
+        [
+            "Periodo di riferimento",
+            "Tag materiale",
+            "Matrice",
+            "IDs gruppi microbi",
+            "Nome indicatore",
+            "Numeratore",
+            "Tasso per 10.000 gg",
+            "Tasso per 1.000 ricoveri o pazienti",
+            "Totale giornate di degenza",
+            "Totale ricoveri o pazienti",
+        ],
+    )
+    reference_date_format = openpyxl.styles.NamedStyle(
+        name="cd2", number_format="MMM-YY"
+    )
+
+    for i, (
+        sheet_name,
+        tag_materiale,
+        nome_tag_materiale,
+        id_gruppo_microbo,
+        nome_gruppo_microbo,
+        tot,
+        resistenti,
+        resistenti_text,
+        _,
+    ) in enumerate(overall_rows, start=2):
+        overall_ws.cell(i, 1, generate_date_reference_for_excel_output(year, month))
+        overall_ws.cell(i, 1).style = reference_date_format
+        overall_ws.cell(i, 2, tag_materiale)
+        overall_ws.cell(i, 3, nome_tag_materiale)
+        overall_ws.cell(i, 4, id_gruppo_microbo)
+        overall_ws.cell(i, 5, nome_gruppo_microbo)
+        overall_ws.cell(i, 6).hyperlink = f"#'{sheet_name}'!A1"
+        overall_ws.cell(i, 6).value = "vai al dettaglio"
+        overall_ws.cell(i, 6).style = "Hyperlink"
+        if tot is not None:
+            overall_ws.cell(i, 7, tot)
+            if resistenti is not None:
+                overall_ws.cell(
+                    i, 8, f"{resistenti} ({resistenti/tot:.0%})".replace(".", ",")
+                )
+                if resistenti:
+                    overall_ws.cell(i, 9, resistenti_text)
+                    overall_ws.cell(i, 9).alignment = openpyxl.styles.Alignment(
+                        wrap_text=True
+                    )
+        sheet = wb[sheet_name]
+        sheet["L1"].hyperlink = f"#'overall'!A{i}"
+        sheet["L1"].value = "torna all'indice"
+        sheet["L1"].style = "Hyperlink"
+
+    for i, (
+        tag_materiale,
+        nome_materiale,
+        id_gruppo_microbi,
+        nome,
+        numeratore,
+    ) in enumerate(rate_rows, start=2):
+        overall_rates_ws.cell(
+            i, 1, generate_date_reference_for_excel_output(year, month)
+        )
+        overall_rates_ws.cell(i, 1).style = reference_date_format
+        overall_rates_ws.cell(i, 2, tag_materiale)
+        overall_rates_ws.cell(i, 3, nome_materiale)
+        overall_rates_ws.cell(i, 4, id_gruppo_microbi)
+        overall_rates_ws.cell(i, 4).alignment = openpyxl.styles.Alignment(
+            wrap_text=True
+        )
+        overall_rates_ws.cell(i, 5, nome)
+        if days_of_hospitalization is not None:
+            overall_rates_ws.cell(i, 9, days_of_hospitalization)
+        if number_of_admissions_or_patients is not None:
+            overall_rates_ws.cell(i, 10, number_of_admissions_or_patients)
+        if numeratore is not None:
+            overall_rates_ws.cell(i, 6, numeratore)
+            if days_of_hospitalization is not None:
+                overall_rates_ws.cell(i, 7, f"=F{i}/I{i}*10000")
+                overall_rates_ws.cell(i, 7).number_format = "0.00"
+            if number_of_admissions_or_patients is not None:
+                overall_rates_ws.cell(i, 8, f"=F{i}/J{i}*1000")
+                overall_rates_ws.cell(i, 8).number_format = "0.00"
+    overall_rates_ws["L1"].hyperlink = "#'overall'!A1"
+    overall_rates_ws["L1"].value = "torna all'indice"
+    overall_rates_ws["L1"].style = "Hyperlink"
+
+    for ws in wb._sheets:
+        if ws.title not in ("overall", "overall_rates"):
+            for cell in ws["K"]:
+                cell.alignment = openpyxl.styles.Alignment(wrap_text=True)
+    _legacy_set_column_widths(wb)
+    _legacy_set_wb_filters(wb)
+    wb._sheets = [
+        wb[sheetname] for sheetname in ["overall", "overall_rates"] + sheetnames
+    ]
+    wb.save(path)
+
+
+def _same_workbook(a, b):
+    """None if the workbooks at a and b have the same sheets, cell values, styles,
+    hyperlinks, column widths and filters, else a description of the first difference"""
+    wa, wb = openpyxl.load_workbook(a), openpyxl.load_workbook(b)
+    if wa.sheetnames != wb.sheetnames:
+        return f"sheets {wa.sheetnames} vs {wb.sheetnames}"
+
+    def cell(c):
+        return (
+            c.value,
+            c.number_format,
+            c.style,
+            c.font.b,
+            c.alignment.horizontal,
+            c.alignment.vertical,
+            c.alignment.wrap_text,
+            c.border.left and c.border.left.style,
+            c.hyperlink and (c.hyperlink.location, c.hyperlink.target),
+        )
+
+    for name in wa.sheetnames:
+        sa, sb = wa[name], wb[name]
+        if sa.dimensions != sb.dimensions:
+            return f"{name}: cells {sa.dimensions} vs {sb.dimensions}"
+        for ca, cb in zip(
+            itertools.chain(*sa.iter_rows()), itertools.chain(*sb.iter_rows())
+        ):
+            if cell(ca) != cell(cb):
+                return f"{name}!{ca.coordinate}: {cell(ca)} vs {cell(cb)}"
+        widths = [
+            {k: v.width for k, v in s.column_dimensions.items()} for s in (sa, sb)
+        ]
+        if widths[0] != widths[1]:
+            return f"{name}: widths {widths[0]} vs {widths[1]}"
+        if sa.auto_filter.ref != sb.auto_filter.ref:
+            return f"{name}: filter {sa.auto_filter.ref} vs {sb.auto_filter.ref}"
+    return None
+
+
+def synthetic_report(n_isolates, rng):
+    """(overall rows, rate rows) of a report as analyze computes them: a detail frame per
+    instruction, without the resistances for half of them, some empty and a sheet name used
+    by two instructions"""
+    overall_rows = []
+    for i, instruction in enumerate(instructions + instructions[:1]):
+        df = synthetic_detail(
+            instruction, int(rng.integers(0, n_isolates // 50 + 1)), rng
+        )
+        if i % 2:
+            df = df.drop(columns=["resistente", "n_resistenze"])
+        valid_df = df[df.to_drop.isnull()]
+        resistenti = (
+            valid_df.resistente.astype(bool).sum()
+            if "resistente" in df.columns and not valid_df.resistente.dropna().empty
+            else None
+        )
+        overall_rows.append(
+            (
+                f"{instruction.tag}-{instruction.gruppo_microbo_id}",
+                instruction.tag,
+                instruction.descrizione,
+                instruction.gruppo_microbo_id,
+                instruction.descrizione_gruppo_microbo,
+                len(valid_df),
+                resistenti,
+                (
+                    generate_resistenti_text_for_excel_output(valid_df)
+                    if resistenti
+                    else None
+                ),
+                df,
+            )
+        )
+    rate_rows = [
+        (
+            instruction.tag,
+            instruction.descrizione,
+            str(instruction.id_gruppo_microbi),
+            instruction.descrizione_gruppo_microbi,
+            int(rng.integers(0, 10)),
+        )
+        for instruction in rate_instructions
+    ]
+    return overall_rows, rate_rows
+
+
+def check_workbook(n_isolates, rng):
+    overall_rows, rate_rows = synthetic_report(n_isolates, rng)
+    with tempfile.TemporaryDirectory() as folder:
+        for year, month, days, admissions in (
+            (2023, 3, None, None),
+            (2023, None, 1234, 321),
+        ):
+            legacy_path = os.path.join(folder, "legacy.xlsx")
+            _legacy_write_report(
+                legacy_path, overall_rows, rate_rows, year, month, days, admissions
+            )
+            path = os.path.join(folder, "report.xlsx")
+            report = _report_writer(path, [row[0] for row in overall_rows], year, month)
+            for sheet_name, *row, df in overall_rows:
+                overall_row = report.add_overall_row(
+                    sheet_name,
+                    *row[:4],
+                    tot=row[4],
+                    resistenti=row[5],
+                    resistenti_text=row[6],
+                )
+                report.add_detail(sheet_name, df, overall_row)
+            for *row, numeratore in rate_rows:
+                report.add_overall_rates_row(
+                    *row,
+                    numeratore=numeratore,
+                    days_of_hospitalization=days,
+                    number_of_admissions_or_patients=admissions,
+                )
+            report.save()
+            difference = _same_workbook(path, legacy_path)
+            if difference:
+                return f"{year}-{month}: {difference}"
+    return None
+
+
+CHECKS = {
+    "classification": check_classification,
+    "dedup": check_dedup,
+    "workbook": check_workbook,
+}
+
+
+def main(n_isolates=3_000):
+    failed = False
+    for name, check in CHECKS.items():
+        difference = check(n_isolates, np.random.default_rng(0))
+        print(
+            f"  {name + ':':16s} {'DIFFERENT, ' + difference if difference else 'OK'}"
+        )
+        failed |= difference is not None
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
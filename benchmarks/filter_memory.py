@@ -0,0 +1,104 @@
+"""Peak memory and time of filter_df_for_count over all the instructions, whole-frame
+copy (previous implementation) vs precomputed gruppo microbo indices.
+
+Run from the repository root:
+    python -m benchmarks.filter_memory [n_rows]
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from instructions import instructions
+from utils.helper import filter_df_for_count, gruppo_microbo_indices, has_tag
+
+
+def _copying_filter_df_for_count(
+    df, year, month=None, id_gruppo_microbo=None, tag=None, **kwargs
+):
+    # filter_df_for_count before the group indices
+    temp_df = df.copy()
+    if id_gruppo_microbo:
+        temp_df = temp_df[
+            temp_df.id_gruppo_microbo.str.lower() == id_gruppo_microbo.lower()
+        ]
+    if tag and temp_df.shape[0]:
+        temp_df = temp_df[has_tag(temp_df, tag)]
+    temp_df = temp_df[(temp_df.data_prelievo.dt.year == year)]
+    if month:
+        temp_df = temp_df[(temp_df.data_prelievo.dt.month == month)]
+    cols = temp_df.columns.tolist()
+    temp_df["tag"] = tag
+    temp_df["id_richiesta"] = temp_df["id_richiesta"].astype(int)
+    tags_col_index = cols.index("tags")
+    cols = cols[:tags_col_index] + ["tag"] + cols[tags_col_index:]
+    return temp_df[cols].copy()
+
+
+def synthetic_isolates(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    gruppi = sorted({i.gruppo_microbo_id for i in instructions}) + ["altro"]
+    tags = ["sorv_pass", "sorv_pass|sangue", "sorv_pass|urine", "sorv_att", ""]
+    return pd.DataFrame(
+        {
+            "id_richiesta": (70000000 + np.arange(n_rows)).astype(str),
+            "cognome_paziente": rng.choice(["ROSSI", "BIANCHI", "VERDI"], n_rows),
+            "nome_paziente": rng.choice(["MARIO", "ANNA", "LUCA"], n_rows),
+            "data_nascita": pd.Timestamp("1950-01-01")
+            + pd.to_timedelta(rng.integers(0, 20000, n_rows), unit="D"),
+            "tags": rng.choice(tags, n_rows),
+            "data_prelievo": pd.Timestamp("2022-11-01")
+            + pd.to_timedelta(rng.integers(0, 480 * 24, n_rows), unit="h"),
+            "id_gruppo_microbo": rng.choice(gruppi, n_rows),
+            "nome_gruppo_microbo": "NOME",
+            "nome_reparto": rng.choice(["MEDICINA", "CHIRURGIA"], n_rows),
+            "id_ricovero": "R1",
+            "resistente": rng.choice(["", "ESBL", "MDR>KPC"], n_rows),
+        }
+    )
+
+
+def _measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(n_rows=200_000):
+    df = synthetic_isolates(n_rows)
+
+    def copying():
+        for instruction in instructions:
+            _copying_filter_df_for_count(
+                df,
+                year=2023,
+                id_gruppo_microbo=instruction.gruppo_microbo_id,
+                tag=instruction.tag,
+            )
+
+    def indexed():
+        group_indices = gruppo_microbo_indices(df)
+        for instruction in instructions:
+            filter_df_for_count(
+                df,
+                year=2023,
+                id_gruppo_microbo=instruction.gruppo_microbo_id,
+                tag=instruction.tag,
+                group_indices=group_indices,
+            )
+
+    print(f"{n_rows} isolates, {len(instructions)} instructions")
+    for name, fn in [("copy", copying), ("group indices", indexed)]:
+        elapsed, peak = _measure(fn)
+        print(f"{name:>14}: {elapsed:6.2f} s, peak {peak / 2**20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,110 @@
+"""Time of writing the report of all the instructions as the excel workbook (_report_writer)
+vs the overall, overall_rates and details tables of _columnar_writer in each columnar format,
+i.e. the time saved by --output-format without xlsx.
+
+Run from the repository root:
+    python -m benchmarks.output_formats [n_rows_per_instruction]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from instructions import instructions, rate_instructions
+from utils.report_helper import (
+    COLUMNAR_OUTPUT_FORMATS,
+    _columnar_writer,
+    _report_writer,
+)
+
+
+def synthetic_detail(instruction, n_rows, rng):
+    """A detail frame of the instruction as analyze passes it to the report"""
+    resistente = rng.choice(["", "ESBL", "MDR>KPC", "ESBL|MDR>VIM", None], n_rows)
+    return pd.DataFrame(
+        {
+            "id_richiesta": 70_000_000 + rng.integers(0, 1_000_000, n_rows),
+            "tag": instruction.tag,
+            "tags": rng.choice(
+                ["sorv_pass", "sorv_pass|urine", "sorv_pass|sangue"], n_rows
+            ),
+            "data_prelievo": (
+                pd.Timestamp("2023-03-01")
+                + pd.to_timedelta(rng.integers(0, 31, n_rows), unit="D")
+            ).date,
+            "nome_reparto": rng.choice(["MEDICINA", "CHIRURGIA"], n_rows),
+            "id_gruppo_microbo": instruction.gruppo_microbo_id,
+            "nome_gruppo_microbo": instruction.descrizione_gruppo_microbo,
+            "id_microbo": "micro",
+            "nome_microbo": "Microbo",
+            "resistente": resistente,
+            "n_resistenze": pd.Series(resistente).str.count(r"\|") + 1.0,
+            "to_drop": rng.choice(
+                [None, "Duplicato di id_richiesta: 70000000"], n_rows
+            ),
+        }
+    )
+
+
+def write_report(report, details):
+    for instruction, df in details:
+        sheet_name = f"{instruction.tag}-{instruction.gruppo_microbo_id}"
+        overall_row = report.add_overall_row(
+            sheet_name,
+            instruction.tag,
+            instruction.descrizione,
+            instruction.gruppo_microbo_id,
+            instruction.descrizione_gruppo_microbo,
+            tot=len(df),
+            resistenti=df.resistente.astype(bool).sum(),
+            resistenti_text="ESBL: 1\nMDR: 1",
+        )
+        report.add_detail(sheet_name, df, overall_row)
+    for instruction in rate_instructions:
+        report.add_overall_rates_row(
+            instruction.tag,
+            instruction.descrizione,
+            str(instruction.id_gruppo_microbi),
+            instruction.descrizione_gruppo_microbi,
+            numeratore=3,
+            days_of_hospitalization=1234,
+            number_of_admissions_or_patients=321,
+        )
+    report.save()
+
+
+def main(n_rows=200):
+    rng = np.random.default_rng(0)
+    details = [(i, synthetic_detail(i, n_rows, rng)) for i in instructions]
+    print(f"{len(details)} instructions, {len(details) * n_rows} detail rows")
+
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        write_report(
+            _report_writer(
+                os.path.join(folder, "report.xlsx"),
+                [f"{i.tag}-{i.gruppo_microbo_id}" for i, _ in details],
+                2023,
+                3,
+            ),
+            details,
+        )
+        print(f"  xlsx:    {time.perf_counter() - start:6.2f} s")
+        for output_format in COLUMNAR_OUTPUT_FORMATS:
+            paths = {
+                table: os.path.join(folder, f"{table}.{output_format}")
+                for table in ("overall", "overall_rates", "details")
+            }
+            start = time.perf_counter()
+            write_report(
+                _columnar_writer({output_format: paths}, 2023, 3, "to_drop"), details
+            )
+            print(f"  {output_format + ':':8s} {time.perf_counter() - start:6.2f} s")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
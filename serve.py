@@ -0,0 +1,95 @@
+import argparse
+import sys
+
+
+from utils.serve import serve
+
+from analyze import DEFAULT_DEFAULT_DAYS_CUTOFF, DEFAULT_TO_DROP_COLUMN
+from instructions import instructions, rate_instructions
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WATCH_INTERVAL = 5
+
+_description_lines = [
+    "Servizio che tiene in memoria i dati caricati e classificati e risponde alle richieste di report su una porta locale o su un socket Unix, senza ricaricare i dati ad ogni richiesta.",
+    "I file della cartella data vengono controllati periodicamente e vengono ricaricati solo i mesi modificati. Per applicare modifiche a instructions.py, alle regole o al programma è necessario riavviare il servizio.",
+]
+
+
+def main():
+    args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="\n".join(_description_lines),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=DEFAULT_HOST,
+        help="L'indirizzo su cui rispondere alle richieste.",
+    )
+    parser.add_argument(
+        "--port",
+        "-p",
+        type=int,
+        default=DEFAULT_PORT,
+        help="La porta su cui rispondere alle richieste.",
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Il percorso del socket Unix su cui rispondere alle richieste, se specificato --host e --port vengono ignorati. Un socket rimasto da un'esecuzione precedente viene sostituito, un altro file già presente fa terminare il servizio con un errore.",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=DEFAULT_WATCH_INTERVAL,
+        help="Ogni quanti secondi controllare se i file della cartella data sono cambiati.",
+    )
+    parser.add_argument(
+        "--drop-column",
+        type=str,
+        default=DEFAULT_TO_DROP_COLUMN,
+        help="La colonna del file excel in cui scrivere i motivi per cui un isolato è stato scartato (se vuota significa che l'osservazione è valida ai fini del conteggio).",
+    )
+    parser.add_argument(
+        "--default-days-cutoff",
+        type=int,
+        default=DEFAULT_DEFAULT_DAYS_CUTOFF,
+        help="Il numero di giorni da considerare per il calcolo dei duplicati, se non specificato nel file instructions.py.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="Il numero di processi (o thread) con cui parallelizzare l'elaborazione, se non specificato vengono usati tutti i processori disponibili.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["serial", "threads", "processes"],
+        default="processes",
+        help="Come parallelizzare l'elaborazione: in serie, con più thread o con più processi. Le elaborazioni piccole vengono comunque eseguite in serie.",
+    )
+    config = vars(parser.parse_args(args))
+
+    serve(
+        instructions,
+        rate_instructions,
+        host=config.get("host"),
+        port=config.get("port"),
+        socket_path=config.get("socket"),
+        watch_interval=config.get("watch_interval"),
+        drop_column=config.get("drop_column"),
+        default_days_cutoff=config.get("default_days_cutoff"),
+        workers=config.get("workers"),
+        backend=config.get("backend"),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
-from .analyze import analyze
+from .analyze import analyze, analyze_all_periods, analyze_isolates
 from .helper import check_parameters
+from .serve import serve
@@ -1,33 +1,67 @@
-import openpyxl
+from dataclasses import dataclass
+from typing import List, Optional, Union
 import pandas as pd
-from pandarallel import pandarallel
+import pyarrow as pa
 from .check_resistance import (
     check_resistance_and_validity,
+    load_isolates,
     get_resistance_or_not_instructions,
+    _year_isolates,
 )
-from .duplicated_fns import (
-    filter_query_repeated_isolation_in_patients_lt_1_month_resistance_wise,
-    filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance,
-)
+from .duplicated_fns import _PATIENT_COLS, _PATIENT_KEY, _dedup_cache
+from .executor import _executor
 from .helper import (
     load_data,
     check_total_df,
     generate_excel_output_filename,
+    generate_columnar_output_filenames,
     filter_df_for_count,
+    gruppo_microbo_indices,
+    to_object_dtypes,
+    encode_tags,
+    has_tag,
+    _select_for_count,
+    _check_cached_report,
+    _report_key,
+    _update_cached_report,
+    _load_window,
+    _process_files,
+    _window_partitions,
+    _add_patient_key,
 )
 from .report_helper import (
-    add_overall_rates_ws_intestation_row,
-    add_overall_ws_intestation_row,
-    generate_date_reference_for_excel_output,
+    COLUMNAR_OUTPUT_FORMATS,
+    _columnar_writer,
+    _report_frames,
+    _report_writer,
     generate_resistenti_text_for_excel_output,
-    set_column_widths,
-    set_wb_filters,
     simplify_resistances,
 )
 
-from .instructions import autogenerate
+from .instructions import _instruction, autogenerate
+
+# The legacy resistances are computed in parallel only if each worker gets at least this many isolates
+_MIN_GROUPS_PER_WORKER = 1_000
 
-pandarallel.initialize(progress_bar=False, verbose=1)
+# This df contains for each row the resistances of the microorganism isolated in that request. (One row = one microorganism)
+# Patients are identified by patient_key, the names are not loaded at all
+_ISOLATE_COLS = [
+    "id_richiesta",
+    "patient_key",
+    "tags",
+    "data_prelievo",
+    "id_gruppo_microbo",
+]
+_KEEP_COLS = [
+    "nome_gruppo_microbo",
+    "id_microbo",
+    "nome_microbo",
+    "id_reparto",
+    "nome_reparto",
+    "id_ricovero",
+    "data_ricovero",
+    "data_dimissione",
+]
 
 
 def analyze(
@@ -40,37 +74,137 @@ def analyze(
     rate_instructions=list(),
     days_of_hospitalization=None,
     number_of_admissions_or_patients=None,
+    legacy_resistance=False,
+    dedup_cache=None,
+    workers=None,
+    backend="processes",
+    year_isolates=None,
+    output_formats=("xlsx",),
 ):
-    total_df = load_data(year=year, month=month)
-    check_total_df(total_df)
+    if not output_formats:
+        raise ValueError("Specificare almeno un formato di output")
+    unknown_formats = set(output_formats) - {"xlsx", *COLUMNAR_OUTPUT_FORMATS}
+    if unknown_formats:
+        raise ValueError(
+            f"Formati di output non supportati: {', '.join(sorted(unknown_formats))}"
+        )
+    excel_output_filepath = generate_excel_output_filename(
+        excel_output_folder_name, year, month
+    )
+    # The tables of the columnar formats are written in a folder named as the excel file
+    columnar_output_filepaths = {
+        output_format: generate_columnar_output_filenames(
+            excel_output_folder_name, year, month, output_format
+        )
+        for output_format in output_formats
+        if output_format != "xlsx"
+    }
+    output_filepaths = [excel_output_filepath] if "xlsx" in output_formats else []
+    output_filepaths += [
+        path for paths in columnar_output_filepaths.values() for path in paths.values()
+    ]
+    # The report is written again only if the data, the instructions, the options or the code changed
+    report_key = _report_key(
+        year,
+        month,
+        instructions,
+        rate_instructions,
+        drop_column=drop_column,
+        default_days_cutoff=default_days_cutoff,
+        days_of_hospitalization=days_of_hospitalization,
+        number_of_admissions_or_patients=number_of_admissions_or_patients,
+        legacy_resistance=legacy_resistance,
+    )
+    if all(_check_cached_report(path, report_key) for path in output_filepaths):
+        print(f"Report {', '.join(output_filepaths)} is up to date, nothing to do")
+        return
 
-    resistance_instructions = get_resistance_or_not_instructions()
+    # Same (tag, gruppo microbo, cutoff) subsets are deduplicated once, also across instructions and rate_instructions
+    dedup_cache = dedup_cache if dedup_cache is not None else _dedup_cache()
+
+    if legacy_resistance:
+        total_df = load_data(
+            year=year,
+            month=month,
+            workers=workers,
+            backend=backend,
+            # Only the columns needed for the resistances and the checks are read from the cache
+            columns=_ISOLATE_COLS
+            + _KEEP_COLS
+            + [
+                "id_esame",
+                "id_materiale",
+                "id_antibiotico",
+                "risultato_quantitativo",
+                "esbl",
+            ],
+        )
+        check_total_df(total_df)
+        df = _executor(backend, workers).groupby_apply(
+            to_object_dtypes(total_df),
+            _ISOLATE_COLS,
+            check_resistance_and_validity,
+            min_groups=_MIN_GROUPS_PER_WORKER,
+            keep_cols=_KEEP_COLS,
+        )
+    elif year_isolates is not None:
+        # The partitions of the whole year were already classified and read by analyze_all_periods
+        df = year_isolates.load(month, group_cols=_ISOLATE_COLS, keep_cols=_KEEP_COLS)
+    else:
+        # Only the months that are new or changed are classified, the others are read from the cache
+        df = load_isolates(
+            year=year,
+            month=month,
+            group_cols=_ISOLATE_COLS,
+            keep_cols=_KEEP_COLS,
+            workers=workers,
+            backend=backend,
+        )
+    df = _prepare_isolates(df)
+    _instructions = _all_instructions(df, year, month, instructions)
 
-    # This df contains for each row the resistances of the microorganism isolated in that request. (One row = one microorganism)
-    df = total_df.groupby(
-        [
-            "id_richiesta",
-            "cognome_paziente",
-            "nome_paziente",
-            "data_nascita",
-            "tags",
-            "data_prelievo",
-            "id_gruppo_microbo",
-        ],
-        as_index=False,
-    ).parallel_apply(
-        check_resistance_and_validity,
-        keep_cols=[
-            "nome_gruppo_microbo",
-            "id_microbo",
-            "nome_microbo",
-            "id_reparto",
-            "nome_reparto",
-            "id_ricovero",
-            "data_ricovero",
-            "data_dimissione",
-        ],
+    # Do the actual analysis and write it to excel, the sheets are written as they are computed
+    reports = []
+    if "xlsx" in output_formats:
+        reports.append(
+            _report_writer(
+                excel_output_filepath,
+                [f"{i.tag}-{i.gruppo_microbo_id}" for i in _instructions],
+                year,
+                month,
+            )
+        )
+    if columnar_output_filepaths:
+        reports.append(
+            _columnar_writer(columnar_output_filepaths, year, month, drop_column)
+        )
+    _compute_report(
+        df,
+        year,
+        month,
+        _instructions,
+        rate_instructions,
+        reports,
+        drop_column=drop_column,
+        default_days_cutoff=default_days_cutoff,
+        days_of_hospitalization=days_of_hospitalization,
+        number_of_admissions_or_patients=number_of_admissions_or_patients,
+        dedup_cache=dedup_cache,
+        workers=workers,
+        backend=backend,
     )
+    for report in reports:
+        report.save()
+    for path in output_filepaths:
+        _update_cached_report(path, report_key)
+    print(f"Dedup cache: {dedup_cache.hits} hits, {dedup_cache.misses} misses")
+
+
+def _prepare_isolates(df):
+    """Add to the isolates the columns the instructions are computed on: tags_mask and
+    n_resistenze"""
+    # Tags are encoded once, filters test a bit of tags_mask instead of splitting the tags string
+    df["tags_mask"] = encode_tags(df.tags)
     # fmt: off
     df["n_resistenze"] = (
         df.resistente.replace("", pd.NA)
@@ -87,20 +221,14 @@ def analyze(
         .map(lambda ress: any(["MDR" in res for res in ress]), na_action="ignore").replace(True, 0.1)  # Add a little bit of priority to MDR (.1)
     )
     # fmt: on
-    # not_null_resistente_df contains only the rows with verfied resistance (if the antibiogram wasn't executed, the row is dropped)
-    not_null_resistente_df = df.dropna(subset=["resistente"]).copy()
-
-    excel_output_filepath = generate_excel_output_filename(
-        excel_output_folder_name, year, month
-    )
+    return df
 
-    # Do the actual analysis and write it to excel
-    # data is an array of tuples (tag_materiale, nome_tag_materiale, id_gruppo_microbo, nome_gruppo_microbo, temp_df)
-    data = []
-    rates_data_no_mac_no_ps = []
 
+def _all_instructions(df, year, month, instructions):
+    """instructions followed by those of sorveglianza attiva, autogenerated for all the
+    gruppi microbi isolated in the period"""
     ## Add sorveglianza attiva to instructions for all available microorganisms
-    autogeneration_mask = df.tags.str.split("|").apply(lambda tags: "sorv_att" in tags)
+    autogeneration_mask = has_tag(df, "sorv_att")
     autogeneration_mask &= df.data_prelievo.dt.year == year
     if month is not None:
         autogeneration_mask &= df.data_prelievo.dt.month == month
@@ -109,104 +237,37 @@ def analyze(
     _instructions += autogenerate(
         df[autogeneration_mask], "sorv_att", "Sorveglianza attiva"
     )
+    return _instructions
 
-    with pd.ExcelWriter(excel_output_filepath, engine="openpyxl") as writer:
-        for instruction in _instructions:
-            tag_materiale = instruction.tag
-            nome_materiale = instruction.descrizione
-            id_gruppo_microbo = instruction.gruppo_microbo_id
-            nome_gruppo_microbo = instruction.descrizione_gruppo_microbo
-            cutoff_repeat_days = instruction.cutoff_repeat_days
-            resistenze_gruppo_microbo = resistance_instructions.get(
-                id_gruppo_microbo, False
-            )
-            if resistenze_gruppo_microbo:
-                temp_df = filter_df_for_count(
-                    not_null_resistente_df,
-                    year=year,
-                    month=month,
-                    resistances=None,
-                    id_gruppo_microbo=id_gruppo_microbo,
-                    tag=tag_materiale,
-                    custom_filter_fn=filter_query_repeated_isolation_in_patients_lt_1_month_resistance_wise,
-                    custom_filter_fn_kwargs=dict(
-                        drop_column=drop_column,
-                        days_cutoff=(
-                            cutoff_repeat_days
-                            if cutoff_repeat_days is not None
-                            else default_days_cutoff
-                        ),
-                    ),
-                )
-                temp_df = temp_df.reindex(
-                    columns=[
-                        "id_richiesta",
-                        "tag",
-                        "tags",
-                        "data_prelievo",
-                        "nome_reparto",
-                        "id_gruppo_microbo",
-                        "nome_gruppo_microbo",
-                        "id_microbo",
-                        "nome_microbo",
-                        "resistente",
-                        "n_resistenze",
-                        drop_column,
-                    ]
-                )
-            else:
-                temp_df = filter_df_for_count(
-                    df,
-                    year=year,
-                    month=month,
-                    id_gruppo_microbo=id_gruppo_microbo,
-                    tag=tag_materiale,
-                    custom_filter_fn=filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance,
-                    custom_filter_fn_kwargs=dict(
-                        drop_column=drop_column,
-                        days_cutoff=(
-                            cutoff_repeat_days
-                            if cutoff_repeat_days is not None
-                            else default_days_cutoff
-                        ),
-                    ),
-                )
-                temp_df = temp_df.reindex(
-                    columns=[
-                        "id_richiesta",
-                        "tag",
-                        "tags",
-                        "data_prelievo",
-                        "nome_reparto",
-                        "id_gruppo_microbo",
-                        "nome_gruppo_microbo",
-                        "id_microbo",
-                        "nome_microbo",
-                        drop_column,
-                    ]
-                )
 
-            # convert datetime to date
-            if "data_prelievo" in temp_df.columns:
-                temp_df["data_prelievo"] = temp_df.data_prelievo.dt.date
-            if "data_ricovero" in temp_df.columns:
-                temp_df["data_ricovero"] = temp_df.data_ricovero.dt.date
-            if "data_dimissione" in temp_df.columns:
-                temp_df["data_dimissione"] = temp_df.data_dimissione.dt.date
-            sheet_name = f"{tag_materiale}-{id_gruppo_microbo}"
-            data.append(
-                (
-                    tag_materiale,
-                    nome_materiale,
-                    id_gruppo_microbo,
-                    nome_gruppo_microbo,
-                    temp_df,
-                )
-            )
-            temp_df.to_excel(writer, sheet_name=sheet_name, index=False)
+def _compute_report(
+    df,
+    year,
+    month,
+    instructions,
+    rate_instructions,
+    reports,
+    drop_column,
+    default_days_cutoff,
+    days_of_hospitalization,
+    number_of_admissions_or_patients,
+    dedup_cache,
+    workers,
+    backend,
+):
+    """Compute the report of the prepared isolates df, with instructions already including the
+    autogenerated ones, and add its rows to each of reports (_report_writer, _columnar_writer
+    or _report_frames) without saving them"""
+    resistance_instructions = get_resistance_or_not_instructions()
+
+    # not_null_resistente_df contains only the rows with verfied resistance (if the antibiogram wasn't executed, the row is dropped)
+    not_null_resistente_df = df.dropna(subset=["resistente"]).copy()
+    # Row positions of each gruppo microbo, so that each instruction only takes its own rows
+    df_indices = gruppo_microbo_indices(df)
+    not_null_resistente_df_indices = gruppo_microbo_indices(not_null_resistente_df)
 
     # No mac no ps for rates
-    df = df[
+    rates_df = df[
         (~df.nome_reparto.str.contains("mac", regex=False, case=False, na=False))
         & (
             ~df.nome_reparto.str.contains(
@@ -215,7 +276,158 @@ def analyze(
         )
         & (~df.id_ricovero.str.startswith("PS", na=False))
     ]
-    df["resistente"] = df.resistente.fillna("")
+    rates_df["resistente"] = rates_df.resistente.fillna("")
+    rates_df_indices = gruppo_microbo_indices(rates_df)
+
+    # The rows of every instruction and rate instruction are deduplicated at once, with the
+    # patients split in shards processed in parallel. The loops below find them in dedup_cache.
+    dedup_requests = []
+    for tag_materiale, id_gruppo_microbo, cutoff_repeat_days, rates in [
+        (i.tag, i.gruppo_microbo_id, i.cutoff_repeat_days, False) for i in instructions
+    ] + [
+        (i.tag, id_gruppo_microbo, i.cutoff_repeat_days, True)
+        for i in rate_instructions
+        for id_gruppo_microbo in (
+            i.id_gruppo_microbi
+            if not isinstance(i.id_gruppo_microbi, str)
+            else [i.id_gruppo_microbi]
+        )
+    ]:
+        resistance_wise = resistance_instructions.get(id_gruppo_microbo, False)
+        if rates:
+            frame, indices = rates_df, rates_df_indices
+        elif resistance_wise:
+            frame, indices = not_null_resistente_df, not_null_resistente_df_indices
+        else:
+            frame, indices = df, df_indices
+        dedup_requests.append(
+            (
+                _select_for_count(
+                    frame,
+                    id_gruppo_microbo=id_gruppo_microbo,
+                    tag=tag_materiale,
+                    group_indices=indices,
+                ),
+                (
+                    cutoff_repeat_days
+                    if cutoff_repeat_days is not None
+                    else default_days_cutoff
+                ),
+                resistance_wise,
+            )
+        )
+    dedup_cache.prefetch(dedup_requests, _executor(backend, workers))
+
+    for instruction in instructions:
+        tag_materiale = instruction.tag
+        nome_materiale = instruction.descrizione
+        id_gruppo_microbo = instruction.gruppo_microbo_id
+        nome_gruppo_microbo = instruction.descrizione_gruppo_microbo
+        cutoff_repeat_days = instruction.cutoff_repeat_days
+        resistenze_gruppo_microbo = resistance_instructions.get(
+            id_gruppo_microbo, False
+        )
+        if resistenze_gruppo_microbo:
+            temp_df = filter_df_for_count(
+                not_null_resistente_df,
+                year=year,
+                month=month,
+                resistances=None,
+                id_gruppo_microbo=id_gruppo_microbo,
+                tag=tag_materiale,
+                custom_filter_fn=dedup_cache.resistance_wise,
+                custom_filter_fn_kwargs=dict(
+                    drop_column=drop_column,
+                    days_cutoff=(
+                        cutoff_repeat_days
+                        if cutoff_repeat_days is not None
+                        else default_days_cutoff
+                    ),
+                ),
+                group_indices=not_null_resistente_df_indices,
+            )
+            temp_df = temp_df.reindex(
+                columns=[
+                    "id_richiesta",
+                    "tag",
+                    "tags",
+                    "data_prelievo",
+                    "nome_reparto",
+                    "id_gruppo_microbo",
+                    "nome_gruppo_microbo",
+                    "id_microbo",
+                    "nome_microbo",
+                    "resistente",
+                    "n_resistenze",
+                    drop_column,
+                ]
+            )
+        else:
+            temp_df = filter_df_for_count(
+                df,
+                year=year,
+                month=month,
+                id_gruppo_microbo=id_gruppo_microbo,
+                tag=tag_materiale,
+                custom_filter_fn=dedup_cache.no_resistance,
+                custom_filter_fn_kwargs=dict(
+                    drop_column=drop_column,
+                    days_cutoff=(
+                        cutoff_repeat_days
+                        if cutoff_repeat_days is not None
+                        else default_days_cutoff
+                    ),
+                ),
+                group_indices=df_indices,
+            )
+            temp_df = temp_df.reindex(
+                columns=[
+                    "id_richiesta",
+                    "tag",
+                    "tags",
+                    "data_prelievo",
+                    "nome_reparto",
+                    "id_gruppo_microbo",
+                    "nome_gruppo_microbo",
+                    "id_microbo",
+                    "nome_microbo",
+                    drop_column,
+                ]
+            )
+
+        # convert datetime to date
+        if "data_prelievo" in temp_df.columns:
+            temp_df["data_prelievo"] = temp_df.data_prelievo.dt.date
+        if "data_ricovero" in temp_df.columns:
+            temp_df["data_ricovero"] = temp_df.data_ricovero.dt.date
+        if "data_dimissione" in temp_df.columns:
+            temp_df["data_dimissione"] = temp_df.data_dimissione.dt.date
+        sheet_name = f"{tag_materiale}-{id_gruppo_microbo}"
+
+        # Overall row of the instruction, linked to its detail sheet
+        valid_df = temp_df[temp_df[drop_column].isnull()]
+        try:
+            if valid_df.resistente.dropna().empty:
+                resistenti = None
+            else:
+                resistenti = valid_df.resistente.astype(bool).sum()
+        except (AttributeError, KeyError):
+            resistenti = None
+        resistenti_text = (
+            generate_resistenti_text_for_excel_output(valid_df) if resistenti else None
+        )
+        for report in reports:
+            overall_row = report.add_overall_row(
+                sheet_name,
+                tag_materiale,
+                nome_materiale,
+                id_gruppo_microbo,
+                nome_gruppo_microbo,
+                tot=len(valid_df),
+                resistenti=resistenti,
+                resistenti_text=resistenti_text,
+            )
+            report.add_detail(sheet_name, temp_df, overall_row)
 
     for instruction in rate_instructions:
         tag_materiale = instruction.tag
@@ -236,13 +448,13 @@ def analyze(
             if resistenze_gruppo_microbo:
                 temp_dfs.append(
                     filter_df_for_count(
-                        df,
+                        rates_df,
                         year=year,
                         month=month,
                         resistances=None,
                         id_gruppo_microbo=id_gruppo_microbo,
                         tag=tag_materiale,
-                        custom_filter_fn=filter_query_repeated_isolation_in_patients_lt_1_month_resistance_wise,
+                        custom_filter_fn=dedup_cache.resistance_wise,
                         custom_filter_fn_kwargs=dict(
                             drop_column=drop_column,
                             days_cutoff=(
@@ -251,17 +463,18 @@ def analyze(
                                 else default_days_cutoff
                             ),
                         ),
+                        group_indices=rates_df_indices,
                     )
                 )
             else:
                 temp_dfs.append(
                     filter_df_for_count(
-                        df,
+                        rates_df,
                         year=year,
                         month=month,
                         id_gruppo_microbo=id_gruppo_microbo,
                         tag=tag_materiale,
-                        custom_filter_fn=filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance,
+                        custom_filter_fn=dedup_cache.no_resistance,
                         custom_filter_fn_kwargs=dict(
                             drop_column=drop_column,
                             days_cutoff=(
@@ -270,6 +483,7 @@ def analyze(
                                 else default_days_cutoff
                             ),
                         ),
+                        group_indices=rates_df_indices,
                     )
                 )
         temp_df = pd.concat(temp_dfs).reindex(
@@ -296,146 +510,124 @@ def analyze(
         if "data_dimissione" in temp_df.columns:
             temp_df["data_dimissione"] = temp_df.data_dimissione.dt.date
         temp_df["is_numerator"] = select_fn(temp_df)
-        rates_data_no_mac_no_ps.append(
-            (
+        valid_df = temp_df[temp_df[drop_column].isnull()]
+        try:
+            numeratore = valid_df.is_numerator.sum()
+            if pd.isnull(numeratore):
+                numeratore = 0
+        except (AttributeError, KeyError):
+            numeratore = None
+        for report in reports:
+            report.add_overall_rates_row(
                 tag_materiale,
                 nome_materiale,
                 ", ".join(id_gruppo_microbi),
                 nome,
-                temp_df,
+                numeratore=numeratore,
+                days_of_hospitalization=days_of_hospitalization,
+                number_of_admissions_or_patients=number_of_admissions_or_patients,
             )
-        )
-
-    wb = openpyxl.load_workbook(excel_output_filepath)
-    sheetnames = list(wb.sheetnames)
 
-    # Add overall sheet and hyperlinks
-    overall_ws = wb.create_sheet("overall")
-    overall_rates_ws = wb.create_sheet("overall_rates")
 
-    # Intestation
-    add_overall_ws_intestation_row(overall_ws)
-    add_overall_rates_ws_intestation_row(overall_rates_ws)
-
-    # Custom formats
-    reference_date_format = openpyxl.styles.NamedStyle(
-        name="cd2", number_format="MMM-YY"
-    )
-
-    # Overall ws: iterate data
-    for i, (
-        tag_materiale,
-        nome_tag_materiale,
-        id_gruppo_microbo,
-        nome_gruppo_microbo,
-        temp_df,
-    ) in enumerate(data, start=2):
-        temp_df = temp_df[temp_df[drop_column].isnull()]
-        try:
-            if temp_df.resistente.dropna().empty:
-                resistenti = None
-            else:
-                resistenti = temp_df.resistente.astype(bool).sum()
-        except (AttributeError, KeyError):
-            resistenti = None
-        sheet_name = f"{tag_materiale}-{id_gruppo_microbo}"
-        tot = len(temp_df)
-
-        overall_ws.cell(i, 1, generate_date_reference_for_excel_output(year, month))
-        overall_ws.cell(i, 1).style = reference_date_format
-        overall_ws.cell(i, 2, tag_materiale)
-        overall_ws.cell(i, 3, nome_tag_materiale)
-        overall_ws.cell(i, 4, id_gruppo_microbo)
-        overall_ws.cell(i, 5, nome_gruppo_microbo)
-
-        overall_ws.cell(i, 6).hyperlink = f"#'{sheet_name}'!A1"
-        overall_ws.cell(i, 6).value = "vai al dettaglio"
-        overall_ws.cell(i, 6).style = "Hyperlink"
-
-        if tot is not None:
-            # Add tot
-            overall_ws.cell(i, 7, tot)
-            if resistenti is not None:
-                # Add n resistenti and pct
-                overall_ws.cell(
-                    i, 8, f"{resistenti} ({resistenti/tot:.0%})".replace(".", ",")
-                )
-                # add dettaglio resistenze if any resistenti
-                if resistenti:
-                    resistenti_text = generate_resistenti_text_for_excel_output(temp_df)
-                    overall_ws.cell(i, 9, resistenti_text)
-                    overall_ws.cell(i, 9).alignment = openpyxl.styles.Alignment(
-                        wrap_text=True
-                    )
-
-        # Add link to overall sheet
-        sheet = wb[sheet_name]
-        sheet["L1"].hyperlink = f"#'overall'!A{i}"
-        sheet["L1"].value = "torna all'indice"
-        sheet["L1"].style = "Hyperlink"
+def analyze_all_periods(year, workers=None, backend="processes", **kwargs):
+    """analyze() of each month of year and of the whole year, the same reports of 13 separate
+    runs. The isolates of the year (and its margins) are loaded and classified once and each
+    patient history is deduplicated once, then reused by every report that includes it. With
+    legacy_resistance only the deduplication is shared. The periods without data (e.g. the
+    months still to come) are skipped."""
+    year_isolates = _year_isolates(year, workers=workers, backend=backend)
+    dedup_cache = _dedup_cache(patient_histories=True)
+    _process_files(silent=True, workers=workers, backend=backend)
+    for month in [*range(1, 13), None]:
+        if not _window_partitions(*_load_window(year, month), silent=True):
+            print(f"No data for {year}-{month or 'all'}, skipping")
+            continue
+        analyze(
+            year=year,
+            month=month,
+            workers=workers,
+            backend=backend,
+            dedup_cache=dedup_cache,
+            year_isolates=year_isolates,
+            **kwargs,
+        )
 
-    # Overall_rates_ws: iterate rates_data
-    for i, (
-        tag_materiale,
-        nome_materiale,
-        id_gruppo_microbi,
-        nome,
-        temp_df,
-    ) in enumerate(rates_data_no_mac_no_ps, start=2):
-        temp_df = temp_df[temp_df[drop_column].isnull()]
-        try:
-            numeratore = temp_df.is_numerator.sum()
-            if pd.isnull(numeratore):
-                numeratore = 0
-        except (AttributeError, KeyError):
-            numeratore = None
 
-        overall_rates_ws.cell(
-            i, 1, generate_date_reference_for_excel_output(year, month)
-        )
-        overall_rates_ws.cell(i, 1).style = reference_date_format
-        overall_rates_ws.cell(i, 2, tag_materiale)
-        overall_rates_ws.cell(i, 3, nome_materiale)
-        overall_rates_ws.cell(i, 4, id_gruppo_microbi)
-        overall_rates_ws.cell(i, 4).alignment = openpyxl.styles.Alignment(
-            wrap_text=True
-        )
-        overall_rates_ws.cell(i, 5, nome)
-        if days_of_hospitalization is not None:
-            overall_rates_ws.cell(i, 9, days_of_hospitalization)
-        if number_of_admissions_or_patients is not None:
-            overall_rates_ws.cell(i, 10, number_of_admissions_or_patients)
-        if numeratore is not None:
-            overall_rates_ws.cell(i, 6, numeratore)
-            if days_of_hospitalization is not None:
-                # Add tasso per 10.000 gg as formula
-                overall_rates_ws.cell(i, 7, f"=F{i}/I{i}*10000")
-                overall_rates_ws.cell(i, 7).number_format = "0.00"
-            if number_of_admissions_or_patients is not None:
-                # Add tasso per 1.000 ricoveri or pazienti as formula
-                overall_rates_ws.cell(i, 8, f"=F{i}/J{i}*1000")
-                overall_rates_ws.cell(i, 8).number_format = "0.00"
-    # Add link to overall overall_rates_ws
-    overall_rates_ws["L1"].hyperlink = "#'overall'!A1"
-    overall_rates_ws["L1"].value = "torna all'indice"
-    overall_rates_ws["L1"].style = "Hyperlink"
+@dataclass
+class _analysis_result:
+    """The report computed by analyze_isolates. overall and overall_rates have the columns of
+    the tables of --output-format (see _columnar_writer): one row per instruction with
+    totale_isolati and resistenti, one row per rate instruction with numeratore and the rates.
+    details[i] is the detail frame of instructions[i], the row of overall with istruzione i.
+    """
 
-    # Set K column .styles.Alignment(wrap_text=True) for all sheets except overall
-    for ws in wb._sheets:
-        if ws.title not in ("overall", "overall_rates"):
-            for cell in ws["K"]:
-                cell.alignment = openpyxl.styles.Alignment(wrap_text=True)
+    year: int
+    month: Optional[int]
+    instructions: List[_instruction]
+    overall: pd.DataFrame
+    overall_rates: pd.DataFrame
+    details: List[pd.DataFrame]
 
-    # Set column width
-    set_column_widths(wb)
 
-    # Set filters
-    set_wb_filters(wb)
+def analyze_isolates(
+    isolates: Union[pd.DataFrame, pa.Table],
+    year,
+    month=None,
+    instructions=list(),
+    rate_instructions=list(),
+    drop_column="to_drop",
+    default_days_cutoff=30,
+    days_of_hospitalization=None,
+    number_of_admissions_or_patients=None,
+    workers=None,
+    backend="serial",
+) -> _analysis_result:
+    """analyze() of already loaded isolates, in memory: nothing is read from data,
+    _cached_data or manual_db_adds.xlsx and nothing is written, the report is returned as an
+    _analysis_result.
 
-    # Set sheet order
-    wb._sheets = [
-        wb[sheetname] for sheetname in ["overall", "overall_rates"] + sheetnames
+    isolates has a row per isolate with resistente and the columns of _ISOLATE_COLS and
+    _KEEP_COLS, as load_isolates returns them, and must include the months before the period
+    (and after it, see _load_window) for the duplicates to be found as in analyze. Instead of
+    patient_key it may have cognome_paziente, nome_paziente and data_nascita. The frame of the
+    caller is not modified. With backend="processes" the frames are handed to the workers
+    through a temporary file (see _shared_frame)."""
+    if isinstance(isolates, pa.Table):
+        df = isolates.to_pandas()
+    else:
+        df = isolates.copy()
+    if _PATIENT_KEY not in df.columns and all(c in df.columns for c in _PATIENT_COLS):
+        df = _add_patient_key(df)
+    missing = [
+        c for c in _ISOLATE_COLS + _KEEP_COLS + ["resistente"] if c not in df.columns
     ]
+    if missing:
+        raise ValueError(f"Colonne mancanti negli isolati: {', '.join(missing)}")
 
-    # Save
-    wb.save(excel_output_filepath)
+    df = _prepare_isolates(df)
+    _instructions = _all_instructions(df, year, month, instructions)
+    report = _report_frames(year, month, drop_column)
+    _compute_report(
+        df,
+        year,
+        month,
+        _instructions,
+        rate_instructions,
+        [report],
+        drop_column=drop_column,
+        default_days_cutoff=default_days_cutoff,
+        days_of_hospitalization=days_of_hospitalization,
+        number_of_admissions_or_patients=number_of_admissions_or_patients,
+        dedup_cache=_dedup_cache(),
+        workers=workers,
+        backend=backend,
+    )
+    report.save()
+    return _analysis_result(
+        year=year,
+        month=month,
+        instructions=_instructions,
+        overall=report.overall,
+        overall_rates=report.overall_rates,
+        details=report.details,
+    )
@@ -1,6 +1,154 @@
+from dataclasses import dataclass
+import hashlib
+import json
+import os
 import re
+from typing import Dict, Optional, Tuple, Union
+import numpy as np
 import pandas as pd
-from .helper import microbo_mapper
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from .duplicated_fns import _PATIENT_COLS, _PATIENT_KEY
+from .helper import (
+    microbo_mapper,
+    _generate_csv_legend_path,
+    to_object_dtypes,
+    check_total_df,
+    _CURRENT_VERSION,
+    _LOAD_DATA_REQUIRED_COLUMNS,
+    _add_patient_key,
+    _check_cached_version,
+    _get_cached_isolates,
+    _get_fingerprint_for_file,
+    _isolates_file,
+    _load_manual_db_adds,
+    _load_window,
+    _partition_file,
+    _process_files,
+    _read_manual_db_adds,
+    _read_partitions,
+    _restrict_manual_db_adds,
+    _update_cached_version,
+    _window_partitions,
+    _with_compact_dtypes,
+)
+from .executor import _executor
+
+_SORVEGLIANZA_ATTIVA_MATERIALE = "TB"
+_RULE_PHASES = ("base", "indipendente", "meccanismo")
+_RULE_CONDITIONS = ("positivo", "maggiore", "sorveglianza_attiva")
+
+
+@dataclass(frozen=True)
+class _rule_condition:
+    id_antibiotico: Optional[str]
+    condizione: str
+    soglia: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class _rule_level:
+    resistenza: str
+    condizioni: Tuple[_rule_condition, ...]
+
+
+@dataclass(frozen=True)
+class _rule_program:
+    # base: catena if/elif, si applica solo il primo livello soddisfatto
+    base: Tuple[_rule_level, ...] = ()
+    # indipendente: ogni livello soddisfatto aggiunge la sua resistenza
+    indipendente: Tuple[_rule_level, ...] = ()
+    # meccanismo: come indipendente, ma MDR>xxx sostituisce MDR (o MDR>NDD se nessun dettaglio)
+    meccanismo: Tuple[_rule_level, ...] = ()
+
+
+@dataclass(frozen=True)
+class _resistance_rules:
+    version: str
+    hash: str
+    programs: Dict[str, _rule_program]
+    antibiotics: Tuple[str, ...]
+
+
+def load_resistance_rules(path: Union[str, os.PathLike]) -> _resistance_rules:
+    """Compile the rules file into one program per id_gruppo_microbo.
+
+    Rows with the same gruppo, fase and ordine are in OR between them, levels are
+    evaluated in increasing ordine."""
+    with open(path, "rb") as f:
+        content = f.read()
+    version = ""
+    first_line = content.decode("utf-8").splitlines()[0]
+    if first_line.startswith("#") and ":" in first_line:
+        version = first_line.split(":", 1)[1].strip()
+    rules = pd.read_csv(
+        path, comment="#", dtype={"id_antibiotico": str, "resistenza": str}
+    )
+    if not rules.fase.isin(_RULE_PHASES).all():
+        raise ValueError(
+            f"Fase non valida in {path}: {set(rules.fase) - set(_RULE_PHASES)}"
+        )
+    if not rules.condizione.isin(_RULE_CONDITIONS).all():
+        raise ValueError(
+            f"Condizione non valida in {path}: {set(rules.condizione) - set(_RULE_CONDITIONS)}"
+        )
+    if rules[rules.condizione == "maggiore"].soglia.isnull().any():
+        raise ValueError(f"Condizione 'maggiore' senza soglia in {path}")
+    rules["gruppi"] = rules.gruppi.str.split("|")
+    rules = rules.explode("gruppi")
+
+    programs = {}
+    for gruppo, gruppo_rules in rules.groupby("gruppi", sort=False):
+        phases = {}
+        for fase in _RULE_PHASES:
+            levels = []
+            for _, level_rules in gruppo_rules[gruppo_rules.fase == fase].groupby(
+                "ordine", sort=True
+            ):
+                if level_rules.resistenza.nunique() != 1:
+                    raise ValueError(
+                        f"Resistenze diverse per lo stesso ordine ({gruppo}, {fase}) in {path}"
+                    )
+                levels.append(
+                    _rule_level(
+                        resistenza=level_rules.resistenza.iloc[0],
+                        condizioni=tuple(
+                            _rule_condition(
+                                id_antibiotico=(
+                                    row.id_antibiotico
+                                    if pd.notnull(row.id_antibiotico)
+                                    else None
+                                ),
+                                condizione=row.condizione,
+                                soglia=(
+                                    float(row.soglia)
+                                    if pd.notnull(row.soglia)
+                                    else None
+                                ),
+                            )
+                            for row in level_rules.itertuples()
+                        ),
+                    )
+                )
+            phases[fase] = tuple(levels)
+        if len(phases["base"]) > 255 or (
+            len(phases["indipendente"]) + len(phases["meccanismo"]) > 55
+        ):
+            raise ValueError(f"Troppe regole per il gruppo {gruppo} in {path}")
+        programs[gruppo] = _rule_program(**phases)
+
+    return _resistance_rules(
+        version=version,
+        hash=hashlib.md5(content).hexdigest(),
+        programs=programs,
+        antibiotics=tuple(rules.id_antibiotico.dropna().unique()),
+    )
+
+
+resistance_rules = load_resistance_rules(
+    _generate_csv_legend_path("resistance_rules.csv")
+)
 
 
 def _cast_float_or_bool(x):
@@ -28,167 +176,49 @@ def _extract_value(df, atb_id):
     return value_or_values.apply(_cast_float_or_bool).max()
 
 
+def _check_condition(condition, value, is_sorveglianza_attiva):
+    if condition.condizione == "sorveglianza_attiva":
+        return is_sorveglianza_attiva
+    if pd.isnull(value):
+        return False
+    if condition.condizione == "positivo":
+        return bool(value)
+    return value > condition.soglia
+
+
 def _check_resistance_and_validity(df):
     # if the function returns NA the observation must be discarded
 
     if not "id_gruppo_microbo" in df.columns:
         return pd.NA
 
-    resistances = set()
-    # Se tampone anale = sorveglianza attiva
-    is_sorveglianza_attiva = df.id_materiale.iloc[0] == "TB"
-    mdr_value = _extract_value(df, "MDR")
-    esbl_value = _extract_value(df, "ESBL")
-
-    kpc_value = _extract_value(df, "KPC")
-    kpc_alternative_value = _extract_value(df, "CARBA")
-    imp_value = _extract_value(df, "imp")
-    ndm_value = _extract_value(df, "ndm")
-    carba_r_value = _extract_value(df, "CARBA-R")
-    oxa_value = _extract_value(df, "oxa")
-    vim_value = _extract_value(df, "vim")
-
-    def evaluate_mdr_mech(resistances):
-        detail = False
-        if (pd.notnull(kpc_value) and kpc_value) or (
-            pd.notnull(kpc_alternative_value) and kpc_alternative_value
-        ):
-            resistances.add("MDR>KPC")
-            detail = True
-            resistances.add("MDR")
-        if pd.notnull(imp_value) and imp_value:
-            resistances.add("MDR>IMP")
-            detail = True
-            resistances.add("MDR")
-        if pd.notnull(ndm_value) and ndm_value:
-            resistances.add("MDR>NDM")
-            detail = True
-            resistances.add("MDR")
-        if pd.notnull(oxa_value) and oxa_value:
-            resistances.add("MDR>OXA-48")
-            detail = True
-            resistances.add("MDR")
-        if pd.notnull(vim_value) and vim_value:
-            resistances.add("MDR>VIM")
-            detail = True
-            resistances.add("MDR")
-
-        # Carba-R is not an MDR, is only a resistance mechanism
-        if pd.notnull(carba_r_value) and carba_r_value:
-            detail = True
-            resistances.add("CAR")
-
-        if "MDR" in resistances and not detail:
-            resistances.add("MDR>NDD")
-
-        if "MDR" in resistances:
-            resistances.remove("MDR")
-        return resistances
-
-    if df.id_gruppo_microbo.iloc[0] in (
-        "esccol",
-        "klespp",
-        "kleoxy",
-        "klepne",
-        "klespe",
-        "prospp",
-        "mormor",
-    ):
-        if pd.notnull(mdr_value) and mdr_value:
-            resistances.add("MDR")
-        elif is_sorveglianza_attiva:
-            resistances.add("MDR")
-        else:
-            cefotaxime_value = _extract_value(df, "CTX")
-            ceftazidime_value = _extract_value(df, "CAZ")
-            if (
-                (pd.notnull(esbl_value) and esbl_value)
-                or (pd.notnull(cefotaxime_value) and cefotaxime_value > 1)
-                or (pd.notnull(ceftazidime_value) and ceftazidime_value > 1)
-            ):
-                resistances.add("ESBL")
-
-        resistances = evaluate_mdr_mech(resistances)
-        return "|".join(resistances)
-
-    elif df.id_gruppo_microbo.iloc[0] in ["pseaer", "psespp", "psepsu"]:
-        meropenem_value = _extract_value(df, "MEM")
-        imipenem_value = _extract_value(df, "IPM")
-        if pd.notnull(mdr_value) and mdr_value:
-            resistances.add("MDR")
-        elif (pd.notnull(meropenem_value) and meropenem_value > 2) or (
-            pd.notnull(imipenem_value) and imipenem_value > 4
-        ):
-            resistances.add("CAR")
-        elif is_sorveglianza_attiva:
-            resistances.add("MDR")
-        resistances = evaluate_mdr_mech(resistances)
-        # if "CAR" in resistances and "MDR" in resistances and len(resistances) == 2:
-        #     resistances.remove("MDR")
-        return "|".join(resistances)
-
-    elif df.id_gruppo_microbo.iloc[0] == "acibcx":
-        if pd.notnull(mdr_value) and mdr_value:
-            resistances.add("MDR")
-        elif is_sorveglianza_attiva:
-            resistances.add("MDR")
-        resistances = evaluate_mdr_mech(resistances)
-        return "|".join(resistances)
+    program = resistance_rules.programs.get(df.id_gruppo_microbo.iloc[0])
+    if program is None:
+        # Nessuna regola per il gruppo: si restituisce pd.NA
+        return pd.NA
 
-    elif df.id_gruppo_microbo.iloc[0] == "enbaco":
-        if pd.notnull(mdr_value) and mdr_value:
-            resistances.add("MDR")
-        elif is_sorveglianza_attiva:
-            resistances.add("MDR")
-        resistances = evaluate_mdr_mech(resistances)
-        return "|".join(resistances)
+    # Se tampone anale = sorveglianza attiva
+    is_sorveglianza_attiva = df.id_materiale.iloc[0] == _SORVEGLIANZA_ATTIVA_MATERIALE
+    values = {}
 
-    elif df.id_gruppo_microbo.iloc[0] == "citspp":
-        if pd.notnull(mdr_value) and mdr_value:
-            resistances.add("MDR")
-        elif is_sorveglianza_attiva:
-            resistances.add("MDR")
-        resistances = evaluate_mdr_mech(resistances)
-        return "|".join(resistances)
+    def is_hit(level):
+        for condition in level.condizioni:
+            if condition.id_antibiotico and condition.id_antibiotico not in values:
+                values[condition.id_antibiotico] = _extract_value(
+                    df, condition.id_antibiotico
+                )
+            value = values.get(condition.id_antibiotico, pd.NA)
+            if _check_condition(condition, value, is_sorveglianza_attiva):
+                return True
+        return False
 
-    elif df.id_gruppo_microbo.iloc[0] == "sermar":
-        if pd.notnull(mdr_value) and mdr_value:
-            resistances.add("MDR")
-        resistances = evaluate_mdr_mech(resistances)
-        return "|".join(resistances)
-
-    elif df.id_gruppo_microbo.iloc[0] == "psemal":
-        sxt_value = _extract_value(df, "SXT")
-        if pd.notnull(sxt_value) and sxt_value > 80:
-            resistances.add("SXT")
-        return "|".join(resistances)
-
-    elif df.id_gruppo_microbo.iloc[0] == "staaur":
-        oxa_value = _extract_value(df, "OXA")
-        vancomicina_value = _extract_value(df, "VAN")
-        if not pd.isnull(oxa_value) and oxa_value > 2:
-            resistances.add("MRSA")
-        if not pd.isnull(vancomicina_value) and vancomicina_value > 2:
-            resistances.add("VANCO")
-        return "|".join(resistances)
-
-    elif df.id_gruppo_microbo.iloc[0] == "entspp":
-        # esclude enterococcus gallinarum che è sempre resistente
-        vancomicina_value = _extract_value(df, "VAN")
-        df = df[~df.id_microbo.isin(["entgal", "entcas"])].copy()
-        if not pd.isnull(vancomicina_value) and vancomicina_value > 4:
-            resistances.add("VRE")
-        return "|".join(resistances)
-    elif df.id_gruppo_microbo.iloc[0] == "strpne":
-        penicillina_value = _extract_value(df, "PEN")
-        benzilpenicillina_value = _extract_value(df, "BPE")
-        if (
-            not pd.isnull(benzilpenicillina_value) and benzilpenicillina_value > 0.06
-        ) or (not pd.isnull(penicillina_value) and penicillina_value > 0.06):
-            resistances.add("PEN")
-        return "|".join(resistances)
-    # Se si arriva a questo punto si restituisce pd.NA
-    return pd.NA
+    base = next((level.resistenza for level in program.base if is_hit(level)), None)
+    return _compose_resistances(
+        base=base,
+        independent=[l.resistenza for l in program.indipendente if is_hit(l)],
+        mechanisms=[l.resistenza for l in program.meccanismo if is_hit(l)],
+        evaluate_mech=bool(program.meccanismo),
+    )
 
 
 def check_resistance_and_validity(df, keep_cols=None):
@@ -244,3 +274,428 @@ def get_resistance_or_not_instructions():
     resistance_check = values.to_dict()
 
     return resistance_check
+
+
+def _to_float(x):
+    x = _cast_float_or_bool(x)
+    if pd.isnull(x):
+        return np.nan
+    return float(x)
+
+
+def _cast_float_or_bool_array(values: pd.Series) -> np.ndarray:
+    """Vectorized _cast_float_or_bool: bools become 1.0/0.0 and missing or unparsable values NaN"""
+    codes, uniques = pd.factorize(values)
+    casted = np.array([_to_float(x) for x in uniques], dtype=float)
+    out = np.full(len(values), np.nan)
+    valid = codes >= 0
+    out[valid] = casted[codes[valid]]
+    return out
+
+
+def _compose_resistances(base, independent, mechanisms, evaluate_mech):
+    # The resistances are joined sorted: the order of the set depends on the hash seed, and the
+    # months of a report can be classified by different runs
+    resistances = set()
+    if base:
+        resistances.add(base)
+    for resistance in independent:
+        resistances.add(resistance)
+    if not evaluate_mech:
+        return "|".join(sorted(resistances))
+    detail = False
+    for mechanism in mechanisms:
+        if mechanism.startswith("MDR>"):
+            resistances.add(mechanism)
+            detail = True
+            resistances.add("MDR")
+        else:
+            detail = True
+            resistances.add(mechanism)
+    if "MDR" in resistances and not detail:
+        resistances.add("MDR>NDD")
+    if "MDR" in resistances:
+        resistances.remove("MDR")
+    return "|".join(sorted(resistances))
+
+
+def _evaluate_level(level, sorveglianza_attiva, values):
+    hit = np.zeros(len(sorveglianza_attiva), dtype=bool)
+    for condition in level.condizioni:
+        if condition.condizione == "sorveglianza_attiva":
+            hit |= sorveglianza_attiva
+        elif condition.condizione == "positivo":
+            value = values[condition.id_antibiotico]
+            hit |= ~np.isnan(value) & (value != 0)
+        else:
+            # comparisons with NaN are always False
+            hit |= values[condition.id_antibiotico] > condition.soglia
+    return hit
+
+
+def _evaluate_resistances(gruppi, sorveglianza_attiva, values):
+    """Evaluate the compiled resistance rules over all isolates at once.
+
+    gruppi and sorveglianza_attiva are arrays with one element per isolate, values maps
+    each antibiotic of the rules to the array of its (max) value.
+    Returns an object array with the same strings _check_resistance_and_validity returns.
+    """
+    rules = resistance_rules
+    programs = list(dict.fromkeys(rules.programs.values()))
+    program_ids = {p: i for i, p in enumerate(programs)}
+    isolate_programs = (
+        pd.Series(gruppi, dtype=object)
+        .map({g: program_ids[p] for g, p in rules.programs.items()})
+        .fillna(-1)
+        .to_numpy(dtype=np.int64)
+    )
+
+    # Each isolate outcome is encoded as an integer: the satisfied base level in the
+    # lowest 8 bits, then one bit for each indipendente and meccanismo level
+    outcomes = np.zeros(len(gruppi), dtype=np.int64)
+    for program_id, program in enumerate(programs):
+        selected = np.flatnonzero(isolate_programs == program_id)
+        if not len(selected):
+            continue
+        program_values = {atb: value[selected] for atb, value in values.items()}
+        program_sorveglianza_attiva = sorveglianza_attiva[selected]
+        outcome = np.zeros(len(selected), dtype=np.int64)
+        for i, level in reversed(list(enumerate(program.base, start=1))):
+            hit = _evaluate_level(level, program_sorveglianza_attiva, program_values)
+            outcome[hit] = i  # reversed order: the first satisfied level wins
+        for i, level in enumerate(program.indipendente + program.meccanismo):
+            hit = _evaluate_level(level, program_sorveglianza_attiva, program_values)
+            outcome |= hit.astype(np.int64) << (8 + i)
+        outcomes[selected] = outcome
+
+    # Build the string once per distinct (program, outcome)
+    uniques, inverse = np.unique(
+        np.stack([isolate_programs, outcomes], axis=1), axis=0, return_inverse=True
+    )
+    composed = np.empty(len(uniques), dtype=object)
+    for i, (program_id, outcome) in enumerate(uniques):
+        if program_id < 0:
+            composed[i] = pd.NA
+            continue
+        program = programs[program_id]
+        base_level = outcome & 0xFF
+        hits = [
+            level.resistenza
+            for j, level in enumerate(program.indipendente + program.meccanismo)
+            if outcome >> (8 + j) & 1
+        ]
+        n_independent = sum(
+            outcome >> (8 + j) & 1 for j in range(len(program.indipendente))
+        )
+        composed[i] = _compose_resistances(
+            base=program.base[base_level - 1].resistenza if base_level else None,
+            independent=hits[:n_independent],
+            mechanisms=hits[n_independent:],
+            evaluate_mech=bool(program.meccanismo),
+        )
+    return composed[inverse.reshape(-1)]
+
+
+def _mode_by_group(group_ids: np.ndarray, n_groups: int, values: pd.Series):
+    # Same result of values.mode().iloc[0] for each group: the most frequent value, the
+    # smallest one in case of ties, pd.NA if the group has only missing values
+    out = np.full(n_groups, pd.NA, dtype=object)
+    valid = values.notna().to_numpy()
+    if not valid.any():
+        return out
+    counts = (
+        pd.DataFrame({"g": group_ids[valid], "v": values.to_numpy()[valid]})
+        .groupby(["g", "v"], sort=True)
+        .size()
+    )
+    best = counts.groupby(level=0, sort=False).idxmax()
+    out[best.index.to_numpy()] = np.array([v for _, v in best], dtype=object)
+    return out
+
+
+def classify_isolates(df, group_cols, keep_cols):
+    """Vectorized equivalent of
+    ``df.groupby(group_cols, as_index=False).apply(check_resistance_and_validity, keep_cols=keep_cols)``.
+
+    The long table (one row per antibiotic) is pivoted once into a wide isolate x
+    antibiotic matrix and every rule is evaluated as a whole-column mask.
+    """
+    df = df[df[group_cols].notna().all(axis=1)]
+    group_ids = df.groupby(group_cols, sort=True, observed=True).ngroup().to_numpy()
+    _, first_positions = np.unique(group_ids, return_index=True)
+    n_groups = len(first_positions)
+
+    # Wide matrix with the max value of each relevant antibiotic for each isolate
+    antibiotics = list(resistance_rules.antibiotics)
+    atb_codes = pd.Categorical(df.id_antibiotico, categories=antibiotics).codes
+    selected = atb_codes >= 0
+    matrix = np.full((n_groups, len(antibiotics)), np.nan)
+    np.fmax.at(
+        matrix,
+        (group_ids[selected], atb_codes[selected]),
+        _cast_float_or_bool_array(df.risultato_quantitativo[selected]),
+    )
+
+    first_rows = df.iloc[first_positions]
+    resistente = _evaluate_resistances(
+        gruppi=first_rows.id_gruppo_microbo.to_numpy(dtype=object),
+        # Se tampone anale = sorveglianza attiva
+        sorveglianza_attiva=(
+            first_rows.id_materiale == _SORVEGLIANZA_ATTIVA_MATERIALE
+        ).to_numpy(),
+        values={atb: matrix[:, i] for i, atb in enumerate(antibiotics)},
+    )
+
+    result = pd.DataFrame(
+        {c: _mode_by_group(group_ids, n_groups, df[c]) for c in keep_cols}
+        | {"resistente": resistente}
+    ).infer_objects()
+    # Keys as plain objects, as the groupby of the legacy path returns them
+    keys = to_object_dtypes(first_rows[group_cols].reset_index(drop=True))
+    return pd.concat([keys, result], axis=1)
+
+
+def _name_group_cols(group_cols):
+    # patient_key depends on the loaded months, the cached isolates keep the patient names
+    return [
+        c
+        for col in group_cols
+        for c in (_PATIENT_COLS if col == _PATIENT_KEY else [col])
+    ]
+
+
+# The columns check_total_df reads
+_TOTAL_DF_COLUMNS = [
+    "id_richiesta",
+    "id_esame",
+    "id_gruppo_microbo",
+    "nome_gruppo_microbo",
+    "data_prelievo",
+    "esbl",
+]
+
+
+def _partition_columns(group_cols, keep_cols):
+    return list(
+        dict.fromkeys(
+            [
+                *_name_group_cols(group_cols),
+                *keep_cols,
+                # needed by check_total_df and classify_isolates
+                "id_esame",
+                "id_gruppo_microbo",
+                "nome_gruppo_microbo",
+                "id_materiale",
+                "id_antibiotico",
+                "risultato_quantitativo",
+                "esbl",
+                *_LOAD_DATA_REQUIRED_COLUMNS,
+            ]
+        )
+    )
+
+
+def _classify_rows(df, group_cols, keep_cols):
+    """classify_isolates of the rows of df (as read by _read_partitions), grouped by the
+    patient names instead of patient_key"""
+    df = _with_compact_dtypes(df)
+    return classify_isolates(df, _name_group_cols(group_cols), keep_cols=keep_cols)
+
+
+def _classify_partition(year, month, group_cols, keep_cols):
+    """Classify the isolates of a partition and save them in _isolates_file. Runs in a worker."""
+    classified = _classify_rows(
+        _read_partitions(
+            [(year, month)], columns=_partition_columns(group_cols, keep_cols)
+        ),
+        group_cols,
+        keep_cols,
+    )
+    os.makedirs(os.path.dirname(_isolates_file(year, month)), exist_ok=True)
+    pq.write_table(
+        pa.Table.from_pandas(classified, preserve_index=False),
+        _isolates_file(year, month),
+    )
+
+
+# Partitions are classified in parallel only if each worker gets at least this many rows
+_MIN_ROWS_PER_WORKER = 200_000
+
+
+def _classified_isolates(
+    partitions, group_cols, keep_cols, silent=False, workers=None, backend="processes"
+):
+    """{(year, month): isolates} of the partitions, classifying again only the months whose key
+    changed"""
+    _check_cached_version("classification", silent=silent)
+    stage = {
+        name: fingerprint and fingerprint["hash"]
+        for name, fingerprint in _CURRENT_VERSION["stages"]["classification"].items()
+    }
+    to_classify = []
+    for y, m in partitions:
+        cached = _get_cached_isolates(f"{y}-{m}")
+        source = _get_fingerprint_for_file(_partition_file(y, m), cached.get("source"))
+        key = hashlib.blake2b(
+            json.dumps(
+                [source and source["hash"], stage, group_cols, keep_cols]
+            ).encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
+        if cached.get("key") == key and os.path.exists(_isolates_file(y, m)):
+            if not silent:
+                print(f'Isolates of "{y}-{m}" already classified, skipping')
+        else:
+            if not silent:
+                print(f'Classifying isolates of "{y}-{m}"')
+            to_classify.append((y, m))
+        _CURRENT_VERSION["isolates"][f"{y}-{m}"] = dict(source=source, key=key)
+    _executor(backend, workers).map(
+        _classify_partition,
+        [(y, m, group_cols, keep_cols) for y, m in to_classify],
+        size=sum(
+            pq.ParquetFile(_partition_file(y, m)).metadata.num_rows
+            for y, m in to_classify
+        ),
+        min_size=_MIN_ROWS_PER_WORKER,
+    )
+    # Cached and just classified months are read back alike, so that they have the same dtypes
+    isolates = {
+        (y, m): pq.read_table(_isolates_file(y, m)).to_pandas() for y, m in partitions
+    }
+    _update_cached_version()
+    return isolates
+
+
+def _window_isolates(isolates, low, high, group_cols, keep_cols, manual_db_adds):
+    """The isolates of the window [low, high) given the {(year, month): isolates} of its
+    partitions, with the requests of manual_db_adds classified again, patient_key and the
+    dtypes and order of classify_isolates"""
+    partitions = list(isolates)
+    isolates = pd.concat(list(isolates.values()), ignore_index=True)
+    # check_total_df runs on the whole window and not on each month, as the rows of an exam
+    # may fall in two months
+    total_df = _read_partitions(partitions, columns=_TOTAL_DF_COLUMNS)
+
+    # The requests with manual_db_adds are classified again with the added rows
+    if len(manual_db_adds):
+        df = _read_partitions(
+            partitions,
+            columns=_partition_columns(group_cols, keep_cols),
+            filter=ds.field("id_richiesta").isin(
+                manual_db_adds.id_richiesta.dropna().unique()
+            ),
+        )
+        manual_db_adds = _restrict_manual_db_adds(
+            _load_manual_db_adds(df, manual_db_adds), low, high
+        )
+        total_df = pd.concat(
+            [total_df, manual_db_adds[_TOTAL_DF_COLUMNS]], ignore_index=True
+        )
+    check_total_df(total_df)
+    if len(manual_db_adds):
+        manual_isolates = _classify_rows(
+            pd.concat([df, manual_db_adds], ignore_index=True),
+            group_cols,
+            keep_cols,
+        )
+        isolates = pd.concat(
+            [
+                isolates[~isolates.id_richiesta.isin(df.id_richiesta)],
+                manual_isolates,
+            ],
+            ignore_index=True,
+        )
+    if isolates.empty:
+        raise ValueError("Nessun dato presente!")
+
+    if _PATIENT_KEY in group_cols:
+        isolates = _add_patient_key(isolates).drop(columns=_PATIENT_COLS)
+    # Same dtypes classify_isolates gives on the whole window, whatever parquet and concat made of
+    # the columns with missing values
+    isolates = isolates.assign(
+        **{
+            c: isolates[c].astype(object).where(isolates[c].notna(), pd.NA)
+            for c in keep_cols + ["resistente"]
+        }
+    ).infer_objects()
+    # Same order of the groupby on the whole window
+    return (
+        isolates[group_cols + keep_cols + ["resistente"]]
+        .sort_values(group_cols)
+        .reset_index(drop=True)
+    )
+
+
+def load_isolates(
+    year,
+    month=None,
+    group_cols=(),
+    keep_cols=(),
+    silent=False,
+    workers=None,
+    backend="processes",
+):
+    """classify_isolates of the observations load_data would return, with the isolates of
+    each month cached in _cached_data/isolates.
+
+    The isolates of a month are classified again only if its key changes: the key combines the
+    hash of the partition, the hash of the classification stage (resistance_rules.csv and the
+    classification code) and the requested columns. The changed months are classified by an
+    _executor with the given backend and workers. Isolates of the requests in manual_db_adds
+    are classified on every run together with the added rows."""
+    group_cols, keep_cols = list(group_cols), list(keep_cols)
+    _process_files(silent=silent, workers=workers, backend=backend)
+    low, high = _load_window(year, month)
+    partitions = _window_partitions(low, high, silent=silent)
+    if not partitions:
+        raise ValueError("Nessun dato presente!")
+    isolates = _classified_isolates(
+        partitions, group_cols, keep_cols, silent, workers, backend
+    )
+    return _window_isolates(
+        isolates, low, high, group_cols, keep_cols, _read_manual_db_adds()
+    )
+
+
+class _year_isolates:
+    """load_isolates of each month of a year and of the whole year. The window of the year
+    contains the window of every month, so its partitions are classified and read once, on the
+    first load, and each load only takes the partitions of its own window."""
+
+    def __init__(self, year, silent=False, workers=None, backend="processes"):
+        self.year = year
+        self.silent = silent
+        self.workers = workers
+        self.backend = backend
+        self._columns = None
+        self._isolates = None
+        self._manual_db_adds = None
+
+    def load(self, month=None, group_cols=(), keep_cols=()):
+        group_cols, keep_cols = list(group_cols), list(keep_cols)
+        if self._columns != (group_cols, keep_cols):
+            _process_files(
+                silent=self.silent, workers=self.workers, backend=self.backend
+            )
+            self._isolates = _classified_isolates(
+                _window_partitions(*_load_window(self.year), silent=self.silent),
+                group_cols,
+                keep_cols,
+                self.silent,
+                self.workers,
+                self.backend,
+            )
+            self._manual_db_adds = _read_manual_db_adds()
+            self._columns = (group_cols, keep_cols)
+        low, high = _load_window(self.year, month)
+        isolates = {
+            partition: df
+            for partition, df in self._isolates.items()
+            if low <= partition < high
+        }
+        if not isolates:
+            raise ValueError("Nessun dato presente!")
+        return _window_isolates(
+            isolates, low, high, group_cols, keep_cols, self._manual_db_adds
+        )
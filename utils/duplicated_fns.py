@@ -1,74 +1,179 @@
+import hashlib
 import itertools
+
+import numpy as np
 import pandas as pd
 
+from .executor import _read_shared, _shared_frame
 
-def _pairwise(iterable):
-    a, b = itertools.tee(iterable)
-    next(b, None)
-    return zip(a, b)
+_PATIENT_COLS = ["cognome_paziente", "nome_paziente", "data_nascita"]
+# Integer key of (cognome_paziente, nome_paziente, data_nascita) added by load_data, in the same order
+_PATIENT_KEY = "patient_key"
+_NS_PER_DAY = 24 * 60 * 60 * 10**9
+# _dedup_cache.prefetch runs in parallel only if each shard gets at least this many rows
+_MIN_ROWS_PER_SHARD = 20_000
 
+# Drop reasons, the referenced isolate is appended as " di id_richiesta: ... (data prelievo: ...)"
+_NO_REASON = 0
+_REASONS = {
+    1: "",
+    2: ", che ha più resistenze",
+    3: ", che aveva più resistenze",
+    4: ", entrambi con lo stesso numero di resistenze",
+    5: ", che era resistente",
+    6: ", che è/sarà resistente",
+    7: ", entrambi non resistenti",
+}
 
-if not hasattr(itertools, "pairwise"):
-    setattr(itertools, "pairwise", _pairwise)
 
+def _patient_cols(df):
+    return [_PATIENT_KEY] if _PATIENT_KEY in df.columns else _PATIENT_COLS
 
-def _drop_duplicated_resistance_wise(df, days_cutoff=30, drop_column="to_drop"):
-    """drop duplicates keeping the first resistant in chronological order"""
-    df = df.sort_values("data_prelievo")
-    # Prima di tutto eliminiamo i duplicati resistenti tenendo i primi in ordine cronologico
-    next_iteration = True
-    not_drop_df = df[df[drop_column].isnull()]
-    while next_iteration and not_drop_df.resistente.astype(bool).sum() > 0:
-        next_iteration = False
-        indexes, rows = list(
-            zip(*not_drop_df[not_drop_df.resistente.astype(bool)].iterrows())
+
+def _sort_by_patient_and_date(df, group_cols):
+    """Return the positions of the rows of df grouped by patient (in sorted key order,
+    rows with missing keys are excluded) and sorted by data_prelievo, along with the
+    patient code of each returned row."""
+    valid = np.flatnonzero(df[group_cols].notna().all(axis=1).to_numpy())
+    if group_cols == [_PATIENT_KEY]:
+        patients = df[_PATIENT_KEY].to_numpy()[valid].astype(np.int64)
+    else:
+        patients = df.iloc[valid].groupby(group_cols, sort=True).ngroup().to_numpy()
+    dates = df.data_prelievo.to_numpy()[valid]
+    order = np.lexsort((dates, patients))
+    positions, patients = valid[order], patients[order]
+
+    # Rows of the same patient with the same data_prelievo keep the order that
+    # sort_values (quicksort, not stable) gives on the patient's rows
+    tied = (patients[1:] == patients[:-1]) & (dates[order][1:] == dates[order][:-1])
+    for patient in np.unique(patients[1:][tied]):
+        block = np.flatnonzero(patients == patient)
+        patient_positions = np.sort(positions[block])
+        patient_dates = df.data_prelievo.to_numpy()[patient_positions]
+        positions[block] = patient_positions[patient_dates.argsort(kind="quicksort")]
+    return positions, patients
+
+
+def _close_pairs(alive, patients, dates, days_cutoff):
+    """Consecutive alive rows of the same patient less than days_cutoff days apart"""
+    idx = np.flatnonzero(alive)
+    previous, current = idx[:-1], idx[1:]
+    # (a - b).days of two timestamps is the floor of the difference in days
+    close = (patients[previous] == patients[current]) & (
+        (dates[current] - dates[previous]) // _NS_PER_DAY < days_cutoff
+    )
+    return previous[close], current[close]
+
+
+def _sweep(alive, patients, dates, days_cutoff, reason, reference, decide):
+    """Compare consecutive alive rows and drop one of each pair closer than days_cutoff,
+    repeating on the remaining rows until no pair is left.
+
+    decide(previous, current) returns (drop_current, reason) arrays for the pairs: if
+    drop_current is False the previous row is dropped. When a row is dropped by both its
+    pairs the one with the following row wins, as it is evaluated last."""
+    while True:
+        previous, current = _close_pairs(alive, patients, dates, days_cutoff)
+        if not len(previous):
+            return
+        drop_current, pair_reason = decide(previous, current)
+        reason[current[drop_current]] = pair_reason[drop_current]
+        reference[current[drop_current]] = previous[drop_current]
+        reason[previous[~drop_current]] = pair_reason[~drop_current]
+        reference[previous[~drop_current]] = current[~drop_current]
+        alive[current[drop_current]] = False
+        alive[previous[~drop_current]] = False
+
+
+def _find_duplicated(df, days_cutoff=30, resistance_wise=True, group_cols=None):
+    """Return the positions of the rows of df in output order (by patient and
+    data_prelievo) and the drop reason of each of them (pd.NA if the row is kept)."""
+    group_cols = group_cols if group_cols is not None else _patient_cols(df)
+    positions, patients = _sort_by_patient_and_date(df, group_cols)
+    dates = (
+        df.data_prelievo.to_numpy()[positions].astype("datetime64[ns]").astype(np.int64)
+    )
+    reason = np.full(len(positions), _NO_REASON, dtype=np.int8)
+    reference = np.full(len(positions), -1, dtype=np.int64)
+    alive = np.ones(len(positions), dtype=bool)
+
+    if not resistance_wise:
+        _sweep(
+            alive,
+            patients,
+            dates,
+            days_cutoff,
+            reason,
+            reference,
+            lambda previous, current: (
+                np.ones(len(current), dtype=bool),
+                np.full(len(current), 1, dtype=np.int8),
+            ),
         )
-        for (previous_index, previous_row), (index, row) in itertools.pairwise(
-            zip(indexes, rows)
-        ):
-            if (row.data_prelievo - previous_row.data_prelievo).days < days_cutoff:
-                if row.n_resistenze > previous_row.n_resistenze:
-                    df.loc[previous_index, drop_column] = (
-                        f'Duplicato di id_richiesta: {row.id_richiesta} (data prelievo: {row.data_prelievo.strftime("%Y-%m-%d")}), che ha più resistenze'
-                    )
-                elif row.n_resistenze < previous_row.n_resistenze:
-                    df.loc[index, drop_column] = (
-                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), che aveva più resistenze'
-                    )
-                else:
-                    df.loc[index, drop_column] = (
-                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), entrambi con lo stesso numero di resistenze'
-                    )
-                next_iteration = True
-            not_drop_df = df[df[drop_column].isnull()]
-
-    # Ora eliminiamo tutti i duplicati tenendo i primi resistenti in ordine cronologico, se non ci sono resistenti teniamo i primi in ordine cronologico
-    next_iteration = True
-    while next_iteration:
-        next_iteration = False
-        indexes, rows = list(zip(*not_drop_df.iterrows()))
-        for (previous_index, previous_row), (index, row) in itertools.pairwise(
-            zip(indexes, rows)
-        ):
-            if (row.data_prelievo - previous_row.data_prelievo).days < days_cutoff:
-                if previous_row.resistente and row.resistente:
-                    raise ValueError(
-                        "There should not be two consecutive resistant rows"
-                    )
-                elif previous_row.resistente and not row.resistente:
-                    df.loc[index, drop_column] = (
-                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), che era resistente'
-                    )
-                elif not previous_row.resistente and row.resistente:
-                    df.loc[previous_index, drop_column] = (
-                        f'Duplicato di id_richiesta: {row.id_richiesta} (data prelievo: {row.data_prelievo.strftime("%Y-%m-%d")}), che è/sarà resistente'
-                    )
-                else:
-                    df.loc[index, drop_column] = (
-                        f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")}), entrambi non resistenti'
-                    )
-                next_iteration = True
-            not_drop_df = df[df[drop_column].isnull()]
+    else:
+        resistant = df.resistente.astype(bool).to_numpy()[positions]
+        n_resistenze = df.n_resistenze.to_numpy(dtype=float)[positions]
+
+        def decide_resistant(previous, current):
+            more = n_resistenze[current] > n_resistenze[previous]
+            less = n_resistenze[current] < n_resistenze[previous]
+            return ~more, np.select([more, less], [2, 3], 4).astype(np.int8)
+
+        def decide_all(previous, current):
+            if (resistant[previous] & resistant[current]).any():
+                raise ValueError("There should not be two consecutive resistant rows")
+            previous_only = resistant[previous] & ~resistant[current]
+            current_only = ~resistant[previous] & resistant[current]
+            return ~current_only, np.select(
+                [previous_only, current_only], [5, 6], 7
+            ).astype(np.int8)
+
+        # Prima di tutto eliminiamo i duplicati resistenti tenendo i primi in ordine cronologico
+        resistant_alive = alive & resistant
+        _sweep(
+            resistant_alive,
+            patients,
+            dates,
+            days_cutoff,
+            reason,
+            reference,
+            decide_resistant,
+        )
+        alive &= ~resistant | resistant_alive
+        # Ora eliminiamo tutti i duplicati tenendo i primi resistenti in ordine cronologico, se non ci sono resistenti teniamo i primi in ordine cronologico
+        _sweep(
+            alive,
+            patients,
+            dates,
+            days_cutoff,
+            reason,
+            reference,
+            decide_all,
+        )
+
+    reasons = np.full(len(positions), pd.NA, dtype=object)
+    dropped = np.flatnonzero(reason != _NO_REASON)
+    referenced = df.iloc[positions[reference[dropped]]]
+    reasons[dropped] = [
+        f'Duplicato di id_richiesta: {id_richiesta} (data prelievo: {data_prelievo.strftime("%Y-%m-%d")}){_REASONS[r]}'
+        for id_richiesta, data_prelievo, r in zip(
+            referenced.id_richiesta, referenced.data_prelievo, reason[dropped]
+        )
+    ]
+    return positions, reasons
+
+
+def _drop_duplicated(df, days_cutoff, drop_column, resistance_wise, cache=None):
+    if cache is None:
+        positions, reasons = _find_duplicated(
+            df, days_cutoff=days_cutoff, resistance_wise=resistance_wise
+        )
+    else:
+        positions, reasons = cache.find_duplicated(
+            df, days_cutoff=days_cutoff, resistance_wise=resistance_wise
+        )
+    df = df.iloc[positions].reset_index(drop=True)
+    df[drop_column] = reasons
     return df
 
 
@@ -77,53 +182,293 @@ def filter_query_repeated_isolation_in_patients_lt_1_month_resistance_wise(
     days_cutoff=30,
     drop_column="to_drop",
 ):
-    df = df.copy()
-    df[drop_column] = pd.NA
-    group_cols = ["cognome_paziente", "nome_paziente", "data_nascita"]
-    return (
-        df.groupby(group_cols, as_index=False)
-        .apply(
-            _drop_duplicated_resistance_wise,
-            days_cutoff=days_cutoff,
-            drop_column=drop_column,
-        )
-        .reset_index(drop=True)
+    """drop duplicates keeping the first resistant in chronological order"""
+    return _drop_duplicated(
+        df, days_cutoff=days_cutoff, drop_column=drop_column, resistance_wise=True
     )
 
 
-def _drop_duplicated_no_resistance(df, days_cutoff=30, drop_column="to_drop"):
+def filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance(
+    df, days_cutoff=30, drop_column="to_drop"
+):
     """drop duplicates keeping the first in chronological order"""
-    df = df.sort_values("data_prelievo")
-    # eliminiamo tutti i duplicati tenendo i primi in ordine cronologico
-    next_iteration = True
-    not_drop_df = df[df[drop_column].isnull()]
-    while next_iteration:
-        next_iteration = False
-        indexes, rows = list(zip(*not_drop_df.iterrows()))
-        for (previous_index, previous_row), (index, row) in itertools.pairwise(
-            zip(indexes, rows)
-        ):
-            if (row.data_prelievo - previous_row.data_prelievo).days < days_cutoff:
-                df.loc[index, drop_column] = (
-                    f'Duplicato di id_richiesta: {previous_row.id_richiesta} (data prelievo: {previous_row.data_prelievo.strftime("%Y-%m-%d")})'
+    return _drop_duplicated(
+        df, days_cutoff=days_cutoff, drop_column=drop_column, resistance_wise=False
+    )
+
+
+def _patient_histories(df, resistance_wise=True):
+    """(positions, bounds, histories) of the rows of df with a patient_key: positions grouped by
+    patient in increasing patient_key and in frame order within a patient, the rows of the i-th
+    patient at positions[bounds[i]:bounds[i + 1]] and histories[i] a hash of the values of
+    those rows that _find_duplicated reads (blake2b of their row hashes, as fingerprint). The
+    deduplication of a patient only depends on its history, whatever frame (and patient_key)
+    its rows come from."""
+    codes = df[_PATIENT_KEY]
+    valid = np.flatnonzero(codes.notna().to_numpy())
+    codes = codes.to_numpy()[valid].astype(np.int64)
+    order = np.argsort(codes, kind="stable")
+    positions, codes = valid[order], codes[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]][: len(codes)])
+    bounds = np.append(starts, len(positions))
+    cols = ["data_prelievo", "id_richiesta"]
+    if resistance_wise:
+        cols += ["resistente", "n_resistenze"]
+    hashes = pd.util.hash_pandas_object(
+        df[cols].iloc[positions], index=False
+    ).to_numpy()
+    histories = [
+        hashlib.blake2b(hashes[start:stop].tobytes(), digest_size=16).digest()
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    return positions, bounds, histories
+
+
+class _dedup_cache:
+    """Memoize the deduplication of the same rows with the same parameters.
+
+    The key is (resistance_wise, days_cutoff, fingerprint of the rows), where the
+    fingerprint hashes the index and the columns the deduplication reads, so the same
+    tag/gruppo microbo subset is deduplicated once per run even if it is requested by
+    more instructions or rate instructions.
+
+    With patient_histories the deduplication of each patient is also kept by patient history
+    (see _patient_histories) and only the patients with a new history are deduplicated: the
+    reports of the months of a year share most of their patients with the same rows."""
+
+    def __init__(self, patient_histories=False):
+        self._results = {}
+        # (resistance_wise, days_cutoff) -> {history: (order, reasons) of the patient's rows}
+        self._histories = {} if patient_histories else None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(df, resistance_wise=True):
+        cols = _patient_cols(df) + ["data_prelievo", "id_richiesta"]
+        if resistance_wise:
+            cols += ["resistente", "n_resistenze"]
+        hashes = pd.util.hash_pandas_object(df[cols], index=True).to_numpy()
+        return hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest()
+
+    def find_duplicated(self, df, days_cutoff=30, resistance_wise=True):
+        key = (resistance_wise, days_cutoff, self.fingerprint(df, resistance_wise))
+        if key in self._results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if self._histories is not None and _PATIENT_KEY in df.columns:
+                histories = _patient_histories(df, resistance_wise)
+                new = self._new_histories(df, histories, days_cutoff, resistance_wise)
+                if len(new):
+                    self._remember(
+                        new,
+                        *_find_duplicated(
+                            new,
+                            days_cutoff=days_cutoff,
+                            resistance_wise=resistance_wise,
+                        ),
+                        days_cutoff,
+                        resistance_wise,
+                    )
+                self._results[key] = self._from_histories(
+                    histories, days_cutoff, resistance_wise
                 )
-                next_iteration = True
-            not_drop_df = df[df[drop_column].isnull()]
-    return df
+            else:
+                self._results[key] = _find_duplicated(
+                    df, days_cutoff=days_cutoff, resistance_wise=resistance_wise
+                )
+        return self._results[key]
 
+    def _new_histories(self, df, histories, days_cutoff, resistance_wise):
+        """The rows of df of the patients whose history was never deduplicated"""
+        known = self._histories.setdefault((resistance_wise, days_cutoff), {})
+        positions, bounds, histories = histories
+        new = [
+            positions[start:stop]
+            for start, stop, history in zip(bounds[:-1], bounds[1:], histories)
+            if history not in known
+        ]
+        return df.iloc[np.sort(np.concatenate(new))] if new else df.iloc[:0]
 
-def filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance(
-    df, days_cutoff=30, drop_column="to_drop"
-):
-    df = df.copy()
-    df[drop_column] = pd.NA
-    group_cols = ["cognome_paziente", "nome_paziente", "data_nascita"]
-    return (
-        df.groupby(group_cols, as_index=False)
-        .apply(
-            _drop_duplicated_no_resistance,
+    def _remember(self, df, positions, reasons, days_cutoff, resistance_wise):
+        """Keep by patient history the deduplication (positions, reasons) of df"""
+        known = self._histories.setdefault((resistance_wise, days_cutoff), {})
+        patient_positions, bounds, histories = _patient_histories(df, resistance_wise)
+        # _find_duplicated gives the patients in the same order, each one with all its rows
+        for start, stop, history in zip(bounds[:-1], bounds[1:], histories):
+            known[history] = (
+                np.searchsorted(patient_positions[start:stop], positions[start:stop]),
+                reasons[start:stop],
+            )
+
+    def _from_histories(self, histories, days_cutoff, resistance_wise):
+        """(positions, reasons) of _find_duplicated from the known patient histories"""
+        known = self._histories[(resistance_wise, days_cutoff)]
+        positions, bounds, histories = histories
+        if not histories:
+            return positions, np.full(0, pd.NA, dtype=object)
+        parts = [
+            (positions[start:stop][known[history][0]], known[history][1])
+            for start, stop, history in zip(bounds[:-1], bounds[1:], histories)
+        ]
+        return tuple(np.concatenate(part) for part in zip(*parts))
+
+    def trim(self, max_results, max_histories):
+        """Forget the oldest results beyond max_results and the oldest patient histories beyond
+        max_histories (for each days_cutoff and resistance_wise). The keys are the content of
+        the rows, never of where they come from, so what is kept is never wrong after the data
+        change: a forgotten entry is only computed again."""
+        caches = [(self._results, max_results)] + [
+            (known, max_histories) for known in (self._histories or {}).values()
+        ]
+        for cache, max_entries in caches:
+            for key in list(itertools.islice(cache, max(len(cache) - max_entries, 0))):
+                del cache[key]
+
+    def prefetch(self, requests, executor, min_rows=None):
+        """Deduplicate at once the (df, days_cutoff, resistance_wise) requests, e.g. the rows
+        of every instruction, so that the following find_duplicated calls are hits.
+
+        The patients are split by a hash of patient_key in one shard per worker and the
+        shards are deduplicated in parallel by executor (a _shared_frame with the processes
+        backend). The deduplication of a patient only depends on the rows of that patient,
+        so merging the shards by patient gives the same result as the serial
+        _find_duplicated. Nothing is done if executor would run serially (at least
+        min_rows rows per worker, default _MIN_ROWS_PER_SHARD) or if the rows have no
+        patient_key: the requests are then computed one by one when asked."""
+        pending = {}
+        for df, days_cutoff, resistance_wise in requests:
+            if _PATIENT_KEY not in df.columns:
+                return
+            key = (resistance_wise, days_cutoff, self.fingerprint(df, resistance_wise))
+            if key not in self._results:
+                pending[key] = df
+        # With patient histories the shards only get the patients with a new history
+        histories, todo = {}, pending
+        if self._histories is not None:
+            histories = {
+                key: _patient_histories(df, key[0]) for key, df in pending.items()
+            }
+            todo = {
+                key: self._new_histories(df, histories[key], key[1], key[0])
+                for key, df in pending.items()
+            }
+        size = sum(len(df) for df in todo.values())
+        n_shards = executor.n_workers(
+            size, size, min_rows if min_rows is not None else _MIN_ROWS_PER_SHARD
+        )
+        if n_shards <= 1:
+            return
+
+        # One table with the rows of all the requests, grouped by shard
+        table = pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        "request": i,
+                        "position": np.arange(len(df)),
+                        _PATIENT_KEY: df[_PATIENT_KEY].to_numpy(),
+                        "data_prelievo": df.data_prelievo.to_numpy(),
+                        "id_richiesta": df.id_richiesta.to_numpy(dtype=object),
+                        "resistente": (
+                            df.resistente.to_numpy(dtype=object)
+                            if resistance_wise
+                            else None
+                        ),
+                        "n_resistenze": (
+                            df.n_resistenze.to_numpy(dtype=float)
+                            if resistance_wise
+                            else np.nan
+                        ),
+                    }
+                )
+                for i, ((resistance_wise, _, _), df) in enumerate(todo.items())
+            ],
+            ignore_index=True,
+        )
+        # Rows without patient are never in the output of _find_duplicated
+        table = table[table[_PATIENT_KEY].notna()]
+        shard = (
+            pd.util.hash_array(table[_PATIENT_KEY].to_numpy(dtype=np.int64)) % n_shards
+        )
+        table = table.iloc[np.argsort(shard, kind="stable")].reset_index(drop=True)
+        bounds = np.searchsorted(np.sort(shard), np.arange(n_shards + 1))
+        parameters = [
+            (i, days_cutoff, resistance_wise)
+            for i, (resistance_wise, days_cutoff, _) in enumerate(todo)
+        ]
+        shards = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        if executor.backend == "processes":
+            with _shared_frame(table) as shared:
+                results = executor.map(
+                    _find_duplicated_shard,
+                    [(shared.rows(*rows), parameters, True) for rows in shards],
+                )
+        else:
+            results = executor.map(
+                _find_duplicated_shard,
+                [(table.iloc[slice(*rows)], parameters, False) for rows in shards],
+            )
+
+        # Merge the shards: patients in increasing patient_key, each patient comes from a
+        # single shard where its rows are already in order
+        results = [
+            tuple(np.concatenate(part) for part in zip(*parts))
+            for parts in zip(*results)
+        ]
+        for key, (patients, positions, reasons) in zip(todo, results):
+            order = np.argsort(patients, kind="stable")
+            if self._histories is None:
+                self._results[key] = (positions[order], reasons[order])
+            else:
+                self._remember(
+                    todo[key], positions[order], reasons[order], key[1], key[0]
+                )
+        for key in histories:
+            self._results[key] = self._from_histories(histories[key], key[1], key[0])
+        self.misses += len(pending)
+
+    def resistance_wise(self, df, days_cutoff=30, drop_column="to_drop"):
+        """Cached filter_query_repeated_isolation_in_patients_lt_1_month_resistance_wise"""
+        return _drop_duplicated(
+            df,
             days_cutoff=days_cutoff,
             drop_column=drop_column,
+            resistance_wise=True,
+            cache=self,
         )
-        .reset_index(drop=True)
-    )
+
+    def no_resistance(self, df, days_cutoff=30, drop_column="to_drop"):
+        """Cached filter_query_repeated_isolation_in_patients_lt_1_month_no_resistance"""
+        return _drop_duplicated(
+            df,
+            days_cutoff=days_cutoff,
+            drop_column=drop_column,
+            resistance_wise=False,
+            cache=self,
+        )
+
+
+def _find_duplicated_shard(rows, parameters, shared):
+    """_find_duplicated of each request on the rows of a shard (a _shared_frame range if
+    shared). Returns, for each request, the patient_key, the position in the request and the
+    drop reason of the rows in output order."""
+    table = _read_shared(*rows) if shared else rows
+    results = []
+    for request, days_cutoff, resistance_wise in parameters:
+        df = table[table.request.to_numpy() == request]
+        positions, reasons = _find_duplicated(
+            df,
+            days_cutoff=days_cutoff,
+            resistance_wise=resistance_wise,
+            group_cols=[_PATIENT_KEY],
+        )
+        results.append(
+            (
+                df[_PATIENT_KEY].to_numpy(dtype=np.int64)[positions],
+                df.position.to_numpy()[positions],
+                reasons,
+            )
+        )
+    return results
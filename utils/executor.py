@@ -0,0 +1,193 @@
+import concurrent.futures
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+_BACKENDS = ("serial", "threads", "processes")
+
+
+class _executor:
+    """Run independent tasks serially, in a pool of threads or in a pool of processes.
+
+    A task is a tuple of arguments of a module level function (so that it can be pickled
+    for the processes backend). The tasks run serially if there is a single worker or if
+    the work is too small to pay off the parallel overhead: at most size // min_size
+    workers are used."""
+
+    def __init__(self, backend="processes", workers=None):
+        if backend not in _BACKENDS:
+            raise ValueError(
+                f"Backend non valido: {backend}, deve essere uno tra {', '.join(_BACKENDS)}"
+            )
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+
+    def n_workers(self, n_tasks, size=None, min_size=None):
+        if self.backend == "serial":
+            return 1
+        workers = min(self.workers, n_tasks)
+        if size is not None and min_size:
+            workers = min(workers, size // min_size)
+        return max(workers, 1)
+
+    def _run(self, fn, tasks, workers):
+        if workers <= 1:
+            for i, task in enumerate(tasks):
+                yield i, lambda task=task: fn(*task)
+            return
+        pool = (
+            concurrent.futures.ThreadPoolExecutor
+            if self.backend == "threads"
+            else concurrent.futures.ProcessPoolExecutor
+        )
+        with pool(max_workers=workers) as executor:
+            futures = {executor.submit(fn, *task): i for i, task in enumerate(tasks)}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result
+
+    def run(self, fn, tasks, size=None, min_size=None):
+        """Yield (task, wait) in order of completion, wait() returns fn(*task) or raises
+        its exception"""
+        tasks = list(tasks)
+        workers = self.n_workers(len(tasks), size, min_size)
+        for i, wait in self._run(fn, tasks, workers):
+            yield tasks[i], wait
+
+    def map(self, fn, tasks, size=None, min_size=None):
+        """[fn(*task) for task in tasks], the first exception is raised"""
+        tasks = list(tasks)
+        workers = self.n_workers(len(tasks), size, min_size)
+        results = [None] * len(tasks)
+        for i, wait in self._run(fn, tasks, workers):
+            results[i] = wait()
+        return results
+
+    def groupby_apply(self, df, by, fn, min_groups=1, **kwargs):
+        """df.groupby(by, as_index=False).apply(fn, **kwargs) with the groups split in
+        contiguous ranges of group ids, one task per range instead of one per group.
+        Concatenated in order, the ranges give the same rows of a single groupby.
+
+        With the processes backend df is not pickled to the workers: it is written once to a
+        _shared_frame and each task only carries its range of rows. The results come back in
+        columnar form (see _to_columnar)."""
+        group_ids = (
+            df.groupby(by, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        )
+        n_groups = group_ids.max() + 1 if len(group_ids) else 0
+        workers = self.n_workers(n_groups, n_groups, min_groups)
+        if workers <= 1:
+            return _groupby_apply(df, by, fn, kwargs)
+        # Rows sorted by group id (stable, each group keeps the order of its rows), so that a
+        # range of groups is a range of rows. Rows with missing keys are in no group.
+        order = np.argsort(group_ids, kind="stable")
+        order = order[group_ids[order] >= 0]
+        df = df.iloc[order]
+        # A few ranges per worker, so that a slow range does not keep the others waiting
+        row_bounds = np.searchsorted(
+            group_ids[order],
+            np.linspace(0, n_groups, workers * 4 + 1).astype(np.int64),
+        )
+        ranges = [
+            (start, stop)
+            for start, stop in zip(row_bounds[:-1], row_bounds[1:])
+            if stop > start
+        ]
+        if self.backend != "processes":
+            tasks = [(df.iloc[start:stop], by, fn, kwargs) for start, stop in ranges]
+            results = self.map(
+                _groupby_apply, tasks, size=n_groups, min_size=min_groups
+            )
+            return pd.concat(results, ignore_index=True)
+        with _shared_frame(df) as shared:
+            tasks = [
+                (shared.rows(start, stop), by, fn, kwargs) for start, stop in ranges
+            ]
+            results = self.map(
+                _shared_groupby_apply, tasks, size=n_groups, min_size=min_groups
+            )
+        return pd.concat(
+            [_from_columnar(*result) for result in results], ignore_index=True
+        )
+
+
+def _groupby_apply(df, by, fn, kwargs):
+    return df.groupby(by, as_index=False).apply(fn, **kwargs)
+
+
+def _shared_groupby_apply(rows, by, fn, kwargs):
+    return _to_columnar(_groupby_apply(_read_shared(*rows), by, fn, kwargs))
+
+
+def _to_columnar(df):
+    """(table, pickled, dtypes): the columns of df as an Arrow table (strings dictionary
+    encoded), the object columns Arrow cannot hold (values of mixed types, e.g. bool and
+    str) as a plain frame and the dtypes to restore with _from_columnar"""
+    arrays, pickled = {}, []
+    for c in df.columns:
+        try:
+            arrays[c] = pa.array(df[c], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pickled.append(c)
+            continue
+        # Repeated strings (reparti, microbi, ...) are stored once
+        if pa.types.is_string(arrays[c].type) or pa.types.is_large_string(
+            arrays[c].type
+        ):
+            arrays[c] = arrays[c].dictionary_encode()
+    return (
+        pa.table(arrays) if arrays else pa.table({}),
+        df[pickled].reset_index(drop=True),
+        df.dtypes.to_dict(),
+    )
+
+
+def _from_columnar(table, pickled, dtypes):
+    """The frame given to _to_columnar, with a RangeIndex. Missing values of object columns
+    are pd.NA."""
+    df = table.to_pandas() if table.num_columns else pd.DataFrame(index=pickled.index)
+    for c in pickled.columns:
+        df[c] = pickled[c]
+    df = df[list(dtypes)]
+    for c, dtype in dtypes.items():
+        if c in pickled.columns:
+            continue
+        if dtype == object:
+            df[c] = df[c].astype(object).where(df[c].notna(), pd.NA)
+        elif df[c].dtype != dtype:
+            df[c] = df[c].astype(dtype)
+    return df
+
+
+class _shared_frame:
+    """A frame written once to an Arrow IPC file in a temporary folder, that worker processes
+    memory-map instead of receiving its rows pickled: a task only carries rows(start, stop).
+    The columns Arrow cannot hold are still pickled, only the rows of the task. Use it as a
+    context manager, the file is deleted on exit."""
+
+    def __init__(self, df):
+        table, self._pickled, self._dtypes = _to_columnar(df)
+        self._folder = tempfile.mkdtemp(prefix="shared_frame_")
+        self.path = os.path.join(self._folder, "frame.arrow")
+        with pa.OSFile(self.path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    def rows(self, start, stop):
+        return self.path, start, stop, self._pickled.iloc[start:stop], self._dtypes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self._folder, ignore_errors=True)
+
+
+def _read_shared(path, start, stop, pickled, dtypes):
+    """Rows [start, stop) of a _shared_frame, read in a worker"""
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all().slice(start, stop - start)
+        return _from_columnar(table, pickled.reset_index(drop=True), dtypes)
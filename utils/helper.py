@@ -1,22 +1,70 @@
 import json
 import os
 from typing import Iterable, Optional, Union
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from .duplicated_fns import _PATIENT_COLS, _PATIENT_KEY
+from .executor import _executor
 from collections import Counter
+import dataclasses
 import hashlib
+import importlib
+import inspect
+import itertools
+import re
+import shutil
+import types
 
 
-_utils_listdir_to_monitor = [
-    ["utils", f]
-    for f in os.listdir("utils")
-    if not (os.path.isdir(f) or f.startswith("__"))
-]
-_additional_to_monitor = []
-
-_monitor_cache_files = _utils_listdir_to_monitor + _additional_to_monitor
+# What each cached stage depends on: files in utils and the code of its entry points, i.e. the
+# functions, classes and constants of this package their code reaches (see _code_dependencies). A
+# change to any of them invalidates only the artifacts of that stage (e.g. the excel formatting
+# code never forces to reprocess the csv files)
+_CACHE_STAGES = {
+    "ingestion": dict(
+        files=[
+            "columns_mapper.csv",
+            "materiale_mapper.csv",
+            "microbo_mapper.csv",
+            "date_formats.csv",
+        ],
+        functions=["_ingest_file"],
+    ),
+    # Entry points in check_resistance, see load_isolates: the partition is read, its dtypes
+    # made compact, checked and classified with the rules loaded by load_resistance_rules
+    "classification": dict(
+        module="check_resistance",
+        files=["resistance_rules.csv"],
+        functions=["_classify_partition", "load_resistance_rules"],
+    ),
+    # The whole analysis, see _report_key
+    "report": dict(
+        files=[
+            "analyze.py",
+            "check_resistance.py",
+            "duplicated_fns.py",
+            "helper.py",
+            "instructions.py",
+            "report_helper.py",
+            "antibiotico_mapper.csv",
+            "columns_mapper.csv",
+            "date_formats.csv",
+            "materiale_mapper.csv",
+            "microbo_mapper.csv",
+            "resistance_rules.csv",
+            "widths.csv",
+        ],
+        functions=[],
+    ),
+}
 
-_CURRENT_VERSION_HASHES = {}
-_CACHED_VERSION_HASHES = {}
+# version.json: {"stages": {stage: {dependency: fingerprint}}, "files": {data file: fingerprint},
+# "isolates": {partition: key of its classified isolates}, "reports": {output file: key of the report}}
+_CURRENT_VERSION = {"stages": {}, "files": {}, "isolates": {}, "reports": {}}
+_CACHED_VERSION = {}
 
 
 def generate_excel_output_filename(excel_output_folder_name, year, month):
@@ -27,12 +75,29 @@ def generate_excel_output_filename(excel_output_folder_name, year, month):
     )
 
 
+def generate_columnar_output_filenames(
+    excel_output_folder_name, year, month, output_format
+):
+    """{table: path} of the overall, overall_rates and details tables of the report in the
+    given columnar format, in a folder named as the excel file"""
+    folder = os.path.splitext(
+        generate_excel_output_filename(excel_output_folder_name, year, month)
+    )[0]
+    os.makedirs(folder, exist_ok=True)
+    return {
+        table: os.path.join(folder, f"{table}.{output_format}")
+        for table in ("overall", "overall_rates", "details")
+    }
+
+
 def check_parameters(**kwargs):
     month = kwargs.get("month")
     year = kwargs.get("year")
     if month is not None:
         if not 1 <= month <= 12:
             raise ValueError("Il mese deve essere compreso tra 1 e 12")
+        if kwargs.get("all_periods"):
+            raise ValueError("--all-periods non può essere usato insieme a --month")
     if year < 1900:
         raise ValueError("L'anno deve essere maggiore di 1900")
     if year > pd.Timestamp.now().year:
@@ -47,26 +112,126 @@ def check_total_df(total_df):
     ), "data_prelievo contains null values"
     assert not (
         total_df[total_df.id_gruppo_microbo == "esccol"]
-        .groupby(["id_esame", "id_gruppo_microbo", "nome_gruppo_microbo"])
+        .groupby(
+            ["id_esame", "id_gruppo_microbo", "nome_gruppo_microbo"], observed=True
+        )
         .esbl.nunique()
         != 1
     ).any(), "esbl is not unique for esccol"
     assert not (
         total_df.groupby(
-            ["id_esame", "id_gruppo_microbo", "nome_gruppo_microbo"]
+            ["id_esame", "id_gruppo_microbo", "nome_gruppo_microbo"], observed=True
         ).data_prelievo.nunique()
         != 1
     ).any(), "data_prelievo is not unique"
 
 
-def _check_current_version_hash():
-    ret = {}
-    for path, file in _monitor_cache_files:
-        with open(os.path.join(path, file), "rb") as f:
-            file_hash = hashlib.md5(
-                f.read().decode("utf-8", errors="ignore").encode("utf-8")
-            ).hexdigest()
-            ret[file] = file_hash
+def _hash_file(path):
+    """blake2b of the raw bytes of path, read in chunks"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _get_fingerprint_for_file(path, cached=None):
+    """Manifest entry of path: size, mtime_ns and hash of its content. If the cached entry
+    has the same size and mtime_ns its hash is reused and the file is not read."""
+    try:
+        stat = os.stat(path)
+        if (
+            isinstance(cached, dict)
+            and cached.get("size") == stat.st_size
+            and cached.get("mtime_ns") == stat.st_mtime_ns
+        ):
+            return cached
+        return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, hash=_hash_file(path))
+    except Exception as e:
+        print(f'Error loading file "{path}": {e}')
+        return None
+
+
+def _same_content(fingerprint, cached):
+    return (
+        isinstance(fingerprint, dict)
+        and isinstance(cached, dict)
+        and fingerprint["hash"] == cached.get("hash")
+    )
+
+
+# Module-level values hashed with their repr by _code_dependencies (not sets, their repr
+# changes with the hash seed)
+_CONSTANT_TYPES = (str, bytes, int, float, bool, type(None), list, tuple, dict)
+
+
+def _global_names(code):
+    """Global (and attribute) names used by code and by the functions, lambdas and
+    comprehensions defined in it"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _code_dependencies(names, namespace):
+    """{dependency: source} of the functions and classes of this package reachable from the
+    given names of namespace, following the global names used by their code (also through
+    the methods of the classes and into the other modules of the package), and of the
+    constants they use (their repr). Everything outside the package is left out, as the
+    module-level frames read from the csv files in utils: those files are dependencies of
+    the stages on their own."""
+    package = __name__.rpartition(".")[0]
+    found = {}
+    pending = [(name, namespace) for name in names]
+    while pending:
+        name, namespace = pending.pop()
+        if name not in namespace:
+            continue
+        obj = namespace[name]
+        if isinstance(obj, (types.FunctionType, type)):
+            if obj.__module__.rpartition(".")[0] != package:
+                continue
+            key = f"{obj.__module__.rpartition('.')[2]}.{obj.__qualname__}"
+            if key in found:
+                continue
+            found[key] = inspect.getsource(obj)
+            functions = [obj]
+            if isinstance(obj, type):
+                functions = [
+                    getattr(f, "__func__", getattr(f, "fget", f))
+                    for f in vars(obj).values()
+                ]
+            for f in functions:
+                if isinstance(f, types.FunctionType):
+                    pending += [(n, f.__globals__) for n in _global_names(f.__code__)]
+        elif isinstance(obj, _CONSTANT_TYPES) or dataclasses.is_dataclass(obj):
+            found.setdefault(
+                f"{namespace['__name__'].rpartition('.')[2]}.{name}", repr(obj)
+            )
+    return found
+
+
+def _check_current_version_hash(stage):
+    cached = _CACHED_VERSION.get("stages", {}).get(stage, {})
+    namespace = (
+        vars(importlib.import_module(f".{_CACHE_STAGES[stage]['module']}", __package__))
+        if "module" in _CACHE_STAGES[stage]
+        else globals()
+    )
+    ret = {
+        file: _get_fingerprint_for_file(
+            _generate_csv_legend_path(file), cached.get(file)
+        )
+        for file in _CACHE_STAGES[stage]["files"]
+    }
+    for name, source in _code_dependencies(
+        _CACHE_STAGES[stage]["functions"], namespace
+    ).items():
+        ret[name] = dict(
+            hash=hashlib.blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+        )
     return ret
 
 
@@ -79,44 +244,121 @@ def _get_cached_version():
         return {}
 
 
-def _get_hash_for_file(file):
-    try:
-        with open(file, "rb") as f:
-            return hashlib.md5(
-                f.read().decode("utf-8", errors="ignore").encode("utf-8")
-            ).hexdigest()
-    except Exception as e:
-        print(f'Error loading file "{file}": {e}')
-        return None
-
-
-def _check_cached_version(silent=False):
-    global _CURRENT_VERSION_HASHES, _CACHED_VERSION_HASHES
+def _check_cached_version(stage, silent=False):
+    global _CACHED_VERSION
 
-    _CURRENT_VERSION_HASHES = _check_current_version_hash()
-    _CACHED_VERSION_HASHES = _get_cached_version()
+    _CACHED_VERSION = _get_cached_version()
+    current = _check_current_version_hash(stage)
+    _CURRENT_VERSION["stages"][stage] = current
+    cached = _CACHED_VERSION.get("stages", {}).get(stage, {})
 
-    for filename, hash in _CURRENT_VERSION_HASHES.items():
-        if filename not in _CACHED_VERSION_HASHES:
+    for name, fingerprint in current.items():
+        if name not in cached:
             if not silent:
                 print(
-                    f"File {filename} not in cached version, reprocess all files and update version.json"
+                    f"{name} not in cached version, reprocess {stage} and update version.json"
                 )
             return False
-        if hash != _CACHED_VERSION_HASHES[filename]:
+        if not _same_content(fingerprint, cached[name]):
             if not silent:
                 print(
-                    f"File {filename} has different hash, reprocess all files and update version.json"
+                    f"{name} has different hash, reprocess {stage} and update version.json"
                 )
             return False
     return True
 
 
-def _update_cached_version():
-    global _CURRENT_VERSION_HASHES
+def _get_cached_isolates(partition):
+    return _CACHED_VERSION.get("isolates", {}).get(partition, {})
+
 
+def _update_cached_version():
+    # Stages not checked in this run keep their cached version
+    version = dict(
+        stages={**_CACHED_VERSION.get("stages", {}), **_CURRENT_VERSION["stages"]},
+        files=_CURRENT_VERSION["files"],
+        isolates={
+            **_CACHED_VERSION.get("isolates", {}),
+            **_CURRENT_VERSION["isolates"],
+        },
+        reports={**_CACHED_VERSION.get("reports", {}), **_CURRENT_VERSION["reports"]},
+    )
     with open(os.path.join("_cached_data", "version.json"), "w") as f:
-        json.dump(_CURRENT_VERSION_HASHES, f)
+        json.dump(version, f)
+
+
+def _canonical(obj):
+    """JSON-serializable form of instructions and rate_instructions, functions (e.g.
+    select_fn) are represented by their source"""
+    if dataclasses.is_dataclass(obj):
+        return [
+            type(obj).__name__,
+            {f.name: _canonical(getattr(obj, f.name)) for f in dataclasses.fields(obj)},
+        ]
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(x) for x in obj]
+    if callable(obj):
+        try:
+            return inspect.getsource(obj)
+        except (OSError, TypeError):
+            return [obj.__code__.co_code.hex(), list(obj.__code__.co_names)]
+    return repr(obj)
+
+
+def _report_key(year, month, instructions, rate_instructions, **options):
+    """Key of the report of year/month: hash of the data files of the loaded months,
+    manual_db_adds.xlsx, instructions and rate_instructions, the options of analyze and the
+    report stage (the code and the files in utils)"""
+    _check_cached_version("report", silent=True)
+    low, high = _load_window(year, month)
+    window = range(
+        _convert_year_month_to_months(*low), _convert_year_month_to_months(*high)
+    )
+    sources = {
+        file: _get_fingerprint_for_file(
+            os.path.join("data", file), _CACHED_VERSION.get("files", {}).get(file)
+        )
+        for file, y, m in _data_files()
+        if _convert_year_month_to_months(y, m) in window
+    }
+    content = dict(
+        year=year,
+        month=month,
+        options=options,
+        sources={file: f and f["hash"] for file, f in sources.items()},
+        manual_db_adds=(_get_fingerprint_for_file("manual_db_adds.xlsx") or {}).get(
+            "hash"
+        ),
+        instructions=_canonical(list(instructions)),
+        rate_instructions=_canonical(list(rate_instructions)),
+        stage={
+            name: f and f["hash"]
+            for name, f in _CURRENT_VERSION["stages"]["report"].items()
+        },
+    )
+    return hashlib.blake2b(
+        json.dumps(content, sort_keys=True, default=repr).encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+
+
+def _check_cached_report(path, key):
+    """True if path is the report with the given key, as written by the last run"""
+    cached = _CACHED_VERSION.get("reports", {}).get(path, {})
+    return (
+        cached.get("key") == key
+        and os.path.exists(path)
+        and _same_content(
+            _get_fingerprint_for_file(path, cached.get("output")), cached.get("output")
+        )
+    )
+
+
+def _update_cached_report(path, key):
+    _CURRENT_VERSION["reports"][path] = dict(
+        key=key, output=_get_fingerprint_for_file(path)
+    )
+    _update_cached_version()
 
 
 def _generate_csv_legend_path(file: str) -> Union[str, os.PathLike]:
@@ -133,6 +375,41 @@ tags_materiale_mapper = pd.read_csv(
 microbo_mapper = pd.read_csv(
     _generate_csv_legend_path("microbo_mapper.csv"), index_col=0
 )
+# Formats of the date columns of the export, tried in order
+date_formats = (
+    pd.read_csv(_generate_csv_legend_path("date_formats.csv"), dtype=str)
+    .groupby("colonna", sort=False)
+    .formato.agg(list)
+    .to_dict()
+)
+# Each tag of materiale_mapper.csv is a bit of the tags mask
+tag_bits = {
+    tag: 1 << i
+    for i, tag in enumerate(
+        sorted(set(tags_materiale_mapper.explode().dropna().str.lower()))
+    )
+}
+if len(tag_bits) > 63:
+    raise ValueError("Too many tags in materiale_mapper.csv, at most 63 are supported")
+
+
+def encode_tags(tags: pd.Series) -> pd.Series:
+    """Bitmask of the "|" separated tags of each row, the split is done once per distinct value"""
+    codes, uniques = pd.factorize(tags)
+    masks = np.array(
+        [sum(tag_bits.get(tag, 0) for tag in set(u.split("|"))) for u in uniques]
+        + [0],  # codes is -1 for missing tags
+        dtype=np.int64,
+    )
+    return pd.Series(masks[codes], index=tags.index)
+
+
+def has_tag(df, tag: str) -> pd.Series:
+    """Boolean mask of the rows of df tagged with tag, using the tags_mask column if present"""
+    if tag not in tag_bits:
+        return df.tags.str.split("|").apply(lambda tags: tag in tags)
+    mask = df.tags_mask if "tags_mask" in df.columns else encode_tags(df.tags)
+    return (mask & tag_bits[tag]) != 0
 
 
 def _safe_decode(x: bytes):
@@ -149,67 +426,119 @@ def _clean_line(x:str):
 def _safe_decode_and_clean(x):
     return _clean_line(_safe_decode(x))
 
+def _count_fields(path) -> int:
+    """Most common number of fields of the lines of path, counted on the raw bytes (a comma
+    is the same byte in utf-8 and windows-1252). It takes a pass over the file of its own,
+    since the records can't be split before it is known: counting the commas is below 1% of
+    the time of _ingest_file (0.4 s of 100 s on a 570k-line export)."""
+    with open(path, "rb") as f:
+        c = Counter(line.count(b",") + 1 for line in f)
+    return c.most_common(1)[0][0]
+
+
+def _repair_record(line):
+    # A line (or the start of a broken record) with too many fields: keep the first fields and the last 5
+    end_tail = line.rsplit(",", 5)[1:]
+    start = line.split(",", 30)
+    for l in end_tail[::-1]:
+        start[len(start) - 1] = start[-1].replace(l, "").strip().strip(",").strip()
+    return start + end_tail
+
+
 def _custom_reader(path):
-    def gen_summed_lines(lines, i, j):
-        return "".join([lines[i + jj] for jj in range(j)])
+    """Yield the records of a Mercurio export one at a time.
 
+    Records broken on more lines (e.g. a newline inside a field) are joined back keeping a
+    running count of their fields, so each line is split only once and at most the lines
+    of a single record are kept in memory."""
+    n_expected_fields = _count_fields(path)
     with open(path, "rb") as f:
-        lines = f.readlines()
-    try:
-        lines = list(map(_safe_decode_and_clean, lines))
-    except UnicodeDecodeError:
-        print("Error decoding file: {}".format(path))
-
-    c = Counter(map(lambda x: len(x.split(",")), lines))
-    n_expected_fields = c.most_common(1)[0][0]
-    i = 0
-    while i < len(lines):
-        yielded = False
-        if len(lines[i].split(",")) == n_expected_fields:
-            yield lines[i].replace(';', '').strip().split(",")
-            i += 1
-            continue
-        else:
-            j = 1
-            summed_line = gen_summed_lines(lines, i, j)
-            while len(summed_line.split(",")) <= n_expected_fields:
-                if len(summed_line.split(",")) == n_expected_fields:
-                    yield summed_line.split(",")
-                    yielded = True
-                    i += j
-                    break
-                j += 1
-                summed_line = gen_summed_lines(lines, i, j)
-        if not yielded:
-            try:
-                end_tail = lines[i].rsplit(",", 5)[1:]
-                start = lines[i].split(",", 30)
-                for l in end_tail[::-1]:
-                    start[len(start) - 1] = (
-                        start[-1].replace(l, "").strip().strip(",").strip()
-                    )
-                yield start + end_tail
-            except Exception as e:
-                print(e)
-                print(lines[i])
-                print("Error")
-            i += j
-
-
-def _read_csv(path: Union[str, os.PathLike], **kwargs):
-    lines = [[cell.strip() for cell in line] for line in _custom_reader(path)]
-    df = pd.DataFrame(lines[1:], columns=lines[0], **kwargs).replace(
-        ["< >", "<null>"], pd.NA
+        pending = []  # lines of a broken record
+        n_fields = 0  # number of fields of "".join(pending)
+        for line in map(_safe_decode_and_clean, f):
+            if not pending:
+                n_fields = line.count(",") + 1
+                if n_fields == n_expected_fields:
+                    yield line.replace(";", "").strip().split(",")
+                elif n_fields < n_expected_fields:
+                    pending.append(line)
+                else:
+                    yield _repair_record(line)
+                continue
+            pending.append(line)
+            n_fields += line.count(",")
+            if n_fields == n_expected_fields:
+                yield "".join(pending).split(",")
+                pending = []
+            elif n_fields > n_expected_fields:
+                # The following lines don't complete the record: repair its first line and skip them
+                yield _repair_record(pending[0])
+                pending = []
+        if pending:
+            raise ValueError(
+                f'File "{path}" ends with an incomplete record: {"".join(pending)!r}'
+            )
+
+
+def _read_csv_batches(path: Union[str, os.PathLike], batch_size=100_000, **kwargs):
+    """Yield the records of path as DataFrames of at most batch_size rows (dates are not
+    parsed, see _read_csv)"""
+    records = _custom_reader(path)
+    columns = [cell.strip() for cell in next(records)]
+    while True:
+        batch = [
+            [cell.strip() for cell in record]
+            for record in itertools.islice(records, batch_size)
+        ]
+        if not batch:
+            return
+        # Short records are completed with None, as DataFrame does when they are not all short
+        batch = [record + [None] * (len(columns) - len(record)) for record in batch]
+        yield pd.DataFrame(batch, columns=columns, **kwargs).replace(
+            ["< >", "<null>"], pd.NA
+        )
+
+
+def _parse_dates(values: pd.Series, formats):
+    """Parse values trying the formats in order, each distinct value is parsed only once.
+    Return the dates (NaT where no format matches) and the number of rows that didn't match
+    any format with an example of them."""
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype="datetime64[ns]")
+    for fmt in formats:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(uniques[missing], format=fmt, errors="coerce")
+    # codes is -1 for missing values
+    dates = np.append(parsed.to_numpy(), np.datetime64("NaT", "ns"))[codes]
+    failed = np.flatnonzero(parsed.isna().to_numpy())
+    n_failed = np.isin(codes, failed).sum()
+    return (
+        pd.Series(dates, index=values.index, name=values.name),
+        n_failed,
+        uniques[failed[0]] if n_failed else None,
     )
-    for col in [
-        "Data di nascita",
-        "Data di ricovero",
-        "Data di dimissione",
-        "Data di accettazione",
-        "Data di prelievo",
-    ]:
-        df[col] = pd.to_datetime(df[col])
-    return df
+
+
+def _read_csv(path: Union[str, os.PathLike], batch_size=100_000, **kwargs):
+    """Yield the records of path as DataFrames of at most batch_size rows, with the dates
+    parsed with the formats in date_formats.csv. The formats are fixed, so each batch is parsed
+    on its own and gives the same dates as the whole column. The values that don't match any
+    format are reported once, after the last batch."""
+    failed = {col: (0, None) for col in date_formats}
+    for df in _read_csv_batches(path, batch_size=batch_size, **kwargs):
+        for col, formats in date_formats.items():
+            df[col], n_failed, example = _parse_dates(df[col], formats)
+            total, first = failed[col]
+            failed[col] = (total + n_failed, first if first is not None else example)
+        yield df
+    for col, (n_failed, example) in failed.items():
+        if n_failed:
+            print(
+                f'WARNING: {n_failed} values of "{col}" in "{path}" do not match any format of date_formats.csv and were left empty, e.g. "{example}"'
+            )
 
 
 def _rename_columns_and_add_missing_info(df):
@@ -238,54 +567,265 @@ def _rename_columns_and_add_missing_info(df):
     return df
 
 
-def _process_files(silent=False):
-    global _CURRENT_VERSION_HASHES
-    """read all csv files in "data" and process them. Process means that columns are renamed, observation are filtered according to month and file is saved as parquet file. Cached file named version.json is evaluated/updated."""
+_DATASET_FOLDER = os.path.join("_cached_data", "dataset")
+_ISOLATES_FOLDER = os.path.join("_cached_data", "isolates")
+# Rows of a row group of the cached dataset, also the records of an export read at a time by
+# _ingest_file (the peak memory of the ingestion grows with it, not with the size of the export)
+_ROW_GROUP_SIZE = 20_000
+# Columns always read by load_data, needed to filter and to merge manual_db_adds
+_LOAD_DATA_REQUIRED_COLUMNS = [
+    "id_richiesta",
+    "id_microbo",
+    "id_antibiotico",
+    "risultato_quantitativo",
+    "nome_reparto",
+    "data_prelievo",
+]
+
+# dtypes of the frame returned by load_data. Repeated values are categories (dictionary encoded
+# in the cache) with sorted categories, so that sort and groupby give the same order as with
+# plain strings; free text is string[pyarrow]
+_CATEGORY_COLUMNS = [
+    "id_antibiotico",
+    "nome_antibiotico",
+    "sesso",
+    "id_reparto",
+    "nome_reparto",
+    "id_analisi",
+    "nome_analisi",
+    "id_analisi_elementare",
+    "nome_analisi_elementare",
+    "id_materiale",
+    "nome_materiale",
+    "id_microbo",
+    "nome_microbo",
+    "betalattamasi",
+    "id_risultato",
+    "descrizione_risultato",
+    "int_risultato",
+    "microrganismo",
+    "materiale",
+    "analisi",
+    "tags",
+    "id_gruppo_microbo",
+    "nome_gruppo_microbo",
+    "source",
+]
+_STRING_COLUMNS = [
+    "id_esame",
+    "id_paziente",
+    "cognome_paziente",
+    "nome_paziente",
+    "id_richiesta",
+    "id_ricovero",
+    "info_risultato",
+]
+
+
+def _cache_schema(df) -> pa.Schema:
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in schema:
+        if field.name in _CATEGORY_COLUMNS:
+            field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        elif pa.types.is_null(field.type):
+            # Columns with only missing values are saved as string, as in the other partitions
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _sorted_categorical(s: pd.Series) -> pd.Series:
+    # astype(CategoricalDtype(...)) is a no-op on a categorical with the same categories in another order
+    s = s.astype("category").cat.remove_unused_categories()
+    return s.cat.reorder_categories(sorted(s.cat.categories))
+
+
+def _apply_compact_dtypes(df):
+    df = df.astype({c: "string[pyarrow]" for c in _STRING_COLUMNS if c in df.columns})
+    for c in _CATEGORY_COLUMNS:
+        if c in df.columns:
+            df[c] = _sorted_categorical(df[c])
+    if "esbl" in df.columns:
+        df["esbl"] = df.esbl.astype(bool if df.esbl.notna().all() else "boolean")
+    return df
+
+
+def _add_patient_key(df):
+    """Add patient_key, an integer key for (cognome_paziente, nome_paziente, data_nascita) in
+    the same order as the three columns sorted (missing if any of them is missing), so that
+    patients are grouped and sorted on a single integer column"""
+    df[_PATIENT_KEY] = (
+        df.groupby(_PATIENT_COLS, sort=True, observed=True, dropna=True)
+        .ngroup()
+        .astype("Int64")
+    )
+    return df
+
+
+def to_object_dtypes(df, columns=None):
+    """Turn the category and string columns of df (all or the given ones) back to plain
+    object columns, as they were before the compact dtypes of load_data"""
+    columns = df.columns if columns is None else columns
+    return df.astype(
+        {
+            c: object
+            for c in columns
+            if isinstance(df[c].dtype, (pd.CategoricalDtype, pd.StringDtype))
+        }
+    )
+
+
+def _partition_folder(year, month):
+    return os.path.join(_DATASET_FOLDER, f"year={year}", f"month={month}")
+
+
+def _partition_file(year, month):
+    return os.path.join(_partition_folder(year, month), "part-0.parquet")
+
+
+def _isolates_file(year, month):
+    """Classified isolates of the partition, see check_resistance._classify_partition"""
+    return os.path.join(
+        _ISOLATES_FOLDER, f"year={year}", f"month={month}", "part-0.parquet"
+    )
+
+
+def _cached_partitions():
+    """(year, month) of the partitions in the cached dataset"""
+    if not os.path.isdir(_DATASET_FOLDER):
+        return
+    for folder in os.listdir(_DATASET_FOLDER):
+        for subfolder in os.listdir(os.path.join(_DATASET_FOLDER, folder)):
+            match = re.fullmatch(r"year=(\d+)/month=(\d+)", f"{folder}/{subfolder}")
+            if match:
+                yield int(match[1]), int(match[2])
+
+
+def _drop_partition(year, month):
+    """Remove the partition and the classified isolates of a month whose export is no longer
+    in data, with its record in version.json"""
+    shutil.rmtree(_partition_folder(year, month), ignore_errors=True)
+    shutil.rmtree(os.path.dirname(_isolates_file(year, month)), ignore_errors=True)
+    _CACHED_VERSION.get("isolates", {}).pop(f"{year}-{month}", None)
+    _CURRENT_VERSION["isolates"].pop(f"{year}-{month}", None)
+
+
+def _ingest_file(file, year, month):
+    """Read data/file one batch at a time (see _read_csv), rename its columns and append the
+    observations of year-month to its parquet partition. Runs in a worker process.
+
+    Only one batch of the export is in memory at a time, whatever the size of the file. Each
+    batch is sorted by data_prelievo before being written, so every row group covers a short
+    range of dates for its statistics, but the partition as a whole is not sorted: load_data
+    sorts the rows it reads. The partition is written to a temporary file and replaces the
+    previous one only when complete."""
+    ## FIXME: alcuni valori quantitativi sono registrati con la virgola, con problemi di tabulazione es <=0.25 vs. <=0,25 !!
+    path = _partition_file(year, month)
+    os.makedirs(_partition_folder(year, month), exist_ok=True)
+    writer = None
+    try:
+        for df in _read_csv(os.path.join("data", file), batch_size=_ROW_GROUP_SIZE):
+            # rename columns
+            df = _rename_columns_and_add_missing_info(df)
+            # filter date
+            df = df[
+                (df.data_prelievo.dt.month == month)
+                & (df.data_prelievo.dt.year == year)
+            ].sort_values("data_prelievo", kind="stable")
+            if writer is None:
+                # Every batch has the same columns, the schema of the first one is the schema of the partition
+                writer = pq.ParquetWriter(f"{path}.tmp", _cache_schema(df))
+            if len(df):
+                writer.write_table(
+                    pa.Table.from_pandas(
+                        df, schema=writer.schema, preserve_index=False
+                    ),
+                    row_group_size=_ROW_GROUP_SIZE,
+                )
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f'File "{file}" has no records')
+    os.replace(f"{path}.tmp", path)
+
+
+def _data_files():
+    """(file, year, month) of the Mercurio exports in data, named YY-MM.csv"""
+    for file in sorted(os.listdir("data")):
+        if not file.endswith(".csv") or file.startswith("."):
+            continue
+        year, month = file.replace(".csv", "").split("-")
+        if len(year) == 2:
+            year = "20" + year
+        yield file, int(year), int(month)
+
+
+def _process_files(silent=False, workers=None, backend="processes"):
+    """read all csv files in "data" and process them. Process means that columns are renamed, observation are filtered according to month and file is saved as parquet file. Files are processed in parallel by `workers` processes or threads according to backend (default: number of cpus, see _executor). Cached file named version.json is evaluated/updated."""
     os.makedirs("_cached_data", exist_ok=True)
-    if not _check_cached_version(silent=silent):
+    _CURRENT_VERSION["files"] = {}
+    if not _check_cached_version("ingestion", silent=silent):
+        shutil.rmtree(_DATASET_FOLDER, ignore_errors=True)
+        # Monthly files of the previous cache layout
         for file in os.listdir("_cached_data"):
-            os.remove(os.path.join("_cached_data", file))
+            if re.fullmatch(r"\d{4}-\d{1,2}\.parquet", file):
+                os.remove(os.path.join("_cached_data", file))
     else:
         if not silent:
             print("Cache is coherent with current version. No need to reprocess files.")
 
+    # The months whose file was removed from data are dropped, not loaded from the cache
+    exported = {(year, month) for _, year, month in _data_files()}
+    for year, month in sorted(set(_cached_partitions()) - exported):
+        if not silent:
+            print(f"File of {year}-{month} removed from data, dropping its cached data")
+        _drop_partition(year, month)
+
     # iterate through all files in data folder
-    for file in os.listdir("data"):
-        if not file.endswith(".csv") or file.startswith("."):
-            continue
-        year, month = file.replace(".csv", "").split("-")
-        if len(year) == 2:
-            year = "20" + year
-        month = int(month)
-        year = int(year)
+    to_process = []
+    for file, year, month in _data_files():
         # check if file is already processed
-        if os.path.exists(os.path.join("_cached_data", f"{year}-{month}.parquet")):
-            actual_file_hash = _get_hash_for_file(os.path.join("data", file))
-            try:
-                if actual_file_hash == _CACHED_VERSION_HASHES[file]:
-                    _CURRENT_VERSION_HASHES[file] = actual_file_hash
-                    if not silent:
-                        print(f"File {file} already processed, skipping")
-                    continue
-            except KeyError:
-                pass
+        fingerprint = _get_fingerprint_for_file(
+            os.path.join("data", file), _CACHED_VERSION.get("files", {}).get(file)
+        )
+        if os.path.exists(_partition_file(year, month)):
+            if _same_content(fingerprint, _CACHED_VERSION.get("files", {}).get(file)):
+                _CURRENT_VERSION["files"][file] = fingerprint
+                if not silent:
+                    print(f"File {file} already processed, skipping")
+                continue
         if not silent:
             print(f"Processing file {file} as it was not cached or has changed")
-        # read csv
-        ## FIXME: alcuni valori quantitativi sono registrati con la virgola, con problemi di tabulazione es <=0.25 vs. <=0,25 !!
-        df = _read_csv(os.path.join("data", file))
-        # rename columns
-        df = _rename_columns_and_add_missing_info(df)
-        # filter date
-        df = df[
-            (df.data_prelievo.dt.month == month) & (df.data_prelievo.dt.year == year)
-        ]
-        # save as parquet
-        df.to_parquet(os.path.join("_cached_data", f"{year}-{month}.parquet"))
-        # update cached version
-        actual_file_hash = _get_hash_for_file(os.path.join("data", file))
-        _CURRENT_VERSION_HASHES[file] = actual_file_hash
+        to_process.append((file, year, month, fingerprint))
+
+    # Hashes are merged in version.json only at the end, a file that fails is not recorded and will be processed again
+    errors = []
+
+    def _collect(file, fingerprint, wait, i):
+        try:
+            wait()
+            _CURRENT_VERSION["files"][file] = fingerprint
+        except Exception as e:
+            errors.append(e)
+            print(f"Error processing file {file}: {e}")
+            return
+        if not silent:
+            print(f"File {file} processed ({i}/{len(to_process)})")
+
+    fingerprints = {file: fingerprint for file, _, _, fingerprint in to_process}
+    for i, ((file, year, month), wait) in enumerate(
+        _executor(backend, workers).run(
+            _ingest_file,
+            [(file, year, month) for file, year, month, _ in to_process],
+        ),
+        1,
+    ):
+        _collect(file, fingerprints[file], wait, i)
     _update_cached_version()
+    if errors:
+        raise errors[0]
 
 
 def _convert_year_month_to_months(year, month):
@@ -300,7 +840,7 @@ def _convert_months_to_year_month(months):
     return y, m
 
 
-def _load_manual_db_adds(df):
+def _read_manual_db_adds():
     manual_db_adds = pd.read_excel(
         "manual_db_adds.xlsx",
         dtype={
@@ -313,7 +853,7 @@ def _load_manual_db_adds(df):
     if len(manual_db_adds) == 0:
         return pd.DataFrame()
     print(f'Readed {len(manual_db_adds)} manual_db_adds from "manual_db_adds.xlsx"')
-    manual_db_adds = manual_db_adds.reindex(
+    return manual_db_adds.reindex(
         columns=[
             "id_richiesta",
             "id_microbo",
@@ -321,6 +861,14 @@ def _load_manual_db_adds(df):
             "risultato_quantitativo",
         ]
     )
+
+
+def _load_manual_db_adds(df, manual_db_adds=None):
+    manual_db_adds = (
+        _read_manual_db_adds() if manual_db_adds is None else manual_db_adds
+    )
+    if len(manual_db_adds) == 0:
+        return pd.DataFrame()
     # Match on cognome_paziente, nome_paziente, id_richiesta, id_microbo in order to inject the id_antibiotico and risultato_quantitativo
     manual_db_adds = pd.merge(
         df.drop(
@@ -329,7 +877,8 @@ def _load_manual_db_adds(df):
                 "nome_antibiotico",
                 "risultato_quantitativo",
                 "source",
-            ]
+            ],
+            errors="ignore",  # load_data may have been asked for less columns
         ).drop_duplicates(subset=["id_richiesta", "id_microbo"]),
         manual_db_adds,
         on=["id_richiesta", "id_microbo"],
@@ -346,49 +895,9 @@ def _load_manual_db_adds(df):
     return manual_db_adds
 
 
-def load_data(year, month: Optional[int] = None, silent=False):
-    _process_files(silent=silent)
-    if month:
-        sources = []
-        months = _convert_year_month_to_months(year, month)
-        for i in range(
-            months - 2, months + 3 + 1
-        ):  # 12 for margin, 1 for current month
-            y, m = _convert_months_to_year_month(i)
-            if not os.path.exists(os.path.join("_cached_data", f"{y}-{m}.parquet")):
-                if not silent:
-                    print(
-                        f'File "{y}-{m}.parquet" not found, continuing without it!!!!'
-                    )
-            else:
-                if not silent:
-                    print(
-                        'File "{}" found, adding it to sources'.format(
-                            f"{y}-{m}.parquet"
-                        )
-                    )
-                sources.append(f"{y}-{m}.parquet")
-    else:
-        sources = []
-        months = _convert_year_month_to_months(year, 1)
-        for i in range(
-            months - 2, months + 12 + 3 + 1
-        ):  # 2 for margin, 12 for all months
-            y, m = _convert_months_to_year_month(i)
-            if not os.path.exists(os.path.join("_cached_data", f"{y}-{m}.parquet")):
-                if not silent:
-                    print(
-                        f'File "{y}-{m}.parquet" not found, continuing without it!!!!'
-                    )
-            else:
-                if not silent:
-                    print(
-                        'File "{}" found, adding it to sources'.format(
-                            f"{y}-{m}.parquet"
-                        )
-                    )
-                sources.append(f"{y}-{m}.parquet")
-    # Calculate the bounds of the data using data_prelievo
+def _load_window(year, month: Optional[int] = None):
+    """Bounds [low, high) as (year, month) of the observations loaded for the requested month
+    (or year): from 2 months before to 3 months after"""
     if month:
         months = _convert_year_month_to_months(year, month)
         low = _convert_months_to_year_month(months - 2)
@@ -398,35 +907,64 @@ def load_data(year, month: Optional[int] = None, silent=False):
         ## previous and 12 months after
         low = _convert_months_to_year_month(months - 2)
         high = _convert_months_to_year_month(months + 12 + 3)
+    return low, high
 
-    def _read(file):
-        path = os.path.join("_cached_data", file)
-        df = pd.read_parquet(path)
-        df["source"] = file
-        return df
 
-    df = pd.concat(
-        map(_read, sources),
-        ignore_index=True,
-    )
+def _window_partitions(low, high, silent=False):
+    """(year, month) of the cached partitions within [low, high)"""
+    partitions = []
+    for i in range(
+        _convert_year_month_to_months(*low), _convert_year_month_to_months(*high)
+    ):
+        y, m = _convert_months_to_year_month(i)
+        if not os.path.exists(_partition_file(y, m)):
+            if not silent:
+                print(f'Partition "{y}-{m}" not found, continuing without it!!!!')
+        else:
+            if not silent:
+                print(f'Partition "{y}-{m}" found, adding it to sources')
+            partitions.append((y, m))
+    return partitions
 
+
+# Test observations, never loaded
+_TEST_RICHIESTE = [
+    "77441648",
+    "77441652",
+    "77441942",
+    "80851343",
+    "80854688",
+    "77462443",
+    "77462488",
+    "77464108",
+]
+
+
+def _read_partitions(partitions, columns: Optional[Iterable] = None, filter=None):
+    """Rows of the given (year, month) partitions matching the pyarrow filter, with only the
+    given columns (all if None) and the source they come from. Test observations are dropped.
+    """
+    dataset = ds.dataset(
+        [_partition_file(y, m) for y, m in partitions],
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([("year", pa.int32()), ("month", pa.int32())]), flavor="hive"
+        ),
+        partition_base_dir=_DATASET_FOLDER,
+    )
+    table = dataset.to_table(
+        columns=None if columns is None else [*columns, "year", "month"],
+        filter=filter,
+    )
+    df = table.to_pandas()
+    df["source"] = (
+        df.pop("year").astype(str) + "-" + df.pop("month").astype(str) + ".parquet"
+    )
     # Delete test observations
-    df = df[
-        ~df.id_richiesta.isin(
-            [
-                "77441648",
-                "77441652",
-                "77441942",
-                "80851343",
-                "80854688",
-                "77462443",
-                "77462488",
-                "77464108",
-            ]
-        )
-    ]
-    # Load manual_db_adds
-    manual_db_adds = _load_manual_db_adds(df)
+    return df[~df.id_richiesta.isin(_TEST_RICHIESTE)]
+
+
+def _restrict_manual_db_adds(manual_db_adds, low, high):
     if len(manual_db_adds):
         n_manual_db_adds_not_relevant = (
             ~(  # including the first day of the month
@@ -443,19 +981,71 @@ def load_data(year, month: Optional[int] = None, silent=False):
         print(
             f"Included {len(manual_db_adds)} manual_db_adds ({n_manual_db_adds_not_relevant} not relevant)"
         )
-    df = pd.concat([df, manual_db_adds], ignore_index=True)
+    return manual_db_adds
 
-    df = df[
-        (df.data_prelievo >= f"{low[0]}-{low[1]}-01")
-        & (df.data_prelievo < f"{high[0]}-{high[1]}-01")
-    ]
 
+def _with_compact_dtypes(df):
     df["risultato_quantitativo"] = df.risultato_quantitativo.replace(
         {"false": False, "true": True}
     )
+    return _apply_compact_dtypes(df)
+
+
+def load_data(
+    year,
+    month: Optional[int] = None,
+    silent=False,
+    workers=None,
+    columns: Optional[Iterable] = None,
+    backend="processes",
+):
+    """Load the observations from 2 months before to 3 months after the requested month (or
+    year) from the cached dataset. Only the partitions of those months and the rows within
+    the dates are read, and only the requested columns (all if None) plus the ones needed to
+    merge manual_db_adds.
+
+    patient_key (see _add_patient_key) is added if columns is None or contains it, the patient
+    names are kept only if requested."""
+    _process_files(silent=silent, workers=workers, backend=backend)
+    # Calculate the bounds of the data using data_prelievo
+    low, high = _load_window(year, month)
+    partitions = _window_partitions(low, high, silent=silent)
+    if not partitions:
+        raise ValueError("Nessun dato presente!")
+    add_patient_key = columns is None or _PATIENT_KEY in columns
+    if columns is not None:
+        names = [c for c in _PATIENT_COLS if c in columns]
+        columns = [c for c in columns if c != _PATIENT_KEY]
+        if add_patient_key:
+            columns += _PATIENT_COLS
+        columns = list(dict.fromkeys([*columns, *_LOAD_DATA_REQUIRED_COLUMNS]))
+    else:
+        names = _PATIENT_COLS
+    df = _read_partitions(
+        partitions,
+        columns=columns,
+        filter=(ds.field("data_prelievo") >= pd.Timestamp(f"{low[0]}-{low[1]}-01"))
+        & (ds.field("data_prelievo") < pd.Timestamp(f"{high[0]}-{high[1]}-01")),
+    )
+    # Load manual_db_adds
+    manual_db_adds = _restrict_manual_db_adds(_load_manual_db_adds(df), low, high)
+    # Both are already restricted to the dates
+    df = pd.concat([df, manual_db_adds], ignore_index=True)
+
+    df = _with_compact_dtypes(df)
+    if add_patient_key:
+        df = _add_patient_key(df).drop(
+            columns=[c for c in _PATIENT_COLS if c not in names]
+        )
     return df.sort_values("data_prelievo")
 
 
+def gruppo_microbo_indices(df) -> dict:
+    """Positions of the rows of df for each id_gruppo_microbo (lowercase), to be passed to
+    filter_df_for_count as group_indices when filtering the same df many times"""
+    return df.groupby(df.id_gruppo_microbo.str.lower(), sort=False).indices
+
+
 def filter_df_for_count(
     df,
     year: int,
@@ -465,26 +1055,47 @@ def filter_df_for_count(
     tag: str = None,
     custom_filter_fn=lambda df: df,
     custom_filter_fn_kwargs={},
+    group_indices: Optional[dict] = None,
 ):
-    temp_df = df.copy()
-    if id_gruppo_microbo:
-        temp_df = temp_df[
-            temp_df.id_gruppo_microbo.str.lower() == id_gruppo_microbo.lower()
-        ]
-    if tag and temp_df.shape[0]:
-        temp_df = temp_df[temp_df.tags.str.split("|").apply(lambda tags: tag in tags)]
-    if resistances is not None:
-        temp_df = temp_df[temp_df.resistente.isin(resistances)]
+    temp_df = _select_for_count(
+        df,
+        resistances=resistances,
+        id_gruppo_microbo=id_gruppo_microbo,
+        tag=tag,
+        group_indices=group_indices,
+    )
     temp_df = custom_filter_fn(temp_df, **custom_filter_fn_kwargs)
     # Now restrict to actual year
-    temp_df = temp_df[(temp_df.data_prelievo.dt.year == year)]
+    mask = temp_df.data_prelievo.dt.year == year
     # If month is specified, restrict to that month
     if month:
-        temp_df = temp_df[(temp_df.data_prelievo.dt.month == month)]
-    cols = temp_df.columns.tolist()
-    temp_df["tag"] = tag
+        mask &= temp_df.data_prelievo.dt.month == month
+    temp_df = temp_df[mask].copy()
+    temp_df.insert(temp_df.columns.get_loc("tags"), "tag", tag)
     temp_df["id_richiesta"] = temp_df["id_richiesta"].astype(int)
-    tags_col_index = cols.index("tags")
-    cols = cols[:tags_col_index] + ["tag"] + cols[tags_col_index:]
-    temp_df = temp_df[cols].copy()
+    return temp_df
+
+
+def _select_for_count(
+    df,
+    resistances: Optional[Iterable] = None,
+    id_gruppo_microbo: str = None,
+    tag: str = None,
+    group_indices: Optional[dict] = None,
+):
+    """The rows of df that filter_df_for_count passes to custom_filter_fn"""
+    # Only the rows of the requested gruppo microbo are materialized, df is never copied as a whole
+    if id_gruppo_microbo:
+        if group_indices is not None:
+            temp_df = df.iloc[
+                group_indices.get(id_gruppo_microbo.lower(), np.array([], dtype=int))
+            ]
+        else:
+            temp_df = df[df.id_gruppo_microbo.str.lower() == id_gruppo_microbo.lower()]
+    else:
+        temp_df = df.copy()
+    if tag and temp_df.shape[0]:
+        temp_df = temp_df[has_tag(temp_df, tag)]
+    if resistances is not None:
+        temp_df = temp_df[temp_df.resistente.isin(resistances)]
     return temp_df
@@ -1,49 +1,114 @@
+from collections import Counter
+import datetime
+import itertools
 from itertools import combinations
+import json
+import os
 from typing import Iterable, List, Optional
+import numpy as np
 import openpyxl
+from openpyxl.cell import Cell, WriteOnlyCell
+from openpyxl.utils import get_column_letter
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
 import re
+from .helper import _generate_csv_legend_path
 
-_widths = pd.read_csv("utils/widths.csv", index_col=[0, 1])
+_widths = pd.read_csv(_generate_csv_legend_path("widths.csv"), index_col=[0, 1])
+
+
+_BOLD = openpyxl.styles.Font(bold=True)
+_THIN = openpyxl.styles.Side(border_style="thin")
+_BOX = openpyxl.styles.Border(bottom=_THIN, left=_THIN, right=_THIN, top=_THIN)
+_CENTER = openpyxl.styles.Alignment(horizontal="center")
+_WRAP = openpyxl.styles.Alignment(wrap_text=True)
+# Style of the header DataFrame.to_excel writes
+_PANDAS_HEADER_ALIGNMENT = openpyxl.styles.Alignment(
+    horizontal="center", vertical="top"
+)
+# Number formats DataFrame.to_excel gives to dates and datetimes
+_PANDAS_DATE_FORMATS = {
+    datetime.datetime: "YYYY-MM-DD HH:MM:SS",
+    datetime.date: "YYYY-MM-DD",
+}
+
+
+def _cell(ws, value=None, style=None, hyperlink=None, **attributes):
+    """A cell of a write-only worksheet with the given named style, hyperlink and attributes
+    (font, border, alignment, number_format)"""
+    cell = WriteOnlyCell(ws, value)
+    if hyperlink is not None:
+        cell.hyperlink = hyperlink
+    if style is not None:
+        cell.style = style
+    for name, attribute in attributes.items():
+        setattr(cell, name, attribute)
+    return cell
+
+
+def _excel_value(value):
+    """(value, number_format) of a value as DataFrame.to_excel writes it, None if the cell is
+    left empty"""
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None, None
+    if pd.api.types.is_integer(value):
+        return int(value), None
+    if pd.api.types.is_float(value):
+        if np.isinf(value):
+            return ("inf" if value > 0 else "-inf"), None
+        return float(value), None
+    if pd.api.types.is_bool(value):
+        return bool(value), None
+    for kind, number_format in _PANDAS_DATE_FORMATS.items():
+        if isinstance(value, kind):
+            return value, number_format
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds() / 86400, "0"
+    value = str(value)
+    return (value or None), None
 
 
 def add_overall_ws_intestation_row(ws):
-    ws.cell(1, 1, "Periodo di riferimento")
-    ws.cell(1, 2, "Tag materiale")
-    ws.cell(1, 3, "Matrice")
-    ws.cell(1, 4, "ID gruppo microbo")
-    ws.cell(1, 5, "Gruppo microbo")
-    ws.cell(1, 6, "Dettaglio isolati")
-    ws.cell(1, 7, "Totale isolati")
-    ws.cell(1, 8, "Resistenti (%)")
-    ws.cell(1, 9, "Dettaglio resistenze")
-    for cell in ws[1:1]:
-        cell.font = openpyxl.styles.Font(bold=True)
-        side = openpyxl.styles.Side(border_style="thin")
-        cell.border = openpyxl.styles.Border(
-            bottom=side, left=side, right=side, top=side
-        )
-        cell.alignment = openpyxl.styles.Alignment(horizontal="center")
+    ws.append(
+        [
+            _cell(ws, title, font=_BOLD, border=_BOX, alignment=_CENTER)
+            for title in (
+                "Periodo di riferimento",
+                "Tag materiale",
+                "Matrice",
+                "ID gruppo microbo",
+                "Gruppo microbo",
+                "Dettaglio isolati",
+                "Totale isolati",
+                "Resistenti (%)",
+                "Dettaglio resistenze",
+            )
+        ]
+    )
 
 
 def add_overall_rates_ws_intestation_row(ws):
-    ws.cell(1, 1, "Periodo di riferimento")
-    ws.cell(1, 2, "Tag materiale")
-    ws.cell(1, 3, "Matrice")
-    ws.cell(1, 4, "IDs gruppi microbi")
-    ws.cell(1, 5, "Nome indicatore")
-    ws.cell(1, 6, "Numeratore")
-    ws.cell(1, 7, "Tasso per 10.000 gg")
-    ws.cell(1, 8, "Tasso per 1.000 ricoveri o pazienti")
-    ws.cell(1, 9, "Totale giornate di degenza")
-    ws.cell(1, 10, "Totale ricoveri o pazienti")
-    for cell in ws[1:1]:
-        cell.font = openpyxl.styles.Font(bold=True)
-        side = openpyxl.styles.Side(border_style="thin")
-        cell.border = openpyxl.styles.Border(
-            bottom=side, left=side, right=side, top=side
-        )
-        cell.alignment = openpyxl.styles.Alignment(horizontal="center")
+    ws.append(
+        [
+            _cell(ws, title, font=_BOLD, border=_BOX, alignment=_CENTER)
+            for title in (
+                "Periodo di riferimento",
+                "Tag materiale",
+                "Matrice",
+                "IDs gruppi microbi",
+                "Nome indicatore",
+                "Numeratore",
+                "Tasso per 10.000 gg",
+                "Tasso per 1.000 ricoveri o pazienti",
+                "Totale giornate di degenza",
+                "Totale ricoveri o pazienti",
+            )
+        ]
+        # Link to overall sheet
+        + [None, _cell(ws, "torna all'indice", "Hyperlink", "#'overall'!A1")]
+    )
 
 
 def _get_width(column_letter: str, sheet_name: str = "_default"):
@@ -53,36 +118,10 @@ def _get_width(column_letter: str, sheet_name: str = "_default"):
         return 10
 
 
-def set_column_widths(wb):
-    for ws in wb._sheets:
-        sheet_name = ws.title
-        width_name = sheet_name
-        if sheet_name not in ("overall", "overall_rates"):
-            width_name = "_default"
-        for column in [c[0].column_letter for c in list(ws.columns)]:
-            wb[sheet_name].column_dimensions[column].width = _get_width(
-                column, sheet_name=width_name
-            )
-
-
-def set_wb_filters(wb):
-    for ws in wb._sheets:
-        if ws.title in ("overall"):
-            if not len(ws["A"]):
-                continue
-            ws.auto_filter.ref = ws.dimensions
-        elif ws.title in ("overall_rates"):
-            if not len(ws["A"]) or not len(ws["K"]):
-                continue
-            left = ws["A"][0].coordinate
-            right = ws["J"][-1].coordinate
-            ws.auto_filter.ref = f"{left}:{right}"
-        else:
-            if not len(ws["A"]) or not len(ws["K"]):
-                continue
-            left = ws["A"][0].coordinate
-            right = ws["K"][-1].coordinate
-            ws.auto_filter.ref = f"{left}:{right}"
+def _set_column_widths(ws, n_columns, width_name="_default"):
+    for column in range(1, n_columns + 1):
+        column = get_column_letter(column)
+        ws.column_dimensions[column].width = _get_width(column, sheet_name=width_name)
 
 
 def generate_date_reference_for_excel_output(year: int, month: Optional[int] = None):
@@ -96,21 +135,32 @@ def simplify_resistances(resistances: Iterable):
     return list(set([re.sub(r">.*", "", resistance) for resistance in resistances]))
 
 
+def _count_combinations(resistenze: pd.Series, unique_resistenze) -> List:
+    """(resistances, n) of each combination of unique_resistenze in at least one row of
+    resistenze, n being the number of rows with all of them, in the order of
+    combinations(unique_resistenze, i) for i = 1, 2, ...
+
+    The rows are counted once per distinct set of resistances and each set adds its count to
+    its own subsets only, instead of checking every row against every combination."""
+    position = {resistance: i for i, resistance in enumerate(unique_resistenze)}
+    counts = Counter()
+    for observed, n in Counter(map(frozenset, resistenze)).items():
+        observed = sorted(position[resistance] for resistance in observed)
+        for i in range(1, len(observed) + 1):
+            for combination in combinations(observed, i):
+                counts[combination] += n
+    return [
+        (tuple(unique_resistenze[j] for j in combination), counts[combination])
+        for combination in sorted(counts, key=lambda c: (len(c), c))
+    ]
+
+
 def _generate_resistenti_text_for_mdr_details(resistenze: pd.Series) -> List:
     unique_resistenze = resistenze.explode().unique()
     text_chunks = []
-    for i in range(1, len(unique_resistenze) + 1):
-        for resistances in combinations(unique_resistenze, i):
-            mask = resistenze.apply(
-                lambda resistenze_di_ogni_mo: all(
-                    r in resistenze_di_ogni_mo for r in resistances
-                )
-            )
-            n = mask.sum()
-            if n == 0:
-                continue
-            legend = "DET -> " + "+".join(resistances).replace("MDR>", "").strip()
-            text_chunks.append(f"{legend}: {n}")
+    for resistances, n in _count_combinations(resistenze, unique_resistenze):
+        legend = "DET -> " + "+".join(resistances).replace("MDR>", "").strip()
+        text_chunks.append(f"{legend}: {n}")
     return text_chunks
 
 
@@ -118,23 +168,11 @@ def generate_resistenti_text_for_excel_output(df: pd.DataFrame):
     # fmt: off
     resistenze_no_details = df.resistente.replace("", pd.NA).dropna().str.replace('||', '|', regex=False).str.split("|").map(simplify_resistances, na_action='ignore')
     unique_resistenze = resistenze_no_details.explode().unique()
-    mdr_details = df.resistente.replace("", pd.NA).dropna().str.split('|').explode()
-    mdr_details = mdr_details[mdr_details.apply(lambda x: "MDR>" in x)]
-    mdr_details = mdr_details.str.replace('MDR>', '', regex=False)
     # fmt: on
     text_chunks = []
-    for i in range(1, len(unique_resistenze) + 1):
-        for resistances in combinations(unique_resistenze, i):
-            mask = resistenze_no_details.apply(
-                lambda resistenze_di_ogni_mo: all(
-                    r in resistenze_di_ogni_mo for r in resistances
-                )
-            )
-            n = mask.sum()
-            if n == 0:
-                continue
-            legend = "+".join(resistances)
-            text_chunks.append(f"{legend}: {n}")
+    for resistances, n in _count_combinations(resistenze_no_details, unique_resistenze):
+        legend = "+".join(resistances)
+        text_chunks.append(f"{legend}: {n}")
     resistenze = (
         df.resistente.replace("", pd.NA)
         .dropna()
@@ -144,3 +182,408 @@ def generate_resistenti_text_for_excel_output(df: pd.DataFrame):
     if "MDR" in unique_resistenze:
         text_chunks += _generate_resistenti_text_for_mdr_details(resistenze=resistenze)
     return "\n".join(text_chunks)
+
+
+class _report_writer:
+    """Write the report workbook in a single pass with openpyxl write-only mode: the overall and
+    overall_rates sheets first, then a detail sheet per instruction, each row with its styles
+    and hyperlinks as it is written. The widths are set before the rows and the filters before
+    saving, so the workbook is never read back.
+
+    A detail sheet is the output of DataFrame.to_excel, with column K wrapped and in L1 the link
+    back to the overall row. If more instructions have the same sheet name, the later frames
+    overwrite the cells of the earlier ones, as the consecutive to_excel calls on the same
+    sheet did."""
+
+    def __init__(self, path, sheet_names, year, month):
+        self.path = path
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.reference_date = generate_date_reference_for_excel_output(year, month)
+        self.reference_date_format = openpyxl.styles.NamedStyle(
+            name="cd2", number_format="MMM-YY"
+        )
+        self.overall = self.wb.create_sheet("overall")
+        _set_column_widths(self.overall, 9, "overall")
+        add_overall_ws_intestation_row(self.overall)
+        self.overall_rates = self.wb.create_sheet("overall_rates")
+        _set_column_widths(self.overall_rates, 12, "overall_rates")
+        add_overall_rates_ws_intestation_row(self.overall_rates)
+        self._n_overall = self._n_overall_rates = 1
+        # Sheets in order of first use, the cells of a repeated sheet are kept until its last use
+        self._details = {name: None for name in sheet_names}
+        for name in self._details:
+            self._details[name] = self.wb.create_sheet(name)
+        self._uses = Counter(sheet_names)
+        self._pending = {}
+
+    def add_overall_row(
+        self,
+        sheet_name,
+        tag_materiale,
+        nome_tag_materiale,
+        id_gruppo_microbo,
+        nome_gruppo_microbo,
+        tot,
+        resistenti=None,
+        resistenti_text=None,
+    ):
+        """Append a row to the overall sheet and return its number"""
+        ws = self.overall
+        row = [
+            _cell(ws, self.reference_date, self.reference_date_format),
+            tag_materiale,
+            nome_tag_materiale,
+            id_gruppo_microbo,
+            nome_gruppo_microbo,
+            _cell(ws, "vai al dettaglio", "Hyperlink", f"#'{sheet_name}'!A1"),
+        ]
+        if tot is not None:
+            # Add tot
+            row.append(tot)
+            if resistenti is not None:
+                # Add n resistenti and pct
+                row.append(f"{resistenti} ({resistenti/tot:.0%})".replace(".", ","))
+                # add dettaglio resistenze if any resistenti
+                if resistenti:
+                    row.append(_cell(ws, resistenti_text, alignment=_WRAP))
+        ws.append(row)
+        self._n_overall += 1
+        return self._n_overall
+
+    def add_overall_rates_row(
+        self,
+        tag_materiale,
+        nome_materiale,
+        id_gruppo_microbi,
+        nome,
+        numeratore=None,
+        days_of_hospitalization=None,
+        number_of_admissions_or_patients=None,
+    ):
+        ws = self.overall_rates
+        i = self._n_overall_rates + 1
+        row = [
+            _cell(ws, self.reference_date, self.reference_date_format),
+            tag_materiale,
+            nome_materiale,
+            _cell(ws, id_gruppo_microbi, alignment=_WRAP),
+            nome,
+            None,
+            None,
+            None,
+            days_of_hospitalization,
+            number_of_admissions_or_patients,
+        ]
+        if numeratore is not None:
+            row[5] = numeratore
+            if days_of_hospitalization is not None:
+                # Add tasso per 10.000 gg as formula
+                row[6] = _cell(ws, f"=F{i}/I{i}*10000", number_format="0.00")
+            if number_of_admissions_or_patients is not None:
+                # Add tasso per 1.000 ricoveri or pazienti as formula
+                row[7] = _cell(ws, f"=F{i}/J{i}*1000", number_format="0.00")
+        ws.append(row)
+        self._n_overall_rates = i
+
+    def add_detail(self, sheet_name, df, overall_row):
+        """Write df in the detail sheet sheet_name, linked to the overall_row of the overall
+        sheet"""
+        # (value, number_format) of the cells to_excel writes, the header in the first row
+        rows = [[(column, None) for column in df.columns]] + [
+            list(values)
+            for values in zip(*(map(_excel_value, df[column]) for column in df.columns))
+        ]
+        previous = self._pending.pop(sheet_name, [])
+        rows = [
+            row + previous_row[len(row) :]
+            for row, previous_row in itertools.zip_longest(rows, previous, fillvalue=[])
+        ]
+        self._uses[sheet_name] -= 1
+        if self._uses[sheet_name]:
+            self._pending[sheet_name] = rows
+            return
+
+        ws = self._details[sheet_name]
+        n_columns = max(len(row) for row in rows)
+        # Column K is wrapped and L1 holds the link, so there are at least 12 columns
+        _set_column_widths(ws, max(n_columns, 12))
+        for i, values in enumerate(rows):
+            row = [
+                (
+                    _cell(
+                        ws,
+                        value,
+                        **(
+                            dict(
+                                font=_BOLD,
+                                border=_BOX,
+                                alignment=_PANDAS_HEADER_ALIGNMENT,
+                            )
+                            if i == 0
+                            else {}
+                        ),
+                        **(
+                            {}
+                            if number_format is None
+                            else dict(number_format=number_format)
+                        ),
+                    )
+                    if i == 0 or number_format is not None
+                    else value
+                )
+                for value, number_format in values
+            ]
+            row += [None] * (11 - len(row))
+            if len(row) == 11:
+                row.append(None)
+            # Set K column wrap_text
+            if isinstance(row[10], Cell):
+                row[10].alignment = _WRAP
+            else:
+                row[10] = _cell(ws, row[10], alignment=_WRAP)
+            if i == 0:
+                # Add link to overall sheet
+                row[11] = _cell(
+                    ws, "torna all'indice", "Hyperlink", f"#'overall'!A{overall_row}"
+                )
+            ws.append(row)
+        ws.auto_filter.ref = f"A1:K{len(rows)}"
+
+    def save(self):
+        self.overall.auto_filter.ref = f"A1:I{self._n_overall}"
+        self.overall_rates.auto_filter.ref = f"A1:J{self._n_overall_rates}"
+        self.wb.save(self.path)
+
+
+# Formats of _columnar_writer, "xlsx" is the workbook of _report_writer
+COLUMNAR_OUTPUT_FORMATS = ("parquet", "csv", "ndjson")
+
+# Schemas of the tables of _columnar_writer, the same whatever the instructions and the options
+_OVERALL_SCHEMA = pa.schema(
+    [
+        ("anno", pa.int16()),
+        ("mese", pa.int8()),
+        ("istruzione", pa.int32()),
+        ("tag_materiale", pa.string()),
+        ("matrice", pa.string()),
+        ("id_gruppo_microbo", pa.string()),
+        ("gruppo_microbo", pa.string()),
+        ("dettaglio", pa.string()),
+        ("totale_isolati", pa.int64()),
+        ("resistenti", pa.int64()),
+        ("percentuale_resistenti", pa.float64()),
+        ("dettaglio_resistenze", pa.string()),
+    ]
+)
+_OVERALL_RATES_SCHEMA = pa.schema(
+    [
+        ("anno", pa.int16()),
+        ("mese", pa.int8()),
+        ("tag_materiale", pa.string()),
+        ("matrice", pa.string()),
+        ("id_gruppi_microbi", pa.string()),
+        ("nome_indicatore", pa.string()),
+        ("numeratore", pa.int64()),
+        ("tasso_10000_gg", pa.float64()),
+        ("tasso_1000_ricoveri_o_pazienti", pa.float64()),
+        ("totale_giornate_degenza", pa.int64()),
+        ("totale_ricoveri_o_pazienti", pa.int64()),
+    ]
+)
+# The drop column is always named to_drop, whatever --drop-column
+_DETAILS_SCHEMA = pa.schema(
+    [
+        ("anno", pa.int16()),
+        ("mese", pa.int8()),
+        ("istruzione", pa.int32()),
+        ("dettaglio", pa.string()),
+        ("id_richiesta", pa.int64()),
+        ("tag", pa.string()),
+        ("tags", pa.string()),
+        ("data_prelievo", pa.date32()),
+        ("nome_reparto", pa.string()),
+        ("id_gruppo_microbo", pa.string()),
+        ("nome_gruppo_microbo", pa.string()),
+        ("id_microbo", pa.string()),
+        ("nome_microbo", pa.string()),
+        ("resistente", pa.string()),
+        ("n_resistenze", pa.float64()),
+        ("to_drop", pa.string()),
+    ]
+)
+
+
+def _write_ndjson(table, path):
+    """table as a json object per line to path or to a binary file, dates as YYYY-MM-DD"""
+    content = "".join(
+        json.dumps(row, ensure_ascii=False, default=str) + "\n"
+        for row in table.to_pylist()
+    ).encode("utf-8")
+    if isinstance(path, (str, os.PathLike)):
+        with open(path, "wb") as f:
+            f.write(content)
+    else:
+        path.write(content)
+
+
+_TABLE_WRITERS = {
+    "parquet": pq.write_table,
+    "csv": pyarrow.csv.write_csv,
+    "ndjson": _write_ndjson,
+}
+
+
+def _optional_int(value):
+    return None if value is None or pd.isna(value) else int(value)
+
+
+class _columnar_writer:
+    """Write the report as the tables overall, overall_rates and details, with the same rows
+    as the sheets of _report_writer and the same methods, for the machine consumers of the
+    report. The schemas are fixed: the numbers are columns of their own instead of text and
+    formulas, and details holds the rows of the detail frames of all the instructions, linked
+    to their overall row by istruzione (the position of the instruction) and dettaglio (the
+    sheet name). Each table is saved in every format of paths, {format: {table: path}}.
+    """
+
+    def __init__(self, paths, year, month, drop_column):
+        self.paths = paths
+        self.year = year
+        self.month = month
+        self.drop_column = drop_column
+        self._overall = []
+        self._overall_rates = []
+        self._details = []
+
+    def add_overall_row(
+        self,
+        sheet_name,
+        tag_materiale,
+        nome_tag_materiale,
+        id_gruppo_microbo,
+        nome_gruppo_microbo,
+        tot,
+        resistenti=None,
+        resistenti_text=None,
+    ):
+        """Add the row of an instruction to the overall table and return its istruzione"""
+        resistenti = _optional_int(resistenti) if tot is not None else None
+        self._overall.append(
+            dict(
+                anno=self.year,
+                mese=self.month,
+                istruzione=len(self._overall),
+                tag_materiale=tag_materiale,
+                matrice=nome_tag_materiale,
+                id_gruppo_microbo=id_gruppo_microbo,
+                gruppo_microbo=nome_gruppo_microbo,
+                dettaglio=sheet_name,
+                totale_isolati=_optional_int(tot),
+                resistenti=resistenti,
+                percentuale_resistenti=(
+                    resistenti / tot * 100 if resistenti is not None else None
+                ),
+                dettaglio_resistenze=resistenti_text if resistenti else None,
+            )
+        )
+        return len(self._overall) - 1
+
+    def add_overall_rates_row(
+        self,
+        tag_materiale,
+        nome_materiale,
+        id_gruppo_microbi,
+        nome,
+        numeratore=None,
+        days_of_hospitalization=None,
+        number_of_admissions_or_patients=None,
+    ):
+        numeratore = _optional_int(numeratore)
+        self._overall_rates.append(
+            dict(
+                anno=self.year,
+                mese=self.month,
+                tag_materiale=tag_materiale,
+                matrice=nome_materiale,
+                id_gruppi_microbi=id_gruppo_microbi,
+                nome_indicatore=nome,
+                numeratore=numeratore,
+                # A rate is missing where the workbook formula would be missing or #DIV/0!
+                tasso_10000_gg=(
+                    numeratore / days_of_hospitalization * 10000
+                    if numeratore is not None and days_of_hospitalization
+                    else None
+                ),
+                tasso_1000_ricoveri_o_pazienti=(
+                    numeratore / number_of_admissions_or_patients * 1000
+                    if numeratore is not None and number_of_admissions_or_patients
+                    else None
+                ),
+                totale_giornate_degenza=_optional_int(days_of_hospitalization),
+                totale_ricoveri_o_pazienti=_optional_int(
+                    number_of_admissions_or_patients
+                ),
+            )
+        )
+
+    def add_detail(self, sheet_name, df, overall_row):
+        """Add the rows of df to the details table, linked to the overall_row istruzione"""
+        constants = dict(
+            anno=self.year,
+            mese=self.month,
+            istruzione=overall_row,
+            dettaglio=sheet_name,
+        )
+        columns = {"to_drop": self.drop_column}
+        arrays = []
+        for field in _DETAILS_SCHEMA:
+            if field.name in constants:
+                values = [constants[field.name]] * len(df)
+            elif columns.get(field.name, field.name) in df.columns:
+                # Categories and string[pyarrow] as python objects, NaN and NA as null
+                values = df[columns.get(field.name, field.name)].astype(object)
+            else:
+                # e.g. resistente and n_resistenze of the gruppi without resistances
+                values = [None] * len(df)
+            arrays.append(pa.array(values, type=field.type, from_pandas=True))
+        self._details.append(pa.Table.from_arrays(arrays, schema=_DETAILS_SCHEMA))
+
+    def tables(self):
+        """{name: arrow table} of the rows added so far"""
+        return dict(
+            overall=pa.Table.from_pylist(self._overall, schema=_OVERALL_SCHEMA),
+            overall_rates=pa.Table.from_pylist(
+                self._overall_rates, schema=_OVERALL_RATES_SCHEMA
+            ),
+            # In a single chunk, write_csv repeats the header at each empty chunk
+            details=pa.concat_tables(
+                [_DETAILS_SCHEMA.empty_table(), *self._details]
+            ).combine_chunks(),
+        )
+
+    def save(self):
+        tables = self.tables()
+        for output_format, paths in self.paths.items():
+            for name, table in tables.items():
+                _TABLE_WRITERS[output_format](table, paths[name])
+
+
+class _report_frames(_columnar_writer):
+    """The report in memory instead of on disk, for analyze_isolates: after save, overall and
+    overall_rates are DataFrames with the columns (and arrow dtypes) of the tables of
+    _columnar_writer and details holds the detail frame of each instruction, in the order of
+    istruzione"""
+
+    def __init__(self, year, month, drop_column):
+        super().__init__({}, year, month, drop_column)
+        self.details = []
+
+    def add_detail(self, sheet_name, df, overall_row):
+        self.details.append(df)
+
+    def save(self):
+        tables = self.tables()
+        self.overall = tables["overall"].to_pandas(types_mapper=pd.ArrowDtype)
+        self.overall_rates = tables["overall_rates"].to_pandas(
+            types_mapper=pd.ArrowDtype
+        )
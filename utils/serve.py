@@ -0,0 +1,465 @@
+import datetime
+import io
+import json
+import os
+import signal
+import socketserver
+import stat
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .analyze import (
+    _ISOLATE_COLS,
+    _KEEP_COLS,
+    _all_instructions,
+    _compute_report,
+    _prepare_isolates,
+)
+from .check_resistance import _classified_isolates, _window_isolates
+from .duplicated_fns import _dedup_cache
+from .helper import (
+    _convert_year_month_to_months,
+    _data_files,
+    _get_fingerprint_for_file,
+    _load_window,
+    _process_files,
+    _read_manual_db_adds,
+    _same_content,
+)
+from .report_helper import (
+    COLUMNAR_OUTPUT_FORMATS,
+    _TABLE_WRITERS,
+    _columnar_writer,
+    _report_writer,
+)
+
+_CONTENT_TYPES = {
+    "json": "application/json",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+# Bounds of the dedup cache kept between the refreshes, the oldest entries are forgotten first
+_MAX_DEDUP_RESULTS = 2_000
+_MAX_DEDUP_HISTORIES = 500_000
+
+
+class _warm_reports:
+    """The state the daemon keeps between the requests: the classified isolates of each
+    partition, the prepared isolates of the windows already requested, a dedup cache of the
+    patient histories, the tables of the reports already computed and the responses already
+    given (a report asked in another format is only serialized again).
+
+    refresh() compares the files in data and manual_db_adds.xlsx with the last refresh (by
+    size and mtime, hashing only the files that changed, see _get_fingerprint_for_file):
+    only the months whose file changed are ingested and classified again, and only the
+    windows, reports and responses that include them are dropped."""
+
+    def __init__(
+        self,
+        instructions,
+        rate_instructions,
+        drop_column="to_drop",
+        default_days_cutoff=30,
+        workers=None,
+        backend="processes",
+    ):
+        self.instructions = list(instructions)
+        self.rate_instructions = list(rate_instructions)
+        self.drop_column = drop_column
+        self.default_days_cutoff = default_days_cutoff
+        self.workers = workers
+        self.backend = backend
+        self._files = {}
+        self._manual_db_adds_file = None
+        self._manual_db_adds = None
+        self._isolates = {}
+        # (year, month) of the window: prepared isolates
+        self._windows = {}
+        # (year, month, selection, options) of the report: its tables (see _columnar_writer)
+        self._tables = {}
+        # key of the request: (body, content type)
+        self._responses = {}
+        self._dedup_cache = _dedup_cache(patient_histories=True)
+        self.refreshed = None
+
+    def refresh(self):
+        """Reload the months whose file in data changed, True if anything changed"""
+        files = {
+            file: (
+                (year, month),
+                _get_fingerprint_for_file(
+                    os.path.join("data", file), self._files.get(file, (None, None))[1]
+                ),
+            )
+            for file, year, month in _data_files()
+        }
+        changed = {
+            partition
+            for file, (partition, fingerprint) in files.items()
+            if not _same_content(fingerprint, self._files.get(file, (None, None))[1])
+        } | {
+            partition
+            for file, (partition, _) in self._files.items()
+            if file not in files
+        }
+        manual_db_adds_file = _get_fingerprint_for_file(
+            "manual_db_adds.xlsx", self._manual_db_adds_file
+        )
+        manual_db_adds_changed = not _same_content(
+            manual_db_adds_file, self._manual_db_adds_file
+        )
+        if not changed and not manual_db_adds_changed:
+            return False
+
+        if changed:
+            print(f"Refreshing {', '.join(f'{y}-{m}' for y, m in sorted(changed))}")
+            # The partitions of the removed files are dropped by _process_files too
+            _process_files(silent=True, workers=self.workers, backend=self.backend)
+            for partition in changed:
+                self._isolates.pop(partition, None)
+            exported = {partition for partition, _ in files.values()}
+            self._isolates.update(
+                _classified_isolates(
+                    [
+                        partition
+                        for partition in sorted(changed)
+                        if partition in exported
+                    ],
+                    _ISOLATE_COLS,
+                    _KEEP_COLS,
+                    silent=True,
+                    workers=self.workers,
+                    backend=self.backend,
+                )
+            )
+        if manual_db_adds_changed:
+            self._manual_db_adds = _read_manual_db_adds()
+            self._manual_db_adds_file = manual_db_adds_file
+        self._files = files
+
+        # The manual_db_adds may change the isolates of any window
+        stale = [
+            window
+            for window in self._windows
+            if manual_db_adds_changed
+            or any(_in_window(partition, *window) for partition in changed)
+        ]
+        for window in stale:
+            del self._windows[window]
+        self._tables = {
+            key: tables for key, tables in self._tables.items() if key[:2] not in stale
+        }
+        self._responses = {
+            key: response
+            for key, response in self._responses.items()
+            if key[:2] not in stale
+        }
+        # The dedup cache is kept: its keys are the content of the rows, the windows and
+        # patients that didn't change still find their results
+        self._dedup_cache.trim(_MAX_DEDUP_RESULTS, _MAX_DEDUP_HISTORIES)
+        self.refreshed = datetime.datetime.now()
+        return True
+
+    def _window(self, year, month):
+        if (year, month) not in self._windows:
+            low, high = _load_window(year, month)
+            isolates = {
+                partition: df
+                for partition, df in sorted(self._isolates.items())
+                if low <= partition < high
+            }
+            if not isolates:
+                raise ValueError("Nessun dato presente!")
+            self._windows[(year, month)] = _prepare_isolates(
+                _window_isolates(
+                    isolates,
+                    low,
+                    high,
+                    _ISOLATE_COLS,
+                    _KEEP_COLS,
+                    self._manual_db_adds,
+                )
+            )
+        return self._windows[(year, month)]
+
+    def report(
+        self,
+        year,
+        month=None,
+        selection=(),
+        output_format="json",
+        table="overall",
+        details=False,
+        days_of_hospitalization=None,
+        number_of_admissions_or_patients=None,
+    ):
+        """(body, content type) of the report of year/month in output_format, only with the
+        instructions whose sheet name (tag-gruppo microbo) or tag is in selection (all if
+        empty). The columnar formats hold a single table, json holds overall and
+        overall_rates (and details if requested)."""
+        if output_format not in _CONTENT_TYPES:
+            raise ValueError(f"Formato non supportato: {output_format}")
+        if table not in ("overall", "overall_rates", "details"):
+            raise ValueError(f"Tabella non valida: {table}")
+        report_key = (
+            year,
+            month,
+            tuple(sorted(selection)),
+            days_of_hospitalization,
+            number_of_admissions_or_patients,
+        )
+        key = report_key + (
+            output_format,
+            table if output_format in COLUMNAR_OUTPUT_FORMATS else None,
+            details if output_format == "json" else None,
+        )
+        if key in self._responses:
+            return self._responses[key]
+        body = io.BytesIO()
+        if output_format != "xlsx" and report_key in self._tables:
+            self._write(self._tables[report_key], output_format, table, details, body)
+            self._responses[key] = (body.getvalue(), _CONTENT_TYPES[output_format])
+            return self._responses[key]
+
+        df = self._window(year, month)
+        instructions = [
+            i
+            for i in _all_instructions(df, year, month, self.instructions)
+            if not selection
+            or i.tag in selection
+            or f"{i.tag}-{i.gruppo_microbo_id}" in selection
+        ]
+        rate_instructions = [
+            i for i in self.rate_instructions if not selection or i.tag in selection
+        ]
+        # The tables are kept for the other formats of the same report
+        reports = [_columnar_writer({}, year, month, self.drop_column)]
+        if output_format == "xlsx":
+            reports.append(
+                _report_writer(
+                    body,
+                    [f"{i.tag}-{i.gruppo_microbo_id}" for i in instructions],
+                    year,
+                    month,
+                )
+            )
+        _compute_report(
+            df,
+            year,
+            month,
+            instructions,
+            rate_instructions,
+            reports,
+            drop_column=self.drop_column,
+            default_days_cutoff=self.default_days_cutoff,
+            days_of_hospitalization=days_of_hospitalization,
+            number_of_admissions_or_patients=number_of_admissions_or_patients,
+            dedup_cache=self._dedup_cache,
+            workers=self.workers,
+            backend=self.backend,
+        )
+        self._tables[report_key] = reports[0].tables()
+        if output_format == "xlsx":
+            reports[1].save()
+        else:
+            self._write(self._tables[report_key], output_format, table, details, body)
+        self._responses[key] = (body.getvalue(), _CONTENT_TYPES[output_format])
+        return self._responses[key]
+
+    @staticmethod
+    def _write(tables, output_format, table, details, body):
+        if output_format == "json":
+            body.write(
+                json.dumps(
+                    {
+                        name: tables[name].to_pylist()
+                        for name in ("overall", "overall_rates")
+                        + (("details",) if details else ())
+                    },
+                    ensure_ascii=False,
+                    default=str,
+                ).encode("utf-8")
+            )
+        else:
+            _TABLE_WRITERS[output_format](tables[table], body)
+
+    def status(self):
+        return dict(
+            partitions=[f"{y}-{m}" for y, m in sorted(self._isolates)],
+            windows=[f"{y}-{m or 'all'}" for y, m in self._windows],
+            reports=len(self._tables),
+            responses=len(self._responses),
+            dedup_cache=dict(
+                hits=self._dedup_cache.hits, misses=self._dedup_cache.misses
+            ),
+            refreshed=self.refreshed and self.refreshed.isoformat(),
+        )
+
+
+def _in_window(partition, year, month):
+    low, high = _load_window(year, month)
+    return (
+        _convert_year_month_to_months(*low)
+        <= _convert_year_month_to_months(*partition)
+        < _convert_year_month_to_months(*high)
+    )
+
+
+def _optional_int(query, name):
+    value = query.get(name, [None])[0]
+    try:
+        return None if value in (None, "") else int(value)
+    except ValueError:
+        raise ValueError(f"Il parametro {name} deve essere un numero intero")
+
+
+class _report_handler(BaseHTTPRequestHandler):
+    """GET /report?year=...&month=...&instruction=...&format=...&table=...&details=1
+    &days_hospitalization=...&n_admissions=... and GET /status, see README"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        reports = self.server.reports
+        try:
+            self.server.refresh_if_due()
+            if url.path == "/status":
+                body, content_type = (
+                    json.dumps(reports.status()).encode("utf-8"),
+                    _CONTENT_TYPES["json"],
+                )
+            elif url.path == "/report":
+                year = _optional_int(query, "year")
+                if year is None:
+                    raise ValueError("Il parametro year è obbligatorio")
+                start = time.perf_counter()
+                body, content_type = reports.report(
+                    year,
+                    _optional_int(query, "month"),
+                    selection=[
+                        name
+                        for value in query.get("instruction", [])
+                        for name in value.split(",")
+                        if name
+                    ],
+                    output_format=query.get("format", ["json"])[0],
+                    table=query.get("table", ["overall"])[0],
+                    details=query.get("details", ["0"])[0] not in ("", "0"),
+                    days_of_hospitalization=_optional_int(
+                        query, "days_hospitalization"
+                    ),
+                    number_of_admissions_or_patients=_optional_int(
+                        query, "n_admissions"
+                    ),
+                )
+                self.log_message("report in %.3f s", time.perf_counter() - start)
+            else:
+                self._send(404, json.dumps({"error": "Not found"}).encode("utf-8"))
+                return
+        except ValueError as e:
+            self._send(400, json.dumps({"error": str(e)}).encode("utf-8"))
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self._send(500, json.dumps({"error": str(e)}).encode("utf-8"))
+            return
+        self._send(200, body, content_type)
+
+    def _send(self, code, body, content_type=_CONTENT_TYPES["json"]):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # The client of a Unix socket has no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class _watching:
+    """Mixin of the servers: refresh the reports every watch_interval seconds while idle and
+    before a request if the last check is older than that"""
+
+    def refresh_if_due(self):
+        if time.monotonic() - self._last_check >= self.watch_interval:
+            self._last_check = time.monotonic()
+            self.reports.refresh()
+
+    def service_actions(self):
+        try:
+            self.refresh_if_due()
+        except Exception:
+            traceback.print_exc()
+
+
+class _tcp_report_server(_watching, HTTPServer):
+    pass
+
+
+class _unix_report_server(_watching, socketserver.UnixStreamServer):
+    def server_bind(self):
+        # A socket left by a previous run would make bind fail, any other file is left alone
+        try:
+            mode = os.lstat(self.server_address).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(
+                    f'"{self.server_address}" esiste già e non è un socket Unix'
+                )
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def serve(
+    instructions,
+    rate_instructions,
+    host="127.0.0.1",
+    port=8765,
+    socket_path=None,
+    watch_interval=5,
+    drop_column="to_drop",
+    default_days_cutoff=30,
+    workers=None,
+    backend="processes",
+):
+    """Serve the reports over HTTP on host:port, or on the Unix socket socket_path, until
+    interrupted. The data are loaded and classified once at startup and then refreshed as the
+    files in data change (see _warm_reports)."""
+    reports = _warm_reports(
+        instructions,
+        rate_instructions,
+        drop_column=drop_column,
+        default_days_cutoff=default_days_cutoff,
+        workers=workers,
+        backend=backend,
+    )
+    # Bound before loading the data, so that a wrong address fails at once
+    if socket_path is not None:
+        server = _unix_report_server(socket_path, _report_handler)
+        address = socket_path
+    else:
+        server = _tcp_report_server((host, port), _report_handler)
+        address = f"http://{host}:{port}"
+    reports.refresh()
+    server.reports = reports
+    server.watch_interval = watch_interval
+    server._last_check = time.monotonic()
+    # Stopped by kill as by Ctrl+C, so that the socket is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Serving reports on {address}")
+    try:
+        server.serve_forever(poll_interval=min(watch_interval, 0.5))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)